@@ -0,0 +1,61 @@
+"""
+Benchmark of the calendar conversion in util.input, on the time axis of 30
+years of 6-hourly data, with np.datetime64 (standard calendar) and cftime
+(noleap) times. Compares the previous conversions, which converted each
+time in Python and read the full time axis to find its type, with
+convert_to_datetime and convert_from_datetime. Also times 12 requests of the
+datetimes of the time axis (e.g. one per month of wind statistics), which
+converted the axis each time before, and are served from the cache of
+get_datetimes now.
+
+Run from the root directory with:
+    python -m benchmarks.bench_calendar
+"""
+import datetime
+import time
+import cftime
+import numpy as np
+import xarray as xr
+
+from util import input
+
+def _convert_to_datetime_prev(ds, dts):
+    if isinstance(np.array(ds['time'])[0], np.datetime64):
+        return np.array(dts.astype('datetime64[s]').tolist())
+    return np.array([datetime.datetime(x.year, x.month, x.day, x.hour) for x in np.array(dts)])
+
+def _convert_from_datetime_prev(ds, dts):
+    if isinstance(np.array(ds['time'])[0], np.datetime64):
+        return np.array([np.datetime64(str(x)) for x in np.array(dts)])
+    return np.array([cftime.DatetimeNoLeap(x.year, x.month, x.day, x.hour) for x in np.array(dts)])
+
+def _time_fx(fx, n_calls = 3):
+    t_best = np.inf
+    for i in range(n_calls):
+        t_start = time.perf_counter()
+        out = fx()
+        t_best = min(t_best, time.perf_counter() - t_start)
+    return (out, t_best)
+
+def main(n_years = 30, n_months = 12):
+    for calendar in ['standard', 'noleap']:
+        times = xr.date_range('1980-01-01', periods = n_years * 365 * 4, freq = '6h', calendar = calendar,
+                              use_cftime = calendar != 'standard')
+        ds = xr.Dataset(coords = dict(time = times))
+        print('%s calendar, %d times:' % (calendar, len(times)))
+
+        dts, t_to_prev = _time_fx(lambda: _convert_to_datetime_prev(ds, ds['time'].values))
+        dts_new, t_to = _time_fx(lambda: input.convert_to_datetime(ds, ds['time'].values))
+        ct, t_from_prev = _time_fx(lambda: _convert_from_datetime_prev(ds, dts))
+        ct_new, t_from = _time_fx(lambda: input.convert_from_datetime(ds, dts))
+        _, t_axis_prev = _time_fx(lambda: [_convert_to_datetime_prev(ds, ds['time'].values) for i in range(n_months)])
+        _, t_axis = _time_fx(lambda: [input.get_datetimes(ds) for i in range(n_months)])
+        assert np.array_equal(dts, dts_new) and np.array_equal(ct, ct_new)
+        for (name, t_prev, t_new) in [('convert_to_datetime', t_to_prev, t_to),
+                                      ('convert_from_datetime', t_from_prev, t_from),
+                                      ('%d time axis requests' % n_months, t_axis_prev, t_axis)]:
+            print('  %-24s previous %8.2f ms, now %8.2f ms, speedup %7.1fx' %
+                  (name + ':', t_prev * 1e3, t_new * 1e3, t_prev / t_new))
+
+if __name__ == '__main__':
+    main()
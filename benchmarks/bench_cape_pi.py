@@ -0,0 +1,52 @@
+"""
+Check and benchmark of the potential intensity computation. Evaluates
+CAPE_PI_vectorized on a stored reference case (3 times of a 25-level
+sounding on a 12 x 16 grid, pseudoadiabatic thermodynamics), one time at
+a time and for all of the times in one call, and compares the potential
+intensity with the reference. The reference was computed with the
+previous implementation, which looped over the pressure levels.
+
+Run from the root directory with:
+    python -m benchmarks.bench_cape_pi
+"""
+import os
+import sys
+import time
+import numpy as np
+
+import namelist
+from thermo import thermo
+
+fn_ref = '%s/data/cape_pi_reference.npz' % os.path.dirname(os.path.abspath(__file__))
+
+def _time_fx(fx, n_calls):
+    t_start = time.perf_counter()
+    for i in range(n_calls):
+        out = fx()
+    return (out, (time.perf_counter() - t_start) / n_calls)
+
+def main(n_calls = 20, tol = 1e-6):
+    namelist.select_thermo = 1
+    namelist.select_interp = 2
+    with np.load(fn_ref) as ref:
+        ref = dict(ref)
+    nt = ref['sst'].shape[0]
+
+    def PI_per_time():
+        return np.stack([thermo.CAPE_PI_vectorized(ref['sst'][i], ref['psl'][i], ref['p'],
+                                                   ref['T'][i], ref['r'][i]) for i in range(nt)])
+    def PI_all_times():
+        return thermo.CAPE_PI_vectorized(ref['sst'], ref['psl'], ref['p'], ref['T'], ref['r'])
+
+    passed = True
+    for (name, fx) in [('per time', PI_per_time), ('all times', PI_all_times)]:
+        PI, t_fx = _time_fx(fx, n_calls)
+        err = np.max(np.abs(PI - ref['PI']))
+        passed = passed and err <= tol
+        print('%-10s %7.2f ms per call (%d times), max abs diff from reference %.1e m/s' %
+              (name + ':', t_fx * 1e3, nt, err))
+    print('PASS' if passed else 'FAIL (tolerance %.1e m/s)' % tol)
+    return passed
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,52 @@
+"""
+Benchmark of the lookup of parcel temperatures in the entropy inversion
+tables, for one month of ERA5-sized input (37 pressure levels on a 0.25
+degree grid, for the BL and the saturated parcels), evaluated one level at
+a time. Compares the previous paths (RectBivariateSpline for the
+pseudoadiabatic table, interpn for the reversible table) with the
+uniform-grid lookup of entropy_lookup. The reversible table is made by
+repeating the pseudoadiabatic table along an rt axis, so only its timing
+is meaningful.
+
+Run from the root directory with:
+    python -m benchmarks.bench_entropy_lookup
+"""
+import time
+import numpy as np
+from scipy.interpolate import RectBivariateSpline, interpn
+
+from thermo import entropy_lookup
+
+def _time_levels(fx, p_lev, s, rt):
+    t_start = time.perf_counter()
+    out = [fx(np.full(s.shape, p), s, rt) for p in p_lev]
+    return (out, time.perf_counter() - t_start)
+
+def main(n_lev = 37, n_lat = 721, n_lon = 1440):
+    (p_look, s_look), T_lookup, _ = entropy_lookup.load_table(1)
+    rt_look = np.linspace(0, 0.04, 10)
+    T_lookup_rt = np.repeat(T_lookup[:, :, None], len(rt_look), axis = 2)
+
+    rng = np.random.default_rng(0)
+    p_lev = np.geomspace(100000, 100, n_lev)
+    s = rng.uniform(2700, 3400, (2, n_lat, n_lon))
+    rt = rng.uniform(0, 0.03, (2, n_lat, n_lon))
+    f_lookup = RectBivariateSpline(p_look, s_look, T_lookup, kx=1, ky=1)
+
+    cases = [('pseudoadiabatic', 'RectBivariateSpline',
+              lambda p, s, rt: f_lookup.ev(p, s),
+              lambda p, s, rt: entropy_lookup.interp_uniform((p_look, s_look), T_lookup, [p, s], clamp = True)),
+             ('reversible', 'interpn',
+              lambda p, s, rt: interpn((p_look, s_look, rt_look), T_lookup_rt, (p, s, rt), method = 'linear',
+                                       bounds_error = False, fill_value = np.nan),
+              lambda p, s, rt: entropy_lookup.interp_uniform((p_look, s_look, rt_look), T_lookup_rt, [p, s, rt], clamp = False))]
+    print('%d levels x %d x %d points x 2 parcels' % (n_lev, n_lat, n_lon))
+    for (name, name_ref, fx_ref, fx) in cases:
+        T_ref, t_ref = _time_levels(fx_ref, p_lev, s, rt)
+        T_uni, t_uni = _time_levels(fx, p_lev, s, rt)
+        err = max([np.max(np.abs(x - y), where = np.isfinite(x), initial = 0) for (x, y) in zip(T_ref, T_uni)])
+        print('%-16s %-20s %6.2f s, uniform lookup %6.2f s, speedup %4.1fx, max abs diff %.1e K' %
+              (name + ':', name_ref, t_ref, t_uni, t_ref / t_uni, err))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the evaluation of the random Fourier series F(t) of a track,
+in the right-hand side of the intensity model (Coupled_FAST.dydt) and in
+whole calls of Coupled_FAST.gen_track. Compares the previous evaluation, which
+materialized F at the output times of the track and interpolated it with
+scipy interp1d in each call to dydt, with the exact evaluation from the
+weights of the series (Fs_i). Uses the synthetic fields of bench_tracks, so
+no input data is required.
+
+Run from the root directory with:
+    python -m benchmarks.bench_fs
+"""
+import os
+import tempfile
+import time
+import numpy as np
+from scipy.interpolate import interp1d
+
+import namelist
+from benchmarks import bench_tracks
+from intensity import coupled_fast
+from track import bam_track
+
+class _Coupled_FAST_interp1d(coupled_fast.Coupled_FAST):
+    """ Coupled_FAST with the previous evaluation of F(t). """
+    def gen_synthetic_f_weights(self, rng):
+        Fs_w = super().gen_synthetic_f_weights(rng)
+        self.Fs_interp1d = interp1d(self.t_s, bam_track.eval_f_at(Fs_w, self.Fs_k, self.t_s), axis = 1)
+        return Fs_w
+
+    def Fs_i(self, t):
+        return self.Fs_interp1d(t)
+
+def _time_fx(fx, args):
+    t_start = time.perf_counter()
+    out = [fx(*x) for x in args]
+    return (out, (time.perf_counter() - t_start) / len(args))
+
+"""
+Times dydt at random times and states of a track.
+"""
+def _bench_dydt(fasts, rng, n_calls):
+    ts = rng.uniform(0, fasts['exact'].total_time, n_calls)
+    ys = np.stack([rng.uniform(300, 340, n_calls), rng.uniform(8, 25, n_calls),
+                   rng.uniform(5, 60, n_calls), rng.uniform(0.3, 0.9, n_calls)], axis = 1)
+    t_fx = {}
+    dydts = {}
+    for (name, fast) in fasts.items():
+        fast.Fs_w = fast.gen_synthetic_f_weights(np.random.default_rng(1))
+        (dydts[name], t_fx[name]) = _time_fx(fast.dydt, list(zip(ts, ys)))
+    # Differences relative to the largest tendency of each state variable.
+    dydt_ref = np.array(dydts['interp1d'])
+    err = np.max(np.abs(np.array(dydts['exact']) - dydt_ref) / np.max(np.abs(dydt_ref), axis = 0))
+    print('dydt:      interp1d %8.1f us per call, exact %8.1f us per call, speedup %4.2fx, max rel diff %.1e' %
+          (t_fx['interp1d'] * 1e6, t_fx['exact'] * 1e6, t_fx['interp1d'] / t_fx['exact'], err))
+
+"""
+Times whole tracks, from the same seeds and random streams.
+"""
+def _bench_gen_track(fasts, rng, n_storms):
+    seeds = list(zip(rng.uniform(300, 340, n_storms), rng.uniform(8, 25, n_storms),
+                     namelist.seed_v_init_ms + rng.standard_normal(n_storms), rng.uniform(0.3, 0.9, n_storms),
+                     np.random.SeedSequence(0).spawn(n_storms)))
+    t_fx = {}
+    res = {}
+    for (name, fast) in fasts.items():
+        args = [x[:-1] + (np.random.default_rng(x[-1]),) for x in seeds]
+        (res[name], t_fx[name]) = _time_fx(fast.gen_track, args)
+    n_rhs = np.mean([x.nfev for x in res['exact'] if x is not None])
+    # The tracks are chaotic, so compare the positions over the first day.
+    n = int(24 * 60 * 60 / namelist.output_interval_s) + 1
+    err = max([np.max(np.abs(x.y[0:2, :min(n, x.t.size, y.t.size)] - y.y[0:2, :min(n, x.t.size, y.t.size)]))
+               for (x, y) in zip(res['exact'], res['interp1d']) if x is not None])
+    print('gen_track: interp1d %8.1f ms per track, exact %8.1f ms per track, speedup %4.2fx, '
+          '%.0f dydt calls per track, max abs diff of the positions over a day %.1e deg' %
+          (t_fx['interp1d'] * 1e3, t_fx['exact'] * 1e3, t_fx['interp1d'] / t_fx['exact'], n_rhs, err))
+
+def main(n_calls = 20000, n_storms = 32):
+    rng = np.random.default_rng(0)
+    lon = np.arange(0, 360, 1.0)
+    lat = np.arange(-89, 90, 1.0)
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        namelist.src_directory = dir_tmp
+        namelist.output_directory = dir_tmp
+        os.makedirs('%s/intensity/data' % dir_tmp)
+        bench_tracks._write_geo('%s/intensity/data' % dir_tmp, lon, lat)
+        fn_wnd_stat = '%s/env_wnd.nc' % dir_tmp
+        bench_tracks._write_wnd_stat(fn_wnd_stat, lon, lat)
+        fasts = {'interp1d': bench_tracks._make_fast(fn_wnd_stat, lon, lat, _Coupled_FAST_interp1d),
+                 'exact': bench_tracks._make_fast(fn_wnd_stat, lon, lat)}
+        _bench_dydt(fasts, rng, n_calls)
+        _bench_gen_track(fasts, rng, n_storms)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark of the 2-D interpolation of the environmental fields, per time step
+of the intensity model. Compares one RectBivariateSpline per field (mat.interp2_fx),
+against one lookup of the stacked fields (mat.Interp2Stack).
+
+Uses synthetic fields on a 0.5 degree grid, so no input data is required.
+Run from the root directory with:
+    python -m benchmarks.bench_interp
+"""
+import time
+import numpy as np
+
+from util import mat
+
+# Fields evaluated at each time step: thermodynamic (vpot, chi, mld, strat),
+# wind statistics (4 means, 10 covariances), and land / bathymetry.
+N_FIELDS = {'thermo': 4, 'wind': 14, 'geo': 2}
+
+def _time_fx(fx, n_repeat):
+    t_start = time.perf_counter()
+    for i in range(n_repeat):
+        fx()
+    return (time.perf_counter() - t_start) / n_repeat
+
+def main(n_points = (1, 512), n_repeat = 200):
+    rng = np.random.default_rng(0)
+    lon = np.arange(250, 360.01, 0.5)
+    lat = np.arange(60, -0.01, -0.5)
+    Xs = {k: rng.random((n, lat.size, lon.size)) for (k, n) in N_FIELDS.items()}
+
+    f_splines = {k: [mat.interp2_fx(lon, lat, X[i]) for i in range(X.shape[0])] for (k, X) in Xs.items()}
+    f_stacks = {k: mat.Interp2Stack(lon, lat, X) for (k, X) in Xs.items()}
+
+    for n in n_points:
+        clon = rng.uniform(lon[0], lon[-1], n)
+        clat = rng.uniform(lat[-1], lat[0], n)
+
+        def ev_splines():
+            return [np.array([f.ev(clon, clat) for f in fs]) for fs in f_splines.values()]
+        def ev_stacks():
+            return [f.ev(clon, clat) for f in f_stacks.values()]
+
+        err = max([np.max(np.abs(x - y)) for (x, y) in zip(ev_splines(), ev_stacks())])
+        t_splines = _time_fx(ev_splines, n_repeat)
+        t_stacks = _time_fx(ev_stacks, n_repeat)
+        print('n = %4d: splines %8.1f us, stacked %8.1f us, speedup %5.1fx, max abs diff %.1e' %
+              (n, t_splines * 1e6, t_stacks * 1e6, t_splines / t_stacks, err))
+
+if __name__ == '__main__':
+    main()
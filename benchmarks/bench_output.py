@@ -0,0 +1,97 @@
+"""
+Check and benchmark of the output files, for each encoding profile and
+output format. Writes synthetic gridded fields (as the thermodynamic
+stage does, by creating the file and writing it region by region) and
+synthetic ragged tracks, reads them back with output.open_dataset, and
+compares them with what was written: exactly, or to float32 precision for
+the float32 profiles. Also checks that the 'default' profile writes
+contiguous netCDF variables, as xarray does without an encoding. Formats
+whose package is not installed (e.g. zarr) are reported and skipped.
+
+Run from the root directory with:
+    python -m benchmarks.bench_output
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import dask.array
+import netCDF4
+import numpy as np
+import xarray as xr
+
+import namelist
+from util import output
+
+def _make_datasets(n_time = 12, n_lat = 91, n_lon = 180, n_trk = 500, rng = None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    X = 50 + 10 * rng.standard_normal((n_time, n_lat, n_lon))
+    ds_grid = xr.Dataset(data_vars = dict(vmax = (['time', 'lat', 'lon'], X)),
+                         coords = dict(time = np.arange(n_time), lat = np.linspace(-90, 90, n_lat),
+                                       lon = np.linspace(0, 358, n_lon)))
+    row_size = rng.integers(10, 300, n_trk)
+    n_obs = int(np.sum(row_size))
+    ds_trk = xr.Dataset(data_vars = dict(lon_trks = (['obs'], rng.uniform(0, 360, n_obs)),
+                                         vmax_trks = (['obs'], rng.uniform(0, 80, n_obs)),
+                                         row_size = (['n_trk'], row_size),
+                                         tc_years = (['n_trk'], rng.integers(1980, 2020, n_trk))))
+    return (ds_grid, ds_trk)
+
+def _write_grid(ds_grid, fn):
+    fields = dask.array.zeros(ds_grid['vmax'].shape, chunks = (1,) + ds_grid['vmax'].shape[1:])
+    output.create_dataset(ds_grid.assign(vmax = (ds_grid['vmax'].dims, fields)), fn, 'thermo')
+    for i in range(ds_grid.sizes['time']):
+        output.write_region(ds_grid[['vmax']].isel(time = slice(i, i + 1)).drop_vars(['time', 'lat', 'lon']),
+                            fn, dict(time = slice(i, i + 1)))
+
+def _size(fn):
+    if os.path.isdir(fn):
+        return sum([os.path.getsize(os.path.join(d, x)) for (d, _, xs) in os.walk(fn) for x in xs])
+    return os.path.getsize(fn)
+
+def _max_rel_err(ds, ds_ref):
+    return max([float(np.max(np.abs(ds[var].values - ds_ref[var].values) / (np.abs(ds_ref[var].values) + 1e-12)))
+                for var in ds_ref.data_vars])
+
+def main():
+    (ds_grid, ds_trk) = _make_datasets()
+    passed = True
+    for fmt in ['netcdf', 'zarr']:
+        try:
+            output.check_format(fmt)
+        except ImportError as e:
+            print('%s: skipped (%s)' % (fmt, e))
+            continue
+        namelist.output_format = fmt
+        for profile in output.profiles:
+            if output.profiles[profile].get('compression') == 'zstd' and not netCDF4.__has_zstandard_support__:
+                print('%s %s: skipped (netCDF4 without zstd support)' % (fmt, profile))
+                continue
+            namelist.output_profile = profile
+            tol = 1e-6 if output.profiles[profile].get('dtype') == 'float32' else 0
+            dir_tmp = tempfile.mkdtemp()
+            try:
+                fn_grid = output.get_fn('%s/thermo.nc' % dir_tmp)
+                fn_trk = output.get_fn('%s/tracks.nc' % dir_tmp)
+                t_start = time.perf_counter()
+                _write_grid(ds_grid, fn_grid)
+                output.write_dataset(ds_trk, fn_trk, 'tracks')
+                t_write = time.perf_counter() - t_start
+                with output.open_dataset(fn_grid) as ds_g, output.open_dataset(fn_trk) as ds_t:
+                    err = max(_max_rel_err(ds_g, ds_grid), _max_rel_err(ds_t, ds_trk))
+                    ok = err <= tol and np.array_equal(ds_g['lat'].values, ds_grid['lat'].values)
+                if fmt == 'netcdf' and profile == 'default':
+                    with netCDF4.Dataset(fn_grid) as nc_g, netCDF4.Dataset(fn_trk) as nc_t:
+                        is_contiguous = nc_g['vmax'].chunking() == 'contiguous' and nc_t['lon_trks'].chunking() == 'contiguous'
+                    ok = ok and is_contiguous
+                passed = passed and ok
+                print('%-7s %-13s %7.2f MB, written in %5.2f s, max rel err %.1e %s' %
+                      (fmt, profile, (_size(fn_grid) + _size(fn_trk)) / 1e6, t_write, err, 'ok' if ok else 'FAIL'))
+            finally:
+                shutil.rmtree(dir_tmp)
+    print('PASS' if passed else 'FAIL')
+    return passed
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,127 @@
+"""
+Check and benchmark of the batched (RK4) track integrator, against the
+solve_ivp integrator, on fixed seeds in the North Atlantic. Uses synthetic
+wind statistics, thermodynamic fields, land mask and bathymetry, so no input
+data is required. Each seed is integrated with Coupled_FAST.gen_track and,
+with the same random stream, with Coupled_FAST.gen_tracks. A few seeds start
+below the dissipation threshold, so that they stop at the initial time. The
+seeds must be vented by both integrators or by neither, the lifetimes of
+the tracks must agree to within a day, and their positions, intensities and
+environmental winds must agree to within the tolerances below over the first
+days of the tracks. The tolerances are those of solve_ivp, with its default
+relative tolerance (1e-3), which the fixed step of RK4 is well within.
+
+Run from the root directory with:
+    python -m benchmarks.bench_tracks
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+
+import namelist
+from intensity import coupled_fast
+from track import env_wind
+from util import basins
+
+# Tolerances of the lifetimes (s), and of the positions (degrees),
+# intensities (m/s) and environmental winds (m/s) over the first n_days_tol
+# days of the tracks.
+tol_lifetime_s = 24 * 60 * 60
+n_days_tol = 5
+tol_pos = 1.0
+tol_v = 2.0
+tol_wnd = 2.0
+
+def _write_geo(dir_data, lon, lat):
+    (LON, LAT) = np.meshgrid(lon, lat)
+    land = ((LON > 275) & (LON < 290) & (LAT > 30)).astype(float)
+    xr.Dataset(dict(land = (['lat', 'lon'], land)),
+               coords = dict(lat = lat, lon = lon)).to_netcdf('%s/land.nc' % dir_data)
+    xr.Dataset(dict(bathymetry = (['lat', 'lon'], np.where(land == 1, 100., -4000.))),
+               coords = dict(lat = lat, lon = lon)).to_netcdf('%s/bathymetry.nc' % dir_data)
+
+def _write_wnd_stat(fn, lon, lat):
+    (LON, LAT) = np.meshgrid(lon, lat)
+    times = np.array([np.datetime64('2018-%02d-15' % m) for m in range(1, 13)])
+    means = [-10 * np.cos(np.deg2rad(LAT)) * np.sign(LAT - 25), 1 + 0 * LAT, -5 * np.cos(np.deg2rad(LAT)), 0 * LAT]
+    cov = np.array([[40, 5, 10, 2], [5, 30, 1, 8], [10, 1, 15, 2], [2, 8, 2, 12.]])
+    data_vars = {}
+    for (i, var) in enumerate(env_wind.wind_mean_vector_names()):
+        data_vars[var] = (['time', 'lat', 'lon'], np.repeat((means[i] + 2 * np.sin(np.deg2rad(LON)))[None], len(times), 0))
+    for (i, var_i) in enumerate(env_wind.wind_cov_matrix_names()):
+        for j in range(i + 1):
+            X = cov[i, j] * (1 + 0.3 * np.cos(np.deg2rad(LON + LAT)))
+            data_vars[var_i[j]] = (['time', 'lat', 'lon'], np.repeat(X[None], len(times), 0))
+    xr.Dataset(data_vars, coords = dict(time = times, lat = lat, lon = lon)).to_netcdf(fn)
+
+def _make_fast(fn_wnd_stat, lon, lat, cls = coupled_fast.Coupled_FAST):
+    b = basins.TC_Basin('NA')
+    fast = cls(fn_wnd_stat, b, np.datetime64('2018-08-15'),
+               namelist.output_interval_s, namelist.total_track_time_days * 24 * 60 * 60)
+    (LON, LAT) = np.meshgrid(lon, lat)
+    vpot = 80 * np.exp(-((LAT - 18) / 12) ** 2) + 10
+    chi = 0.3 + 0.01 * np.abs(LAT - 15)
+    fast.init_fields(lon, lat, chi, vpot, 30 + 0 * LAT, 1 + 0 * LAT)
+    fast.h_bl = namelist.atm_bl_depth['NA']
+    return fast
+
+def main(n_storms = 64):
+    rng = np.random.default_rng(0)
+    lon = np.arange(0, 360, 1.0)
+    lat = np.arange(-89, 90, 1.0)
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        namelist.src_directory = dir_tmp
+        namelist.output_directory = dir_tmp
+        os.makedirs('%s/intensity/data' % dir_tmp)
+        _write_geo('%s/intensity/data' % dir_tmp, lon, lat)
+        fn_wnd_stat = '%s/env_wnd.nc' % dir_tmp
+        _write_wnd_stat(fn_wnd_stat, lon, lat)
+        fast = _make_fast(fn_wnd_stat, lon, lat)
+
+        clon = rng.uniform(300, 340, n_storms)
+        clat = rng.uniform(8, 25, n_storms)
+        v = namelist.seed_v_init_ms + rng.standard_normal(n_storms)
+        v[0:4] = 3.5
+        m = rng.uniform(0.3, 0.9, n_storms)
+        h_bl = np.full(n_storms, fast.h_bl)
+        seed_seqs = np.random.SeedSequence(0).spawn(n_storms)
+
+        t_start = time.perf_counter()
+        res_ivp = [fast.gen_track(clon[i], clat[i], v[i], m[i], np.random.default_rng(seed_seqs[i]))
+                   for i in range(n_storms)]
+        t_ivp = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        res_rk4 = fast.gen_tracks(clon, clat, v, m, h_bl, [np.random.default_rng(x) for x in seed_seqs])
+        t_rk4 = time.perf_counter() - t_start
+
+    n_tol = int(n_days_tol * 24 * 60 * 60 / namelist.output_interval_s) + 1
+    passed = True
+    (err_pos, err_v, err_wnd) = (0, 0, 0)
+    for (i, (r_ivp, r_rk4)) in enumerate(zip(res_ivp, res_rk4)):
+        if r_ivp is None or r_rk4 is None:
+            if (r_ivp is None) != (r_rk4 is None):
+                print('seed %d: vented by only one of the integrators' % i)
+                passed = False
+            continue
+        if np.abs(r_ivp.t[-1] - r_rk4.t[-1]) > tol_lifetime_s:
+            print('seed %d: lifetime of %.1f days with solve_ivp, %.1f days with RK4' %
+                  (i, r_ivp.t[-1] / 86400, r_rk4.t[-1] / 86400))
+            passed = False
+        n = min(n_tol, r_ivp.t.size, r_rk4.t.size)
+        err_pos = np.maximum(err_pos, np.max(np.abs(r_ivp.y[0:2, :n] - r_rk4.y[0:2, :n])))
+        err_v = np.maximum(err_v, np.max(np.abs(r_ivp.y[2, :n] - r_rk4.y[2, :n])))
+        err_wnd = np.maximum(err_wnd, np.max(np.abs(r_ivp.env_wnds[:n] - r_rk4.env_wnds[:n])))
+    passed = passed and err_pos <= tol_pos and err_v <= tol_v and err_wnd <= tol_wnd
+    n_tracks = sum([x is not None for x in res_ivp])
+    print('%d seeds, %d tracks: solve_ivp %.2f s, RK4 %.2f s, speedup %.1fx' %
+          (n_storms, n_tracks, t_ivp, t_rk4, t_ivp / t_rk4))
+    print('max abs diff over the first %d days: position %.3f deg, intensity %.3f m/s, env. winds %.3f m/s' %
+          (n_days_tol, err_pos, err_v, err_wnd))
+    print('PASS' if passed else 'FAIL')
+    return passed
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,72 @@
+"""
+Benchmark of the input volume of the wind statistics stage, on one month of
+synthetic hourly ERA5-like winds (37 pressure levels, packed as int16 and
+chunked by time step and level). Compares reading the month at all levels,
+which grouping the winds by day did before the level selection, with
+calc_wnd_stat, which only reads the steering levels, one day at a time. The
+volume is the number of bytes read by the process (rchar in /proc/self/io).
+
+Run from the root directory with:
+    python -m benchmarks.bench_wnd_io
+"""
+import datetime
+import os
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+
+import namelist
+from track import env_wind
+from util import input
+
+def _read_bytes():
+    with open('/proc/self/io') as f:
+        return int([x for x in f.read().split('\n') if x.startswith('rchar')][0].split()[1])
+
+def _measure(fx):
+    (b_start, t_start) = (_read_bytes(), time.perf_counter())
+    fx()
+    return (_read_bytes() - b_start, time.perf_counter() - t_start)
+
+def _write_wnd(fn, var, times, lvls, lat, lon, rng):
+    shape = (len(times), len(lvls), len(lat), len(lon))
+    X = 10 * rng.standard_normal(shape, dtype = np.float32)
+    da = xr.DataArray(X, dims = ['time', 'level', 'latitude', 'longitude'], name = var,
+                      coords = dict(time = times, level = lvls, latitude = lat, longitude = lon))
+    da['level'].attrs['units'] = 'millibars'
+    encoding = {var: dict(dtype = 'int16', scale_factor = 0.002, add_offset = 0, _FillValue = -32767,
+                          chunksizes = (1, 1, len(lat), len(lon)))}
+    da.to_dataset().to_netcdf(fn, encoding = encoding)
+
+def main(n_lat = 31, n_lon = 60):
+    namelist.dataset_type = 'ERA5'
+    rng = np.random.default_rng(0)
+    times = np.arange(np.datetime64('2016-01-01'), np.datetime64('2016-02-01'), np.timedelta64(1, 'h'))
+    lvls = np.array([1, 2, 3, 5, 7, 10, 20, 30, 50, 70, 100, 125, 150, 175, 200, 225, 250, 300, 350,
+                     400, 450, 500, 550, 600, 650, 700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975, 1000])
+    lat = np.linspace(60, -60, n_lat)
+    lon = np.linspace(0, 360, n_lon, endpoint = False)
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        fns = ['%s/%s.nc' % (dir_tmp, var) for var in ['u', 'v']]
+        for (fn, var) in zip(fns, ['u', 'v']):
+            _write_wnd(fn, var, times, lvls, lat, lon, rng)
+        print('%d hourly steps x %d levels x %d x %d points, %.0f MB per variable on disk' %
+              (len(times), len(lvls), n_lat, n_lon, os.path.getsize(fns[0]) / 1e6))
+
+        def read_all_levels():
+            for (fn, var) in zip(fns, ['u', 'v']):
+                with xr.open_dataset(fn) as ds:
+                    ds[var].groupby('time.day').mean(dim = 'time')
+        def read_calc_wnd_stat():
+            with xr.open_dataset(fns[0]) as ds_ua, xr.open_dataset(fns[1]) as ds_va:
+                dts = input.get_datetimes(ds_ua)
+                env_wind.calc_wnd_stat(ds_ua['u'], ds_va['v'], datetime.datetime(2016, 1, 15), dts)
+
+        (b_all, t_all) = _measure(read_all_levels)
+        (b_sub, t_sub) = _measure(read_calc_wnd_stat)
+        print('all levels:     %7.1f MB read, %5.2f s' % (b_all / 1e6, t_all))
+        print('calc_wnd_stat:  %7.1f MB read, %5.2f s, %.1fx less input' % (b_sub / 1e6, t_sub, b_all / b_sub))
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,14 @@ Implementation of FAST (Emanuel, 2017) that is coupled to the track.
 
 import numpy as np
 from scipy.integrate import solve_ivp
-from scipy.interpolate import interp1d, RectBivariateSpline
+from scipy.optimize import OptimizeResult
 import warnings
 
 import namelist
 from intensity import geo
 from thermo import thermo
 from track import bam_track, env_wind
-from util import constants
+from util import constants, instrument, mat
 
 class Coupled_FAST(bam_track.BetaAdvectionTrack):
     def __init__(self, fn_wnd_stat, basin, dt_start, dt_s, total_time_s):
@@ -27,58 +27,34 @@ class Coupled_FAST(bam_track.BetaAdvectionTrack):
         self.beta = 1 - self.epsilon - self.kappa   # dimensionless parameter
 
         # Read in high-resolution bathymetry and land masks.
-        self.f_bath = geo.read_bathy(basin)
-        self.f_land = geo.read_land(basin)
+        self.f_geo = geo.read_land_bathy(basin)
         self.debug = False
 
     """ Return if over land (True) or ocean (False) """
     def _get_over_land(self, clon, clat):
         # 9/2/2020: Changed to 1 (and not a rounded number), since PI
         # is changed to be reduced by the area of the core over land.
-        return(self.f_land.ev(clon, clat).flatten()[0] == 1)
+        return(self.f_geo.ev(clon, clat)[0] == 1)
 
     """ Return the current bathymetry/topography at a position."""
     def _get_current_bathymetry(self, clon, clat):
-        return self.f_bath.ev(clon, clat).flatten()[0]
+        return self.f_geo.ev(clon, clat)[1]
 
     """ Return the current mixed layer depth at a position. """
     def _get_current_mixed(self, clon, clat):
-        return self.f_mld.ev(clon, clat).flatten()[0]
+        return self.f_fields.ev(clon, clat)[2]
 
     """ Return the current sub-mixed layer thermal stratification, (K / 100 m)
         at time t_s."""
     def _get_current_strat(self, clon, clat):
-        return self.f_strat.ev(clon, clat).flatten()[0]
+        return self.f_fields.ev(clon, clat)[3]
 
     """ Return the current potential intensity at a position"""
     def _get_current_vpot(self, clon, clat):
         if self._get_over_land(clon, clat):
             return(0)
         else:
-            return self.f_vpot.ev(clon, clat).flatten()[0]
-
-    """ Calculate, alpha (Equation 4), the ocean feedback parameter.
-    Ocean mixing is turned off when the mixed layer depth equals or
-    exceeds the local ocean depth (alpha = 1), or when the hurricane
-    is over land.
-    """
-    def _calc_alpha(self, clon, clat, v_trans, v):
-        h_m = self._get_current_mixed(clon, clat)
-        t_strat = self._get_current_strat(clon, clat)
-        v_pot = self._get_current_vpot(clon, clat)
-        u_T = np.linalg.norm(v_trans)
-        bathymetry = self._get_current_bathymetry(clon, clat)
-
-        # When over land, h_m = NaN, so we make alpha = 1.
-        if (bathymetry >= 0 or -h_m <= bathymetry or t_strat == 0):
-            return(1)
-        else:
-            z = self._calc_z(v, h_m, v_pot, u_T, t_strat)
-            try:
-                fac = np.exp(-np.clip(z, 0, 100))
-            except OverflowError:
-                fac = np.nan
-            return(1 - 0.87 * fac)
+            return self.f_fields.ev(clon, clat)[0]
 
     """ Calculate z (Equation 5) at a time t.
     v is the current intensity in m/s.
@@ -123,61 +99,12 @@ class Coupled_FAST(bam_track.BetaAdvectionTrack):
 
     """ Calculate the normalized mid-level saturation entropy deficit."""
     def _calc_chi(self, clon, clat):
-        return self.f_chi.ev(clon, clat).flatten()[0]
-
-    """ Calculate the ventilation. """
-    def _calc_venti(self, t, clon, clat, env_wnds):
-        chi = self._calc_chi(clon, clat)
-        return (self._calc_S(env_wnds) * chi)
-
-    """ Define the first ODE in the coupled set, Equation 2.
-    For now, use a drag coefficient, constant boundary layer depth,
-    constant thermodynamic efficiency (Equation 8), and constant
-    kappa (Equation 9). This means beta is constant (Equation 6).
-    However, alpha still varies (Equation 4, 5) with time, which means
-    gamma must vary with time as well (Equation 7).
-    Potential intensity (v_p) also varies with time.
-    """
-    def _dvdt(self, clon, clat, v, m, v_trans, env_wnds, t):
-        v_pot = self._get_current_vpot(clon, clat)
-        alpha = self._calc_alpha(clon, clat, v_trans, v)
-        gamma = self._calc_gamma(alpha)
-        beta = self._calc_beta()
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            dvdt = (0.5 * self.Ck / self.h_bl * (alpha * beta * (v_pot ** 2) * (m ** 3) -
-                                                      (1 - gamma * (m ** 3)) * (v ** 2)))
-        return dvdt if ~np.isnan(dvdt) else 0
+        return self.f_fields.ev(clon, clat)[1]
 
     """ Initializes m if no m has been given. Assumes an initial dvdt. """
     def _init_m(self, y, dvdt):
-        steering_coefs = self._calc_steering_coefs(y[2])
-        v_bam, env_wnds = self._step_bam_track(y[0], y[1], 0., steering_coefs)
-        v_pot = np.max([self._get_current_vpot(y[0], y[1]),
-                        self._get_current_vpot(y[0]-0.25, y[1]-0.25),
-                        self._get_current_vpot(y[0]-0.25, y[1]+0.25),
-                        self._get_current_vpot(y[0]+0.25, y[1]-0.25),
-                        self._get_current_vpot(y[0]+0.25, y[1]+0.25)])
-        alpha = self._calc_alpha(y[0], y[1], v_bam, y[2])
-        gamma = self._calc_gamma(alpha)
-        beta = self._calc_beta()
-
-        numer = 2 * self.h_bl / self.Ck * dvdt + (y[2] ** 2)
-        denom = alpha * beta * (v_pot ** 2) + gamma * (y[2] ** 2)
-        return(np.maximum(np.minimum(np.cbrt(numer / denom), 1), 0))
-
-    """ Define the second ODE in the coupled set, Equation 3.
-    For now, use a drag coefficient, constant boundary layer depth,
-    constant thermodynamic efficiency (Equatton 8), and constant
-    kappa (Equation 9).
-    However, environmental wind shear (S) still varies with time.
-    """
-    def _dmdt(self,  clon, clat, v, m, env_wnds, t):
-        venti = self._calc_venti(t, clon, clat, env_wnds)
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            dmdt = 0.5 * self.Ck / self.h_bl * ((1 - m) * v - venti * m)
-        return(dmdt)
+        Fs_t = self.Fs_i(0.)[np.newaxis, :]
+        return self._init_m_vectorized(np.expand_dims(y, 1), Fs_t, dvdt, self.h_bl)[0]
 
     """ Calculate the steering coefficients. """
     def _calc_steering_coefs(self, v):
@@ -194,17 +121,9 @@ class Coupled_FAST(bam_track.BetaAdvectionTrack):
     """ Time-derivative of the state vector, y.
     y[0] is longitude, y[1] is latitude, y[2] is v, and y[3] is m."""
     def dydt(self, t, y):
-        steering_coefs = self._calc_steering_coefs(y[2])
-        v_bam, env_wnds = self._step_bam_track(y[0], y[1], t, steering_coefs)
-        dLondt = v_bam[0] / constants.earth_R * 180. / np.pi / (np.cos(y[1] * np.pi / 180.))
-        dLatdt = v_bam[1] / constants.earth_R * 180. / np.pi
-
-        dvdt = self._dvdt(*y, v_bam, env_wnds, t)
-        dmdt = self._dmdt(*y, env_wnds, t)
-        if self.debug:
-            return(np.array([0, 0, dvdt, dmdt]))
-        else:
-            return(np.array([dLondt, dLatdt, dvdt, dmdt]))
+        Fs_t = self.Fs_i(t)[np.newaxis, :]
+        dydt, _ = self.dydt_vectorized(t, y[np.newaxis, :], Fs_t, self.h_bl)
+        return dydt[0]
 
     """
     lon is a 1-D array describing the longitude of the fields: [lon]
@@ -215,24 +134,35 @@ class Coupled_FAST(bam_track.BetaAdvectionTrack):
     strat is a 2-D matrix of sub-mixed layer thermal stratification in space: [lat, lon]
     """
     def init_fields(self, lon, lat, chi, vpot, mld, strat):
-        lon_b, lat_b, chi_b = self.basin.transform_global_field(lon, lat, chi)
-        self.f_chi = RectBivariateSpline(lon_b, lat_b, chi_b.T, kx=1, ky=1)
-        _, _, vpot_b = self.basin.transform_global_field(lon, lat, vpot)
-        self.f_vpot = RectBivariateSpline(lon_b, lat_b, vpot_b.T, kx=1, ky=1)
+        self.init_basin_fields(*self.basin_fields(lon, lat, chi, vpot, mld, strat))
+
+    """ Return the fields on the basin grid: (lon_b, lat_b, [vpot, chi, mld, strat]). """
+    def basin_fields(self, lon, lat, chi, vpot, mld, strat):
+        lon_b, lat_b, vpot_b = self.basin.transform_global_field(lon, lat, vpot)
+        _, _, chi_b = self.basin.transform_global_field(lon, lat, chi)
         _, _, mld_b = self.basin.transform_global_field(lon, lat, mld)
-        self.f_mld = RectBivariateSpline(lon_b, lat_b, mld_b.T, kx=1, ky=1)
         _, _, strat_b = self.basin.transform_global_field(lon, lat, strat)
-        self.f_strat = RectBivariateSpline(lon_b, lat_b, strat_b.T, kx=1, ky=1)
+        return (lon_b, lat_b, np.stack([vpot_b, chi_b, mld_b, strat_b]))
+
+    """ Initialize the fields from the basin grid (see basin_fields).
+        All fields are interpolated together: [vpot, chi, mld, strat]. """
+    def init_basin_fields(self, lon_b, lat_b, fields_b):
+        self.f_fields = mat.Interp2Stack(lon_b, lat_b, fields_b)
+
+    """ Return the potential intensity at positions, without masking land. """
+    def interp_vpot(self, clon, clat):
+        return self.f_fields.ev(clon, clat)[0]
 
     """ Generate a track with an initial position of (clon, clat),
-        an initial intensity of v, and initial inner core moisture m """
-    def gen_track(self, clon, clat, v, m = None):
-        # Make sure that tracks are sufficiently randomized.
-        bam_track.random_seed()
+        an initial intensity of v, and initial inner core moisture m.
+        The random weights of the track are drawn from the generator rng
+        (a new generator with fresh entropy if not given). """
+    def gen_track(self, clon, clat, v, m = None, rng = None):
+        if rng is None:
+            rng = np.random.default_rng()
 
         # Create the weights for the beta-advection model (across time).
-        self.Fs = self.gen_synthetic_f()
-        self.Fs_i = interp1d(self.t_s, self.Fs, axis = 1)
+        self.Fs_w = self.gen_synthetic_f_weights(rng)
 
         # If the ventilation index is above some threshold, do not integrate.
         S = self._calc_S(self._env_winds(clon, clat, 0))
@@ -264,4 +194,219 @@ class Coupled_FAST(bam_track.BetaAdvectionTrack):
         res = solve_ivp(self.dydt, (0, self.total_time), np.asarray([clon, clat, v, m_init]),
                         t_eval = np.linspace(0, self.total_time, self.total_steps),
                         events = tc_dissipates, max_step = 86400)
+
+        instrument.count('rhs_evaluations', res.nfev)
+
+        # Environmental winds are not part of the time-integrated state, so
+        # evaluate them at all of the output times of the track at once.
+        t_start = instrument.tic()
+        res.env_wnds = self._env_winds_vectorized(res.y[0], res.y[1], self.Fs_i(res.t).T)
+        instrument.toc('env_winds', t_start)
+        return res
+
+    """ Vectorized versions of the methods above, used by the integrators.
+    Positions (clon, clat) and intensities (v, m) are 1-D arrays with one entry
+    per storm, and h_bl is the boundary layer depth of each storm.
+    """
+
+    """ Interpolate the fields used by FAST at the positions (clon, clat).
+        The potential intensity is zero over land. """
+    def _interp_fields_vectorized(self, clon, clat):
+        vpot, chi, mld, strat = self.f_fields.ev(clon, clat)
+        land, bathymetry = self.f_geo.ev(clon, clat)
+        vpot[land == 1] = 0
+        return dict(vpot = vpot, chi = chi, mld = mld, strat = strat,
+                    bathymetry = bathymetry)
+
+    """ Calculate, alpha (Equation 4), the ocean feedback parameter.
+    Ocean mixing is turned off when the mixed layer depth equals or
+    exceeds the local ocean depth (alpha = 1), or when the hurricane
+    is over land.
+    """
+    def _calc_alpha_vectorized(self, fields, v_trans, v):
+        h_m = fields['mld']
+        t_strat = fields['strat']
+        u_T = np.linalg.norm(v_trans, axis = 1)
+        bathymetry = fields['bathymetry']
+
+        z = self._calc_z(v, h_m, fields['vpot'], u_T, t_strat)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            alpha = 1 - 0.87 * np.exp(-np.clip(z, 0, 100))
+
+        # When over land, h_m = NaN, so we make alpha = 1.
+        alpha[(bathymetry >= 0) | (-h_m <= bathymetry) | (t_strat == 0)] = 1
+        return alpha
+
+    def _calc_S_vectorized(self, env_wnds):
+        u250, v250, u850, v850 = env_wind.deep_layer_winds(env_wnds)
+        return np.sqrt(np.power(u250 - u850, 2) + np.power(v250 - v850, 2))
+
+    def _calc_steering_coefs_vectorized(self, v):
+        assert len(namelist.steering_coefs) == len(namelist.steering_levels)
+        if namelist.coupled_track:
+            alpha_fx = np.outer(v*1.94384, namelist.m_alpha) + np.array(namelist.y_alpha)
+            steering_coefs = np.maximum(np.minimum(alpha_fx, namelist.alpha_max), namelist.alpha_min)
+            steering_coefs[np.any(np.isnan(steering_coefs), axis = 1)] = namelist.y_alpha
+        else:
+            steering_coefs = np.tile(namelist.steering_coefs, (np.size(v), 1))
+        return steering_coefs
+
+    """ Define the first ODE in the coupled set, Equation 2.
+    For now, use a drag coefficient, constant boundary layer depth,
+    constant thermodynamic efficiency (Equation 8), and constant
+    kappa (Equation 9). This means beta is constant (Equation 6).
+    However, alpha still varies (Equation 4, 5) with time, which means
+    gamma must vary with time as well (Equation 7).
+    Potential intensity (v_p) also varies with time.
+    """
+    def _dvdt_vectorized(self, fields, v, m, v_trans, h_bl):
+        v_pot = fields['vpot']
+        alpha = self._calc_alpha_vectorized(fields, v_trans, v)
+        gamma = self._calc_gamma(alpha)
+        beta = self._calc_beta()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            dvdt = (0.5 * self.Ck / h_bl * (alpha * beta * (v_pot ** 2) * (m ** 3) -
+                                            (1 - gamma * (m ** 3)) * (v ** 2)))
+        return np.nan_to_num(dvdt, nan = 0)
+
+    """ Define the second ODE in the coupled set, Equation 3.
+    For now, use a drag coefficient, constant boundary layer depth,
+    constant thermodynamic efficiency (Equatton 8), and constant
+    kappa (Equation 9).
+    However, environmental wind shear (S) still varies with time.
+    """
+    def _dmdt_vectorized(self, fields, v, m, env_wnds, h_bl):
+        venti = self._calc_S_vectorized(env_wnds) * fields['chi']
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            dmdt = 0.5 * self.Ck / h_bl * ((1 - m) * v - venti * m)
+        return dmdt
+
+    def _init_m_vectorized(self, y, Fs_t, dvdt, h_bl):
+        clon, clat, v = y
+        steering_coefs = self._calc_steering_coefs_vectorized(v)
+        v_bam, _ = self._step_bam_track_vectorized(clon, clat, Fs_t, steering_coefs)
+        v_pot = np.max([self._interp_fields_vectorized(clon + dlon, clat + dlat)['vpot']
+                        for (dlon, dlat) in [(0, 0), (-0.25, -0.25), (-0.25, 0.25),
+                                             (0.25, -0.25), (0.25, 0.25)]], axis = 0)
+        alpha = self._calc_alpha_vectorized(self._interp_fields_vectorized(clon, clat), v_bam, v)
+        gamma = self._calc_gamma(alpha)
+        beta = self._calc_beta()
+
+        numer = 2 * h_bl / self.Ck * dvdt + (v ** 2)
+        denom = alpha * beta * (v_pot ** 2) + gamma * (v ** 2)
+        return(np.maximum(np.minimum(np.cbrt(numer / denom), 1), 0))
+
+    """ Time-derivative of the state of many storms, y (n, 4), given the
+    weights of the Fourier series of each storm at time t, Fs_t (n, nWLvl).
+    Returns the time-derivative and the environmental winds of each storm.
+    """
+    def dydt_vectorized(self, t, y, Fs_t, h_bl):
+        clon, clat, v, m = y.T
+        steering_coefs = self._calc_steering_coefs_vectorized(v)
+        v_bam, env_wnds = self._step_bam_track_vectorized(clon, clat, Fs_t, steering_coefs)
+
+        dydt = np.zeros(y.shape)
+        if not self.debug:
+            dydt[:, 0] = v_bam[:, 0] / constants.earth_R * 180. / np.pi / (np.cos(clat * np.pi / 180.))
+            dydt[:, 1] = v_bam[:, 1] / constants.earth_R * 180. / np.pi
+        fields = self._interp_fields_vectorized(clon, clat)
+        dydt[:, 2] = self._dvdt_vectorized(fields, v, m, v_bam, h_bl)
+        dydt[:, 3] = self._dmdt_vectorized(fields, v, m, env_wnds, h_bl)
+        return(dydt, env_wnds)
+
+    """ Vectorized version of tc_dissipates in gen_track. A storm stops
+        being integrated once this reaches zero. """
+    def _tc_dissipates_vectorized(self, y):
+        is_active = self.basin.in_basin(y[:, 0], y[:, 1], 1) & (np.abs(y[:, 1]) > 2)
+        return np.where(is_active, np.maximum(0, y[:, 2] - 4), 0)
+
+    """ Generate tracks for many storms at once, with initial positions of
+    (clon, clat), initial intensities of v, and initial inner core moistures m.
+    All storms are advanced together with a fixed-step, fourth-order Runge-Kutta
+    scheme, and each storm is stopped once it dissipates (see gen_track).
+    Returns a list with one result per storm, which is None if the ventilation
+    index is above the threshold. Otherwise, like solve_ivp, the result has
+    the output times (t) and states (y), and also has the environmental winds
+    at the output times (env_wnds). The random weights of each storm are
+    drawn from its own generator in rngs (new generators if not given).
+    """
+    def gen_tracks(self, clon, clat, v, m = None, h_bl = None, rngs = None):
+        clon = np.atleast_1d(clon).astype(float)
+        clat = np.atleast_1d(clat).astype(float)
+        v = np.atleast_1d(v).astype(float)
+        n_storms = clon.size
+        h_bl = np.full(n_storms, self.h_bl if h_bl is None else h_bl, dtype = float)
+
+        if rngs is None:
+            rngs = [np.random.default_rng() for i in range(n_storms)]
+
+        # Create the weights for the beta-advection model (across time).
+        Fs_w = self.gen_synthetic_f_weights_vectorized(rngs)
+
+        # If the ventilation index is above some threshold, do not integrate.
+        Fs_t = self._eval_Fs_vectorized(Fs_w, 0)
+        env_wnds_init = self._env_winds_vectorized(clon, clat, Fs_t)
+        S = self._calc_S_vectorized(env_wnds_init)
+        fields = self._interp_fields_vectorized(clon, clat)
+        vpot = fields['vpot']
+        chi = fields['chi']
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            is_vented = (vpot > 0) & (S * chi / vpot >= 1)
+
+        if m is None:
+            # This means no m has been provided. Initialize with dvdt = 0.
+            m_init = self._init_m_vectorized((clon, clat, v), Fs_t, 0, h_bl)
+        else:
+            m_init = np.full(n_storms, m, dtype = float)
+
+        # Integrate with a time step that evenly divides the output interval.
+        n_sub = int(np.ceil(self.dt_track / namelist.batched_max_step_s))
+        dt = self.dt_track / n_sub
+        y = np.stack([clon, clat, v, m_init], axis = 1)
+        y_out = np.full((n_storms, self.total_steps, 4), np.nan)
+        wnds_out = np.full((n_storms, self.total_steps, self.nWLvl), np.nan)
+        n_out = np.zeros(n_storms, dtype = int)
+        is_alive = ~is_vented
+        y_out[is_alive, 0, :] = y[is_alive]
+        n_out[is_alive] = 1
+        # Environmental winds at the initial time, also of the storms that
+        # dissipate at once (as in gen_track).
+        wnds_out[is_alive, 0, :] = env_wnds_init[is_alive]
+        is_alive &= self._tc_dissipates_vectorized(y) > 0
+        for t_idx in range(1, self.total_steps):
+            if not np.any(is_alive):
+                break
+            for s_idx in range(n_sub):
+                idxs = np.nonzero(is_alive)[0]
+                if idxs.size == 0:
+                    break
+                t = ((t_idx - 1) * n_sub + s_idx) * dt
+                f = lambda ts, ys: self.dydt_vectorized(ts, ys, self._eval_Fs_vectorized(Fs_w, ts)[idxs], h_bl[idxs])
+                k1, env_wnds = f(t, y[idxs])
+                k2, _ = f(t + dt / 2, y[idxs] + dt / 2 * k1)
+                k3, _ = f(t + dt / 2, y[idxs] + dt / 2 * k2)
+                k4, _ = f(t + dt, y[idxs] + dt * k3)
+                if s_idx == 0:
+                    # The first stage is evaluated at the previous output time.
+                    wnds_out[idxs, t_idx - 1, :] = env_wnds
+                y[idxs] += dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+                instrument.count('rhs_evaluations', 4 * idxs.size)
+                is_alive[idxs] = self._tc_dissipates_vectorized(y[idxs]) > 0
+            y_out[is_alive, t_idx, :] = y[is_alive]
+            n_out[is_alive] = t_idx + 1
+
+        # Environmental winds at the final output time.
+        if np.any(is_alive):
+            Fs_t = self._eval_Fs_vectorized(Fs_w, self.total_time)[is_alive]
+            steering_coefs = self._calc_steering_coefs_vectorized(y[is_alive, 2])
+            _, wnds_out[is_alive, -1, :] = self._step_bam_track_vectorized(y[is_alive, 0], y[is_alive, 1],
+                                                                           Fs_t, steering_coefs)
+
+        res = [None] * n_storms
+        for i in np.nonzero(~is_vented)[0]:
+            res[i] = OptimizeResult(t = self.t_s[:n_out[i]], y = y_out[i, :n_out[i], :].T,
+                                    env_wnds = wnds_out[i, :n_out[i], :])
         return res
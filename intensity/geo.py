@@ -1,34 +1,49 @@
+import os
 import numpy as np
-import xarray as xr
-
-from scipy.interpolate import RectBivariateSpline as interp2d
 
 import namelist
+from util import mat, static_fields
+
+_f_geo = {}
+
+# Returns the name of a file in the intensity data directory.
+def _get_fn(fn):
+    return('%s/intensity/data/%s' % (namelist.src_directory, fn))
+
+# Reads in a global field from a file in the intensity data directory,
+# through the store of static fields.
+def _read_field(fn, var):
+    fields = static_fields.get_fields(fn.replace('.nc', ''), _get_fn(fn), ['lon', 'lat', var])
+    return(fields['lon'], fields['lat'], fields[var])
+
+# Interpolation of fields on different grids, evaluated together as one
+# stack: each field is interpolated on its own grid.
+class _Interp2Fields:
+    def __init__(self, fs):
+        self.fs = fs
+
+    def ev(self, clon, clat):
+        return(np.concatenate([f.ev(clon, clat) for f in self.fs]))
 
-# Reads in bathymetry file.
-def read_bathy(basin):
-    fdir = namelist.src_directory
-    fn = '%s/intensity/data/bathymetry.nc' % fdir
-    ds = xr.open_dataset(fn)
-    lon = ds['lon'].data
-    lat = ds['lat'].data
-    bathy = ds['bathymetry'].data
-    ds.close()
-
-    lon_b, lat_b, bathy_b = basin.transform_global_field(lon, lat, bathy)
-    f_bath = interp2d(lon_b, lat_b, bathy_b.T, kx=1, ky=1)
-    return(f_bath)
-
-# Reads in land mask file.
-def read_land(basin):
-    fdir = namelist.src_directory
-    fn = '%s/intensity/data/land.nc' % fdir
-    ds = xr.open_dataset(fn)
-    lon = ds['lon'].data
-    lat = ds['lat'].data
-    land = ds['land'].data
-    ds.close()
+# Reads in the land mask and bathymetry files, and returns one interpolation
+# object for both fields: [land, bathymetry]. Each field is interpolated on
+# its own grid, as when they were read separately, and in one lookup if the
+# grids are the same. The interpolation object is created once per basin in
+# each process, and again if either file is modified.
+def read_land_bathy(basin):
+    fns = [_get_fn('land.nc'), _get_fn('bathymetry.nc')]
+    key = (basin.basin_id, tuple(basin.basin_bounds), tuple([(fn, os.path.getmtime(fn)) for fn in fns]))
+    if key in _f_geo:
+        return(_f_geo[key])
 
+    lon, lat, land = _read_field('land.nc', 'land')
+    lon_bath, lat_bath, bathy = _read_field('bathymetry.nc', 'bathymetry')
     lon_b, lat_b, land_b = basin.transform_global_field(lon, lat, land)
-    f_land = interp2d(lon_b, lat_b, land_b.T, kx=1, ky=1)
-    return(f_land)
+    lon_bath_b, lat_bath_b, bathy_b = basin.transform_global_field(lon_bath, lat_bath, bathy)
+    if np.array_equal(lon, lon_bath) and np.array_equal(lat, lat_bath):
+        f_geo = mat.Interp2Stack(lon_b, lat_b, np.stack([land_b, bathy_b]))
+    else:
+        f_geo = _Interp2Fields([mat.Interp2Stack(lon_b, lat_b, land_b[np.newaxis]),
+                                mat.Interp2Stack(lon_bath_b, lat_bath_b, bathy_b[np.newaxis])])
+    _f_geo[key] = f_geo
+    return(f_geo)
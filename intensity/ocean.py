@@ -3,14 +3,26 @@ import os
 import xarray as xr
 from datetime import datetime
 
+from util import static_fields
+
+"""
+Returns the names of the files of the mixed layer depth and the
+sub-mixed layer thermal stratification climatologies.
+"""
+def get_fn_mld():
+    return '%s/data/mld_climatology.nc' % os.path.dirname(os.path.abspath(__file__))
+
+def get_fn_strat():
+    return '%s/data/strat_climatology.nc' % os.path.dirname(os.path.abspath(__file__))
+
 """
 Returns climatological mixed layer depth for a given year.
 Returns (lat, lon, t) and mixed layer depth (m),
 with dimensions (lat, lon, t). dt_months is type datetimes.
 """
 def mld_climatology(year, basin):
-    f_dir = os.path.dirname(os.path.abspath(__file__))
-    ds = xr.open_dataset('%s/data/mld_climatology.nc' % f_dir)
+    ds = static_fields.get_fields('mld_climatology', get_fn_mld(),
+                                  ['lon', 'lat', 'month', 'mixed_layer'])
     mld = np.asarray(ds['mixed_layer'])
     mld = np.concatenate((mld, np.expand_dims(mld[:, :, 0], 2)), axis=2)
     lon = np.asarray(ds['lon'])
@@ -27,7 +39,6 @@ def mld_climatology(year, basin):
     dt_months[12] = datetime(year + 1, 1, 15) # wrap around
     mld_b[12] = np.copy(mld_b[0])
     mld_clim = np.dstack(mld_b)
-    ds.close()
     da_mld = xr.DataArray(data = mld_clim, dims = ['lat', 'lon', 'time'],
                           coords = dict(lon = ("lon", lon_b), lat = ("lat", lat_b),
                                         time = ("time", np.asarray(dt_months))))    
@@ -39,8 +50,8 @@ for a given year. Returns (lat, lon, t) and thermal stratification
 (K/100m), with dimensions (lat, lon, t). dt_months is type datetimes.
 """
 def strat_climatology(year, basin):
-    f_dir = os.path.dirname(os.path.abspath(__file__))
-    ds = xr.open_dataset('%s/data/strat_climatology.nc' % f_dir)
+    ds = static_fields.get_fields('strat_climatology', get_fn_strat(),
+                                  ['lon', 'lat', 'month', 'strat'])
     strat = np.asarray(ds['strat'])
     strat = np.concatenate((strat, np.expand_dims(strat[:, :, 0], 2)), axis=2)
     lon = np.asarray(ds['lon'])
@@ -57,7 +68,6 @@ def strat_climatology(year, basin):
     dt_months[12] = datetime(year + 1, 1, 15) # wrap around
     strat_b[12] = np.copy(strat_b[0])
     strat_clim = np.dstack(strat_b)
-    ds.close()
     da_strat = xr.DataArray(data = strat_clim, dims = ['lat', 'lon', 'time'],
                           coords = dict(lon = ("lon", lon_b), lat = ("lat", lat_b),
                                         time = ("time", np.asarray(dt_months))))        
@@ -33,6 +33,16 @@ var_keys = {'ERA5': {'sst': 'sst', 'mslp': 'sp', 'temp': 't',
 
 ########################### Parallelism Parameters ##########################
 n_procs = 16              # number of processes to use in dask
+n_tracks_per_task = 10    # number of tracks in each batch of storms run by the process pool
+thermo_tile_gb = 1.0      # approximate memory of each process computing a tile of the thermodynamic fields, GB
+instrument = False        # time and count the stages of each year; saved as a JSON file next to the tracks
+
+############################ Random Number Parameters #######################
+# Seed (entropy) of the random number streams. The streams are arranged as
+# run -> simulation index -> year -> storm, so that any year can be recomputed
+# on its own. If None, new entropy is drawn for each run, and saved in the
+# attributes of the track file (rng_entropy).
+rng_seed = None
 
 ############################ TC Risk Parameters #############################
 """
@@ -48,6 +58,21 @@ These parameters configure the output.
 """
 output_interval_s = 3600              # output interval of tracks, seconds (does not change time integration)
 total_track_time_days = 15            # total time to integrate tracks, days
+tracks_layout = 'dense'               # 'dense' (n_trk, time) arrays padded with NaN, or 'ragged' (CF contiguous ragged array with a row_size per track)
+tracks_dtype = 'float64'              # 'float64' or 'float32' storage of the track variables
+output_profile = 'default'            # encoding of the tracks, thermodynamic and wind files: 'default' (contiguous, uncompressed), 'zlib', 'zlib_float32', 'zstd' or 'zstd_float32' (see util/output.py)
+output_format = 'netcdf'              # 'netcdf' or 'zarr' (requires the zarr package)
+month_cache_dir = None                # directory of the cache of monthly fields in each basin (default: output_directory/month_cache)
+month_cache_max_gb = 20               # maximum size of the cache of monthly fields, GB (0 disables the cache)
+
+"""
+These parameters configure the time integration of the tracks.
+"""
+track_integrator = 'batched'          # 'batched' (seeds integrated together) or 'solve_ivp' (one seed at a time)
+batched_max_step_s = 3600             # maximum time step of the batched (RK4) integrator, seconds
+n_storms_batch = 512                  # maximum number of seeds integrated together by the batched integrator
+wnd_stat_daily_mean = True            # average sub-daily winds to daily means before computing the monthly wind statistics
+wnd_cov_mode = 'factor'               # 'factor' (Cholesky factor of the wind covariance precomputed at each grid point) or 'cov' (factorized at each step)
 
 ########################### Basin & Poisson Parameters #######################
 # Basin to run the downscaling for
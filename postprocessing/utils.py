@@ -7,6 +7,8 @@ import random
 import xarray as xr
 import re
 
+from util import output
+
 def haversine(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance between two points 
@@ -84,6 +86,44 @@ def import_storm_data(basin, pathSTORM):
 
 
 
+def read_TCrisks_tracks(ds, variables):
+    """
+    Read the points of the tracks from a TCrisks dataset, in either the dense
+    layout ((n_trk, time) arrays padded with NaN) or the contiguous ragged
+    layout (points stored along "obs", with the number of points of each track
+    in "row_size"). Ragged files are read as they are, without densifying.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The TCrisks dataset.
+    variables : list of str
+        The track variables to read (e.g. 'lon_trks').
+
+    Returns
+    -------
+    tuple
+        A tuple containing:
+        - The number of points of each track.
+        - A dictionary of the variables, and of 'time' (the time since
+          genesis), at all of the points of all of the tracks, track by track.
+    """
+
+    if 'row_size' in ds:
+        row_size = ds['row_size'].values
+        points = {var: ds[var].values for var in variables + ['time']}
+    else:
+        # A track ends at its last valid point.
+        lon_trks = ds['lon_trks'].values
+        row_size = lon_trks.shape[1] - np.argmax(~np.isnan(lon_trks[:, ::-1]), axis=1)
+        row_size[np.all(np.isnan(lon_trks), axis=1)] = 0
+        is_point = np.arange(lon_trks.shape[1]) < row_size[:, None]
+        points = {var: ds[var].values[is_point] for var in variables}
+        points['time'] = np.broadcast_to(ds['time'].values, lon_trks.shape)[is_point]
+
+    return row_size, points
+
+
 def import_TCrisks_data(file_path,basin, pathTCrisks, number_of_simulations):
     """
     Import and process TCrisks data from a NetCDF file (only specific variables) and put them in the same format as STORM output data.
@@ -106,43 +146,27 @@ def import_TCrisks_data(file_path,basin, pathTCrisks, number_of_simulations):
 
     for sim_index in range (number_of_simulations):
 
-        # Construct the file path dynamically
-        file_name = file_path + f"{sim_index:1d}.nc"
+        # Construct the file path dynamically, in the format found on disk
+        file_name = output.find_fn(pathTCrisks + file_path + f"{sim_index:1d}.nc")
 
-        # Open the NetCDF file and load only the required variables
-        ds = xr.open_dataset(pathTCrisks+file_name, use_cftime=True)
+        # Open the NetCDF (or Zarr) file and load only the required variables
+        ds = output.open_dataset(file_name, use_cftime=True)
 
         # Extract relevant variables
         tc_years = ds['tc_years'].values
-        lon_trks = ds['lon_trks'].values
-        lat_trks = ds['lat_trks'].values
-        vmax_trks = ds['vmax_trks'].values
-        time_trks=ds['time'].values
         tc_month = ds['tc_month'].values
+        row_size, points = read_TCrisks_tracks(ds, ['lon_trks', 'lat_trks', 'vmax_trks'])
 
-        # Flatten and build the output table
+        # Build the output table, one row per point of each track
         extracted_data = {
-            'tc_years': [],
-            'sid': [],
-            'lon': [],
-            'lat': [],
-            'vmax': [],
-            'time': [],
-            'month': []
+            'tc_years': np.repeat(tc_years, row_size),
+            'sid': np.repeat([f"{sim_index}_{i}" for i in range(len(tc_years))], row_size),
+            'lon': points['lon_trks'],
+            'lat': points['lat_trks'],
+            'vmax': points['vmax_trks']*0.88, # convert to 10-min sustained wind to compare with STORM
+            'time': points['time'],
+            'month': np.repeat(tc_month, row_size)
         }
-
-        for i in range(len(tc_years)):
-            for j in range(len(lon_trks[i])):
-                if np.isnan(lon_trks[i][j]) and np.all(np.isnan(lon_trks[i][j:])):
-                    break 
-
-                extracted_data['tc_years'].append(tc_years[i])
-                extracted_data['sid'].append(f"{sim_index}_{i}")
-                extracted_data['lon'].append(lon_trks[i][j])
-                extracted_data['lat'].append(lat_trks[i][j])
-                extracted_data['vmax'].append(vmax_trks[i][j]*0.88) # convert to 10-min sustained wind to compare with STORM
-                extracted_data['time'].append(time_trks[j])
-                extracted_data['month'].append(tc_month[i])
         # Convert to DataFrame
         df = pd.DataFrame(extracted_data)
 
@@ -5,14 +5,12 @@ import shutil
 import importlib
 import sys
 import numpy as np
-import random
 from scripts import generate_land_masks
 from util import compute
 
-def Poisson(mu):
+def Poisson(mu, rng):
     """Sample the number of TC formations in a given year for the basin."""
-    poisson_samples = np.random.poisson(mu, 10000)
-    return int(random.choice(poisson_samples))
+    return int(rng.poisson(mu))
 
 if __name__ == '__main__':
     sim_index = int(sys.argv[1])
@@ -26,8 +24,15 @@ if __name__ == '__main__':
     mu = namelist.mu_tc_per_year
 
     # === Step 2: Sample the number of TCs for each year ===
+    # The random stream of the simulation is below the stream of the run.
+    # A restarted simulation resumes from the stream that it saved.
+    seed_seq = compute.resume_seed_seq(namelist.basin_name, sim_index, namelist)
+    if seed_seq is None:
+        seed_seq = compute.get_sim_seed_seq(sim_index, namelist)
+    print('rng_entropy =', seed_seq.entropy)
+    rng = np.random.default_rng(seed_seq)
     n_years = namelist.end_year - namelist.start_year + 1
-    n_TC_per_year = [Poisson(mu) for _ in range(n_years)]
+    n_TC_per_year = [Poisson(mu, rng) for _ in range(n_years)]
     print('n_TC_per_year =', n_TC_per_year)
 
     # === Step 3: Set up output directory and copy namelist ===
@@ -42,4 +47,4 @@ if __name__ == '__main__':
     compute.compute_downscaling_inputs()
 
     print('Running downscaling for basin', basin_name)
-    compute.run_downscaling(basin_name, n_TC_per_year, sim_index, namelist)
+    compute.run_downscaling(basin_name, n_TC_per_year, sim_index, namelist, seed_seq)
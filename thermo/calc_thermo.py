@@ -4,80 +4,180 @@
 @author: jzlin@mit.edu
 """
 
-import dask
+import concurrent.futures
+import dask.array
 import datetime
+import functools
 import os
 import namelist
 import numpy as np
 import xarray as xr
 
-from util import input, mat
+from util import input, mat, output, util
 from thermo import thermo
 
+# Approximate memory used to compute a tile of the thermodynamic fields,
+# per level, grid point and time of the tile, in bytes.
+n_bytes_tile_point = 300
+
 def get_fn_thermo():
     fn_th = '%s/thermo_%s_%d%02d_%d%02d.nc' % (namelist.output_directory, namelist.exp_prefix,
                                                namelist.start_year, namelist.start_month,
                                                namelist.end_year, namelist.end_month)
-    return(fn_th)
+    return(output.get_fn(fn_th))
+
+"""
+Opens the thermodynamic file. The file is opened once in each process,
+and reopened only if it has been modified.
+"""
+@functools.lru_cache(maxsize = 1)
+def _open_thermo(fn_th, mtime):
+    return output.open_dataset(fn_th)
 
+"""
+Reads time slice "idx" of the thermodynamic variables (vmax, chi, rh_mid),
+with increasing latitude. The last two slices are cached, so that months
+that share a bracketing slice read it once.
+"""
+@functools.lru_cache(maxsize = 2)
+def _read_thermo_slice(fn_th, mtime, idx):
+    ds = _open_thermo(fn_th, mtime)
+    is_lat_dec = ds['lat'].data[0] > ds['lat'].data[-1]
+    fields = []
+    for var in ['vmax', 'chi', 'rh_mid']:
+        x = ds[var][idx].data
+        fields.append(x[::-1, :] if is_lat_dec else x)
+    return fields
+
+@functools.lru_cache(maxsize = 2)
+def _read_thermo_month(fn_th, mtime, dt):
+    ds = _open_thermo(fn_th, mtime)
+    lon = ds['lon'].data
+    lat = ds['lat'].data
+    if lat[0] > lat[-1]:
+        lat = lat[::-1]
+
+    # Interpolate linearly in time between the slices that bracket dt.
+    times = ds['time'].values
+    t = input.convert_from_datetime(ds, [dt])[0]
+    idx = np.searchsorted(times, t, side = 'right') - 1
+    if idx >= 0 and times[idx] == t:
+        fields = [x.copy() for x in _read_thermo_slice(fn_th, mtime, idx)]
+    elif idx >= 0 and idx < len(times) - 1:
+        w = (t - times[idx]) / (times[idx + 1] - times[idx])
+        fields_s = _read_thermo_slice(fn_th, mtime, idx)
+        fields_e = _read_thermo_slice(fn_th, mtime, idx + 1)
+        fields = [(1 - w) * x_s + w * x_e for (x_s, x_e) in zip(fields_s, fields_e)]
+    else:
+        fields = [np.full((len(lat), len(lon)), np.nan) for i in range(3)]
+    for x in fields:
+        x.setflags(write = False)
+    return (lon, lat, *fields)
 
-def compute_thermo(dt_start, dt_end):
-    ds_sst = input.load_sst(dt_start, dt_end).load()
-    ds_psl = input.load_mslp(dt_start, dt_end).load()
-    ds_ta = input.load_temp(dt_start, dt_end).load()
-    ds_hus = input.load_sp_hum(dt_start, dt_end).load()
+"""
+Returns the thermodynamic fields at the datetime dt: (lon, lat, vmax, chi,
+rh_mid), with increasing latitude. Only the two time slices that bracket dt
+are read, and the fields are interpolated linearly in time between them
+(they are NaN outside of the time range of the file). The fields of the
+last two times are cached in each process, and are read-only.
+"""
+def read_thermo_month(dt):
+    fn_th = get_fn_thermo()
+    return _read_thermo_month(fn_th, os.path.getmtime(fn_th), dt)
+
+
+"""
+Returns the tiles of the thermodynamic fields for n_time times of n_lev
+levels on a grid of n_lat x n_lon, as a list of (time slice, lat slice).
+Each tile has as many times as fit in namelist.thermo_tile_gb, or if not
+even one time fits, one time and as many latitudes as fit. The tiles are
+also made small enough that there are at least namelist.n_procs of them
+(if there are as many latitudes and times), so that no process is idle.
+"""
+def get_tiles(n_time, n_lev, n_lat, n_lon):
+    n_rows = int(namelist.thermo_tile_gb * 1e9 / (n_bytes_tile_point * n_lev * n_lon))
+    n_rows = max(1, min(n_rows, n_time * n_lat // max(1, namelist.n_procs)))
+    if n_rows >= n_lat:
+        n_t = n_rows // n_lat
+        return [(slice(i, min(i + n_t, n_time)), slice(0, n_lat)) for i in range(0, n_time, n_t)]
+    return [(slice(i, i + 1), slice(j, min(j + n_rows, n_lat)))
+            for i in range(n_time) for j in range(0, n_lat, n_rows)]
+
+"""
+Opens the input datasets between dt_start and dt_end, without reading them.
+The datasets of the last time range are kept open in each process, for the
+other tiles of the same times.
+"""
+@functools.lru_cache(maxsize = 1)
+def _open_inputs(dt_start, dt_end):
+    return (input.load_sst(dt_start, dt_end), input.load_mslp(dt_start, dt_end),
+            input.load_temp(dt_start, dt_end), input.load_sp_hum(dt_start, dt_end))
+
+"""
+Computes the thermodynamic fields (vmax, chi, rh_mid) between dt_start and
+dt_end, at the latitudes lat_slice of the atmospheric grid. Only this tile of
+the atmospheric fields, and the SST at these times, is read.
+"""
+def compute_thermo(dt_start, dt_end, lat_slice = slice(None)):
+    ds_sst, ds_psl, ds_ta, ds_hus = _open_inputs(dt_start, dt_end)
     lon_ky = input.get_lon_key()
     lat_ky = input.get_lat_key()
     sst_ky = input.get_sst_key()
+    psl = ds_psl[input.get_mslp_key()].isel({lat_ky: lat_slice}).load()
+    ta = ds_ta[input.get_temp_key()].isel({lat_ky: lat_slice}).load()
+    hus = ds_hus[input.get_sp_hum_key()].isel({lat_ky: lat_slice}).load()
+    sst = ds_sst[sst_ky].load()
 
-    nTime = len(ds_sst['time'])
-    vmax = np.zeros(ds_psl[input.get_mslp_key()].shape)
-    chi = np.zeros(ds_psl[input.get_mslp_key()].shape)
-    rh_mid = np.zeros(ds_psl[input.get_mslp_key()].shape)
+    nTime = len(psl['time'])
+    sst_interp = np.zeros(psl.shape)
     for i in range(nTime):
         # Convert all variables to the atmospheric grid.
-        sst_interp = mat.interp_2d_grid(ds_sst[lon_ky], ds_sst[lat_ky],
-                                        np.nan_to_num(ds_sst[sst_ky][i, :, :].data),
-                                        ds_ta[lon_ky], ds_ta[lat_ky])
-        if 'C' in ds_sst[sst_ky].units:
-            sst_interp = sst_interp + 273.15
-
-        psl = ds_psl[input.get_mslp_key()][i, :, :]
-        ta = ds_ta[input.get_temp_key()][i, :, :, :]
-        hus = ds_hus[input.get_sp_hum_key()][i, :, :, :]
-        lvl = ds_ta[input.get_lvl_key()]
-        lvl_d = np.copy(ds_ta[input.get_lvl_key()].data)
-
-        # Ensure lowest model level is first.
-        # Here we assume the model levels are in pressure.
-        if (lvl[0] - lvl[1]) < 0:
-            ta = ta.reindex({input.get_lvl_key(): lvl[::-1]})
-            hus = hus.reindex({input.get_lvl_key(): lvl[::-1]})
-            lvl_d = lvl_d[::-1]
-    
-        p_midlevel = namelist.p_midlevel                    # Pa
-        if lvl.units in ['millibars', 'hPa']:
-            lvl_d *= 100                                    # needs to be in Pa
-            p_midlevel = namelist.p_midlevel / 100          # hPa
-            lvl_mid = lvl.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest')
-
-        # TODO: Check units of psl, ta, and hus
-        vmax_args = (sst_interp, psl.data, lvl_d, ta.data, hus.data)
-        vmax[i, :, :] = thermo.CAPE_PI_vectorized(*vmax_args)
-        ta_midlevel = ta.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest').data
-        hus_midlevel = hus.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest').data
-
-        p_midlevel_Pa = float(lvl_mid) * 100 if lvl_mid.units in ['millibars', 'hPa'] else float(lvl_mid)
-        chi_args = (sst_interp, psl.data, ta_midlevel,
-                    p_midlevel_Pa, hus_midlevel)
-        chi[i, :, :] = np.minimum(np.maximum(thermo.sat_deficit(*chi_args), 0), 10)
-        rh_mid[i, :, :] = thermo.conv_q_to_rh(ta_midlevel, hus_midlevel, p_midlevel_Pa)
+        sst_interp[i, :, :] = mat.interp_2d_grid(ds_sst[lon_ky], ds_sst[lat_ky],
+                                                 np.nan_to_num(sst[i, :, :].data),
+                                                 ta[lon_ky], ta[lat_ky])
+    if 'C' in ds_sst[sst_ky].units:
+        sst_interp = sst_interp + 273.15
+
+    lvl = ds_ta[input.get_lvl_key()]
+    lvl_d = np.copy(ds_ta[input.get_lvl_key()].data)
+
+    # Ensure lowest model level is first.
+    # Here we assume the model levels are in pressure.
+    if (lvl[0] - lvl[1]) < 0:
+        ta = ta.reindex({input.get_lvl_key(): lvl[::-1]})
+        hus = hus.reindex({input.get_lvl_key(): lvl[::-1]})
+        lvl_d = lvl_d[::-1]
+
+    p_midlevel = namelist.p_midlevel                    # Pa
+    if lvl.units in ['millibars', 'hPa']:
+        lvl_d *= 100                                    # needs to be in Pa
+        p_midlevel = namelist.p_midlevel / 100          # hPa
+    lvl_mid = lvl.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest')
+
+    # TODO: Check units of psl, ta, and hus
+    vmax = thermo.CAPE_PI_vectorized(sst_interp, psl.data, lvl_d, ta.data, hus.data)
+    ta_midlevel = ta.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest').data
+    hus_midlevel = hus.sel({input.get_lvl_key(): p_midlevel}, method = 'nearest').data
+
+    p_midlevel_Pa = float(lvl_mid) * 100 if lvl_mid.units in ['millibars', 'hPa'] else float(lvl_mid)
+    chi_args = (sst_interp, psl.data, ta_midlevel,
+                p_midlevel_Pa, hus_midlevel)
+    chi = np.minimum(np.maximum(thermo.sat_deficit(*chi_args), 0), 10)
+    rh_mid = thermo.conv_q_to_rh(ta_midlevel, hus_midlevel, p_midlevel_Pa)
 
     return (vmax, chi, rh_mid)
 
+"""
+Computes the thermodynamic fields over the downscaling period, in tiles (see
+get_tiles) computed in parallel by namelist.n_procs processes. Each tile is
+written to the output file as soon as it is computed, so that the fields are
+never all in memory. The file is written under a temporary name, and renamed
+when it is complete.
+"""
 def gen_thermo():
     # TODO: Assert all of the datasets have the same length in time.
-    if os.path.exists(get_fn_thermo()):
+    fn_th = get_fn_thermo()
+    if os.path.exists(fn_th):
         return
 
     # Load datasets metadata. Since SST is split into multiple files and can
@@ -85,33 +185,43 @@ def gen_thermo():
     dt_start, dt_end = input.get_bounding_times()
     ds = input.load_mslp()
 
-    ct_bounds = [dt_start, dt_end]
-    ds_times = input.convert_from_datetime(ds,
-                   np.array([x for x in input.convert_to_datetime(ds, ds['time'].values)
-                             if x >= ct_bounds[0] and x <= ct_bounds[1]]))
-
-    n_chunks = namelist.n_procs
-    chunks = np.array_split(ds_times, np.minimum(n_chunks, np.floor(len(ds_times) / 2)))
-    lazy_results = []
-    for i in range(len(chunks)):
-        lazy_result = dask.delayed(compute_thermo)(chunks[i][0], chunks[i][-1])
-        lazy_results.append(lazy_result)
-    out = dask.compute(*lazy_results, scheduler = 'processes', num_workers = n_chunks)
+    dts = input.get_datetimes(ds)
+    in_bounds = (dts >= dt_start) & (dts <= dt_end)
+    ds_times = input.convert_from_datetime(ds, dts[in_bounds])
 
-    # Clean up and process output.
+    # Create the output file.
     # Ensure monthly timestamps have middle-of-the-month days.
-    ds_times = input.convert_from_datetime(ds,
-                  np.array([datetime.datetime(x.year, x.month, 15) for x in
-                           [x for x in input.convert_to_datetime(ds, ds['time'].values)
-                            if x >= ct_bounds[0] and x <= ct_bounds[1]]]))
-    vmax = np.concatenate([x[0] for x in out], axis = 0)
-    chi = np.concatenate([x[1] for x in out], axis = 0)
-    rh_mid = np.concatenate([x[2] for x in out], axis = 0)
-    ds_thermo = xr.Dataset(data_vars = dict(vmax = (['time', 'lat', 'lon'], vmax),
-                                            chi = (['time', 'lat', 'lon'], chi),
-                                            rh_mid = (['time', 'lat', 'lon'], rh_mid)),
-                           coords = dict(lon = ("lon", ds[input.get_lon_key()].data),
-                                         lat = ("lat", ds[input.get_lat_key()].data),
-                                         time = ("time", ds_times)))
-    ds_thermo.to_netcdf(get_fn_thermo())
-    print('Saved %s' % get_fn_thermo())
+    ds_times_out = input.convert_from_datetime(ds,
+                      np.array([datetime.datetime(x.year, x.month, 15) for x in dts[in_bounds]]))
+    lon = ds[input.get_lon_key()].data
+    lat = ds[input.get_lat_key()].data
+    n_lev = len(input.load_temp(ds_times[0])[input.get_lvl_key()])
+    n_time, n_lat, n_lon = len(ds_times), len(lat), len(lon)
+    # Save with increasing latitude, so that readers do not need to flip the fields.
+    flip_lat = lat[0] > lat[-1]
+    fields = dask.array.zeros((n_time, n_lat, n_lon), chunks = (1, n_lat, n_lon))
+    ds_thermo = xr.Dataset(data_vars = dict(vmax = (['time', 'lat', 'lon'], fields),
+                                            chi = (['time', 'lat', 'lon'], fields),
+                                            rh_mid = (['time', 'lat', 'lon'], fields)),
+                           coords = dict(lon = ("lon", lon),
+                                         lat = ("lat", lat[::-1] if flip_lat else lat),
+                                         time = ("time", ds_times_out)))
+    fn_tmp = '%s_tmp%s' % os.path.splitext(fn_th)
+    output.create_dataset(ds_thermo, fn_tmp, 'thermo')
+
+    tiles = get_tiles(n_time, n_lev, n_lat, n_lon)
+    # Only a few tiles per process are in flight, so that the parent holds
+    # the fields of a bounded number of tiles, whatever the period.
+    tasks = [(ds_times[t_slice.start], ds_times[t_slice.stop - 1], lat_slice) for (t_slice, lat_slice) in tiles]
+    with concurrent.futures.ProcessPoolExecutor(max_workers = namelist.n_procs) as pool:
+        for (i, (vmax, chi, rh_mid)) in util.pool_imap_unordered(pool, compute_thermo, tasks, 2 * namelist.n_procs):
+            (t_slice, lat_slice) = tiles[i]
+            if flip_lat:
+                lat_slice = slice(n_lat - lat_slice.stop, n_lat - lat_slice.start)
+                vmax, chi, rh_mid = [x[:, ::-1, :] for x in (vmax, chi, rh_mid)]
+            ds_tile = xr.Dataset(data_vars = dict(vmax = (['time', 'lat', 'lon'], vmax),
+                                                  chi = (['time', 'lat', 'lon'], chi),
+                                                  rh_mid = (['time', 'lat', 'lon'], rh_mid)))
+            output.write_region(ds_tile, fn_tmp, dict(time = t_slice, lat = lat_slice))
+    os.rename(fn_tmp, fn_th)
+    print('Saved %s' % fn_th)
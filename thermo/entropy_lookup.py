@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Lookup of the temperature of saturated parcels in the entropy inversion
+tables: thermo/entropy_table.npz (pseudoadiabatic, with pressure and entropy
+axes) and thermo/entropy_table_reversible.npz (reversible, with pressure,
+entropy and total water mixing ratio axes).
+
+Tables written by thermo.generate_entropy_table carry a version in their
+name (e.g. entropy_table_v2.npz), and are used instead of the unversioned
+tables when they exist. Each table is read once in each process, and read
+again only if the file is modified. On uniform axes, which is how the tables are generated, the
+temperature is interpolated (bi- or tri-) linearly from the position of each
+point on the axes, without searching the axes. Otherwise, the lookup falls
+back to interpn.
+
+As before, points outside of the pseudoadiabatic table are clamped to its
+edges (as RectBivariateSpline does), and points outside of the reversible
+table are NaN (as interpn with fill_value = NaN does).
+"""
+
+import functools
+import os
+import numpy as np
+from scipy.interpolate import interpn
+
+import namelist
+
+# Version of the tables written by thermo.generate_entropy_table.
+table_version = 2
+
+"""
+Returns the name of the table of the thermodynamics select_thermo, of the
+given version (None for the unversioned table).
+"""
+def get_fn_table(select_thermo, version = None):
+    if select_thermo == 1:
+        fn_table = '%s/thermo/entropy_table' % namelist.src_directory
+    elif select_thermo == 2:
+        fn_table = '%s/thermo/entropy_table_reversible' % namelist.src_directory
+    else:
+        raise ValueError('select_thermo must be 1 (pseudoadiabatic) or 2 (reversible).')
+    if version is not None:
+        fn_table += '_v%d' % version
+    return('%s.npz' % fn_table)
+
+"""
+Returns the name of the table used for the thermodynamics select_thermo:
+the table of the current version if it exists, and the unversioned table
+otherwise.
+"""
+def find_table(select_thermo):
+    fn_table = get_fn_table(select_thermo, table_version)
+    if os.path.exists(fn_table):
+        return(fn_table)
+    return(get_fn_table(select_thermo))
+
+"""
+Returns whether the axis x is uniform, to a relative tolerance of its spacing.
+"""
+def _is_uniform(x, rtol = 1e-6):
+    dx = np.diff(x)
+    if len(x) < 2 or not np.all(dx > 0):
+        return False
+    dx_mean = (x[-1] - x[0]) / (len(x) - 1)
+    return bool(np.all(np.abs(dx - dx_mean) <= rtol * np.abs(dx[0])))
+
+@functools.lru_cache(maxsize = 2)
+def _load_table(fn, mtime):
+    with np.load(fn) as entropy_table:
+        ax_names = ['p', 's', 'rt'] if 'rt' in entropy_table else ['p', 's']
+        axes = tuple([np.array(entropy_table[x], dtype = float) for x in ax_names])
+        T = np.ascontiguousarray(entropy_table['T'], dtype = float)
+    for x in axes:
+        x.setflags(write = False)
+    T.setflags(write = False)
+    uniform = all([_is_uniform(x) for x in axes])
+    return (axes, T, uniform)
+
+"""
+Returns the axes ((p, s) or (p, s, rt)) and the temperature of the table of
+the thermodynamics select_thermo, and whether all of the axes are uniform.
+"""
+def load_table(select_thermo):
+    fn = find_table(select_thermo)
+    return _load_table(fn, os.path.getmtime(fn))
+
+"""
+Linear interpolation of T on the uniform axes, at the points xi (a list of
+arrays of the same shape, one per axis). Points outside of the axes are
+clamped to the edges if clamp is True, and are NaN otherwise. NaN points
+are NaN.
+"""
+def interp_uniform(axes, T, xi, clamp = True):
+    shape = xi[0].shape
+    strides = [int(np.prod(T.shape[d+1:])) for d in range(T.ndim)]
+    flat_idx = np.zeros(shape, dtype = np.intp)
+    weights = []
+    is_out = np.zeros(shape, dtype = bool)
+    for (d, (x, xq)) in enumerate(zip(axes, xi)):
+        n = len(x)
+        idx = (xq - x[0]) * ((n - 1) / (x[-1] - x[0]))
+        # NaN points are out of the table, whether or not they are clamped.
+        is_out |= ~((idx >= 0) & (idx <= n - 1)) if not clamp else np.isnan(idx)
+        idx = np.where(np.isnan(idx), 0, np.clip(idx, 0, n - 1))
+        i0 = np.clip(np.floor(idx), 0, n - 2).astype(np.intp)
+        weights.append(idx - i0)
+        flat_idx += i0 * strides[d]
+
+    # Sum over the corners of the cells, with the weights of each corner.
+    T_flat = np.ravel(T)
+    T_out = np.zeros(shape)
+    for corner in np.ndindex(*([2] * len(axes))):
+        offset = sum([c * strides[d] for (d, c) in enumerate(corner)])
+        w = np.ones(shape)
+        for (d, c) in enumerate(corner):
+            w *= weights[d] if c == 1 else (1 - weights[d])
+        T_out += w * T_flat[flat_idx + offset]
+    T_out[is_out] = np.nan
+    return T_out
+
+"""
+Returns the temperature [K] of saturated parcels of entropy s at pressure
+p [Pa] (and of total water mixing ratio rt, for reversible thermodynamics),
+from the table of the thermodynamics select_thermo. The inputs are
+broadcast against each other.
+"""
+def lookup_T(select_thermo, p, s, rt = None):
+    (axes, T, uniform) = load_table(select_thermo)
+    xi = [p, s] if select_thermo == 1 else [p, s, rt]
+    xi = np.broadcast_arrays(*[np.asarray(x, dtype = float) for x in xi])
+    clamp = select_thermo == 1
+    if uniform:
+        return interp_uniform(axes, T, xi, clamp = clamp)
+    if clamp:
+        xi = [np.clip(xq, x[0], x[-1]) for (x, xq) in zip(axes, xi)]
+    return interpn(axes, T, tuple(xi), method = 'linear', bounds_error = False, fill_value = np.nan)
@@ -5,14 +5,14 @@ Utility library for thermodynamics and PI computations.
 """
 
 # Import packages
+import concurrent.futures
 import numpy as np
 # For inverting entropy
-from scipy.interpolate import RectBivariateSpline
-from scipy.interpolate import interpn
 from scipy.optimize import minimize
 from scipy.special import lambertw
 # Import parameters
 import namelist
+from thermo import entropy_lookup
 from util import constants as pr
 
 """ Saturation mixing ratio and saturation vapor pressure computation. """
@@ -148,19 +148,6 @@ def CAPE_PI(sst,p_surf,p_env,T_env,r_env):
     select_thermo = namelist.select_thermo
     # Select inversion method: Set to 1 for computation, 2 for interpolation
     select_interp = namelist.select_interp
-    # If interpolation, load temperature table and coordinates
-    if namelist.select_interp == 2:
-        if select_thermo == 1:
-            with np.load('%s/thermo/entropy_table.npz' % namelist.src_directory) as entropy_table:
-                p_look = entropy_table['p']
-                s_look = entropy_table['s']
-                T_lookup = entropy_table['T']
-        elif select_thermo == 2:
-            with np.load('%s/thermo/entropy_table_reversible.npz' % namelist.src_directory) as entropy_table:
-                p_look = entropy_table['p']
-                s_look = entropy_table['s']
-                rt_look = entropy_table['rt']
-                T_lookup = entropy_table['T']
     # Dimensions of the input
     dim_in = T_env.shape
     # Near surface conditions: For now, assume that parcels at the first level
@@ -192,9 +179,6 @@ def CAPE_PI(sst,p_surf,p_env,T_env,r_env):
     PI = np.zeros(sst.shape)
     # Compute LCL pressure and index
     pLCL = get_LCL(p_ns,T_ns,r_ns,rh)
-    if select_thermo == 1:
-        # Create interpolation function for solutions of entropy inversion.
-        f_lookup = RectBivariateSpline(p_look, s_look, T_lookup, kx=1, ky=1)
     for hh in np.arange(dim_in[1]):
         for gg in np.arange(dim_in[2]):
             # Invert for temperature, using dry adiabat under pLCL and moist adiabat above
@@ -221,14 +205,10 @@ def CAPE_PI(sst,p_surf,p_env,T_env,r_env):
                                                  method='BFGS', jac=s_diff_der, options={'gtol': 1e-02}).x
                     jj += 1
             elif select_interp == 2:
-                if select_thermo == 1:
-                    # Then, compute T by inverting moist adiabats
-                    Ta_prof[Icond:,hh,gg] = f_lookup.ev(p_env[Icond:], np.full((len(p_env[Icond:]),), s_ns[hh,gg]))
-                    # For the saturated parcel, pLCL = p_ns, so only invert moist adiabat
-                    Ts_prof[:,hh,gg] = f_lookup.ev(p_env, np.full((len(p_env),), ss[hh,gg]))
-                elif select_thermo == 2:
-                    Ta_prof[Icond:,hh,gg] = interpn((p_look,s_look,rt_look),T_lookup,(p_env[Icond:],s_ns[hh,gg],r_ns[hh,gg]), method='linear', bounds_error = False, fill_value=np.nan)
-                    Ts_prof[:,hh,gg] = interpn((p_look,s_look,rt_look),T_lookup,(p_env,ss[hh,gg],rs[hh,gg]), method='linear',  bounds_error = False, fill_value=np.nan)
+                # Then, compute T by inverting moist adiabats
+                Ta_prof[Icond:,hh,gg] = entropy_lookup.lookup_T(select_thermo, p_env[Icond:], s_ns[hh,gg], r_ns[hh,gg])
+                # For the saturated parcel, pLCL = p_ns, so only invert moist adiabat
+                Ts_prof[:,hh,gg] = entropy_lookup.lookup_T(select_thermo, p_env, ss[hh,gg], rs[hh,gg])
             # Compute mixing ratio of ascent profiles
             tmp, ra_prof[Icond:,hh,gg] = sat_thermo(Ta_prof[Icond:,hh,gg],p_env[Icond:])
             tmp, rs_prof[:,hh,gg] = sat_thermo(Ts_prof[:,hh,gg],p_env)
@@ -257,36 +237,28 @@ def CAPE_PI(sst,p_surf,p_env,T_env,r_env):
 
 """ Vectorized version of a function to compute potential intensity
 Inputs:
-2D sst array [K]
-2D near-surface pressure array [Pa]
+sst array [K] with dimensions (..., lat, lon), e.g. (lat, lon) or (time, lat, lon)
+near-surface pressure array [Pa] with the same dimensions
 1D Environmental pressure sounding [Pa]
-3D Environmental arrays of temperature [K] and water vapor mixing ratio
+Environmental arrays of temperature [K] and water vapor mixing ratio,
+with dimensions (..., lev, lat, lon)
 Output:
-Potential intensity [m/s]"""
+Potential intensity [m/s], with the dimensions of sst"""
 def CAPE_PI_vectorized(sst,p_surf,p_env,T_env,r_env):
     # Ratio of the exchange coefficients
     cecd = namelist.Ck / namelist.Cd;
     # Select thermodynamics: Set to 1 for pseudoadiabatic, 2 for reversible
     select_thermo = namelist.select_thermo
-    # Load temperature table, with pressure and entropy coordinates
-    if namelist.select_interp == 2:
-        if select_thermo == 1:
-            with np.load('%s/thermo/entropy_table.npz' % namelist.src_directory) as entropy_table:
-                p_look = entropy_table['p']
-                s_look = entropy_table['s']
-                T_lookup = entropy_table['T']
-        elif select_thermo == 2:
-            with np.load('%s/thermo/entropy_table_reversible.npz' % namelist.src_directory) as entropy_table:
-                p_look = entropy_table['p']
-                s_look = entropy_table['s']
-                rt_look = entropy_table['rt']
-                T_lookup = entropy_table['T']
-    # Dimensions of the input
-    dim_in = T_env.shape
+    # Levels are the first dimension of the profiles: (lev, ..., lat, lon)
+    T_env = np.moveaxis(T_env, -3, 0)
+    r_env = np.moveaxis(r_env, -3, 0)
+    nPLev = len(p_env)
+    p_lev = np.reshape(p_env, (nPLev,) + (1,) * sst.ndim)
+    p_env_mat = np.broadcast_to(p_lev, T_env.shape)
     # Near surface conditions: For now, assume that parcels at the first level
     # are representative of near surface parcels
-    T_ns = T_env[0,:,:]
-    r_ns = r_env[0,:,:]
+    T_ns = T_env[0]
+    r_ns = r_env[0]
     p_ns = p_env[0]
     # Initialize saturated parcels at SST
     ess, rs = sat_thermo(sst,p_surf)
@@ -301,55 +273,28 @@ def CAPE_PI_vectorized(sst,p_surf,p_env,T_env,r_env):
     lnp = np.log(p_env)
     dlnp = np.diff(lnp,n=1,append = (2*lnp[-1] - lnp[-2]))
     T_rho_env = calc_T_rho(T_env,r_env,r_env)
-    # Initialize ascent profiles
-    Ta_prof = np.zeros(dim_in)
-    T_rho_a = np.zeros(dim_in)
-    ra_prof = np.zeros(dim_in)
-    Ts_prof = np.zeros(dim_in)
-    T_rho_s = np.zeros(dim_in)
-    rs_prof = np.zeros(dim_in)
-    # Initialize PI
-    PI = np.zeros(sst.shape)
     # Compute LCL pressure and index
     pLCL = get_LCL(p_ns,T_ns,r_ns,rh)
-    if select_thermo == 1:
-        # Create interpolation function for solutions of entropy inversion.
-        f_lookup = RectBivariateSpline(p_look, s_look, T_lookup, kx=1, ky=1)
-    # Find pressure level for condensation.
-    nPLev = len(p_env)
-    p_env_mat = np.moveaxis(np.tile(p_env, pLCL.shape + (1,)), 2, 0)
-    Icond = np.tile(pLCL, (len(p_env), 1, 1)) > p_env_mat
-    Icond[-1, :, :] = True                                                  # if no condensation, set it to the highest level
-    Icond_idxs = np.apply_along_axis(np.argmax, 0, Icond)                   # find first index of condensation
-    is_cond = np.full(Icond_idxs.shape, True)
-    is_cond[Icond_idxs == (len(p_env)-1)] = False                           # if no condensation, store for later
-    # For lower levels (higher pressure), compute T based on a dry adiabat
-    Ta_prof = np.multiply(np.tile(T_ns, (nPLev, 1, 1)), np.power(p_env_mat / p_ns, pr.Rd / pr.cp))
-    # Maintain constant vapor mixing ratio
-    ra_prof = np.tile(r_ns, (nPLev, 1, 1))
-    # Then, compute T by inverting moist adiabats
-    if select_thermo == 1:
-        for p_idx in range(nPLev):
-            lvl_mask = Icond_idxs == p_idx
-            nLvl = np.sum(lvl_mask)
-            Ta_prof[p_idx, :, :][lvl_mask] = f_lookup.ev(np.full((nLvl,), p_env[p_idx]), np.full((nLvl,), s_ns[lvl_mask]))
-            tmp, ra_prof[p_idx, :, :][lvl_mask] = sat_thermo(Ta_prof[p_idx, :, :][lvl_mask],np.full((nLvl,), p_env[p_idx]))
-            for p2_idx in range(p_idx, nPLev):
-                Ta_prof[p2_idx, :, :][lvl_mask] = f_lookup.ev(np.full((nLvl,), p_env[p2_idx]), np.full((nLvl,), s_ns[lvl_mask]))
-                tmp, ra_prof[p2_idx, :, :][lvl_mask]  = sat_thermo(Ta_prof[p2_idx, :, :][lvl_mask],np.full((nLvl,), p_env[p2_idx]))
-        # For the saturated parcel, pLCL = p_ns, so only invert moist adiabat
-        Ts_prof = f_lookup.ev(p_env_mat, np.full(p_env_mat.shape, ss))
-    elif select_thermo == 2:
-        for p_idx in range(nPLev):
-            lvl_mask = Icond_idxs == p_idx
-            nLvl = np.sum(lvl_mask)
-            Ta_prof[p_idx, :, :][lvl_mask] = interpn((p_look,s_look,rt_look),T_lookup,(np.full((nLvl,), p_env[p_idx]), np.full((nLvl,), s_ns[lvl_mask]),np.full((nLvl,), r_ns[lvl_mask])), method='linear', bounds_error = False, fill_value=np.nan)
-            tmp, ra_prof[p_idx, :, :][lvl_mask] = sat_thermo(Ta_prof[p_idx, :, :][lvl_mask],np.full((nLvl,), p_env[p_idx]))
-            for p2_idx in range(p_idx, nPLev):
-                Ta_prof[p2_idx, :, :][lvl_mask] = interpn((p_look,s_look,rt_look),T_lookup,(np.full((nLvl,), p_env[p2_idx]), np.full((nLvl,), s_ns[lvl_mask]),np.full((nLvl,), r_ns[lvl_mask])), method='linear', bounds_error = False, fill_value=np.nan)
-                tmp, ra_prof[p2_idx, :, :][lvl_mask]  = sat_thermo(Ta_prof[p2_idx, :, :][lvl_mask],np.full((nLvl,), p_env[p2_idx]))
-        # For the saturated parcel, pLCL = p_ns, so only invert moist adiabat
-        Ts_prof = interpn((p_look,s_look,rt_look),T_lookup,(p_env_mat, np.full(p_env_mat.shape, ss), np.full(p_env_mat.shape, rs)), method='linear',  bounds_error = False, fill_value=np.nan)
+    # Find first pressure level of condensation. If there is no condensation,
+    # use the highest level.
+    Icond = pLCL > p_lev
+    Icond[-1] = True
+    Icond_idxs = np.argmax(Icond, axis = 0)
+    is_moist = np.reshape(np.arange(nPLev), p_lev.shape) >= Icond_idxs
+    # Invert the moist adiabats of the BL parcel and of the saturated parcel
+    # (for which pLCL = p_ns), at all levels, in one lookup.
+    p_look_mat = np.stack([p_env_mat, p_env_mat])
+    s_look_mat = np.stack([np.broadcast_to(s_ns, T_env.shape), np.broadcast_to(ss, T_env.shape)])
+    rt_look_mat = None
+    if select_thermo == 2:
+        rt_look_mat = np.stack([np.broadcast_to(r_ns, T_env.shape), np.broadcast_to(rs, T_env.shape)])
+    T_moist = entropy_lookup.lookup_T(select_thermo, p_look_mat, s_look_mat, rt_look_mat)
+    # For lower levels (higher pressure), compute T based on a dry adiabat,
+    # and maintain constant vapor mixing ratio. Above, the parcel is saturated.
+    Ta_prof = np.where(is_moist, T_moist[0], T_ns * np.power(p_env_mat / p_ns, pr.Rd / pr.cp))
+    tmp, ra_moist = sat_thermo(Ta_prof,p_env_mat)
+    ra_prof = np.where(is_moist, ra_moist, r_ns)
+    Ts_prof = T_moist[1]
     # Compute mixing ratio of saturated ascent profiles
     tmp, rs_prof = sat_thermo(Ts_prof,p_env_mat)
     # Compute density temperature. Assume that there is no liquid or ice water at lower level.
@@ -357,50 +302,16 @@ def CAPE_PI_vectorized(sst,p_surf,p_env,T_env,r_env):
     T_rho_s = calc_T_rho(Ts_prof,rs_prof,rs)
     # Compute CAPE differences
     # Find LNB for saturated and BL profiles
-    a_out_I = (nPLev-1) - np.apply_along_axis(np.argmax, 0, np.flip(T_rho_a >= T_rho_env, axis = 0))
-    s_out_I = (nPLev-1) - np.apply_along_axis(np.argmax, 0, np.flip(T_rho_s >= T_rho_env, axis = 0))
-    # Get outflow properties
-    T_out_a = np.zeros(pLCL.shape)
-    p_out_a = np.zeros(pLCL.shape)
-    add_area_a = np.zeros(pLCL.shape)
-    T_out_s = np.full(pLCL.shape, np.nan)
-    p_out_s = np.zeros(pLCL.shape)
-    add_area_s = np.zeros(pLCL.shape)
-    for p_idx in range(nPLev-1):
-        # For the surface-saturated parcel
-        mask = s_out_I == p_idx
-        Te1 = T_env[p_idx, :, :][mask]
-        Te2 = T_env[p_idx+1, :, :][mask]
-        Tre1 = T_rho_env[p_idx, :, :][mask]
-        Tre2 = T_rho_env[p_idx+1, :, :][mask]
-        Trs1 = T_rho_s[p_idx, :, :][mask]
-        Trs2 = T_rho_s[p_idx+1, :, :][mask]
-        dT1 = Trs1-Tre1
-        dT2 = Trs2-Tre2
-        p_out_s[mask] = (p_env[p_idx]*dT2 - p_env[p_idx+1]*dT1)/(dT2-dT1)
-        T_out_s[mask] = (Te1*(p_out_s[mask]-p_env[p_idx+1])+Te2*(p_env[p_idx]-p_out_s[mask]))/(p_env[p_idx] - p_env[p_idx+1])
-        add_area_s[mask]=pr.Rd *dT1*(p_env[p_idx]-p_out_s[mask])/(p_env[p_idx]+p_out_s[mask])
-        # For the boundary layer parcel
-        mask = a_out_I == p_idx
-        Te1 = T_env[p_idx, :, :][mask]
-        Te2 = T_env[p_idx+1, :, :][mask]
-        Tre1 = T_rho_env[p_idx, :, :][mask]
-        Tre2 = T_rho_env[p_idx+1, :, :][mask]
-        Tra1 = T_rho_a[p_idx, :, :][mask]
-        Tra2 = T_rho_a[p_idx+1, :, :][mask]
-        dT1 = Tra1-Tre1
-        dT2 = Tra2-Tre2
-        p_out_a[mask] = (p_env[p_idx]*dT2 - p_env[p_idx+1]*dT1)/(dT2-dT1)
-        T_out_a[mask] = (Te1*(p_out_a[mask]-p_env[p_idx+1])+Te2*(p_env[p_idx]-p_out_a[mask]))/(p_env[p_idx] - p_env[p_idx+1])
-        add_area_a[mask]=pr.Rd *dT1*(p_env[p_idx]-p_out_a[mask])/(p_env[p_idx]+p_out_a[mask])
-    # Compute CAPE
-    CAPE = np.zeros(pLCL.shape)
-    CAPEs = np.zeros(pLCL.shape)
-    for p_idx in range(nPLev):
-        mask = p_idx <= a_out_I
-        CAPE[mask] += pr.Rd * (T_rho_a[p_idx, :, :][mask] - T_rho_env[p_idx, :, :][mask]) * -dlnp[p_idx]
-        mask = p_idx <= s_out_I
-        CAPEs[mask] += pr.Rd * (T_rho_s[p_idx, :, :][mask] - T_rho_env[p_idx, :, :][mask]) * -dlnp[p_idx]
+    a_out_I = (nPLev-1) - np.argmax(np.flip(T_rho_a >= T_rho_env, axis = 0), axis = 0)
+    s_out_I = (nPLev-1) - np.argmax(np.flip(T_rho_s >= T_rho_env, axis = 0), axis = 0)
+    # Get outflow properties, interpolated between the LNB and the level above
+    T_out_s, add_area_s = _outflow(p_env, T_env, T_rho_env, T_rho_s, s_out_I)
+    T_out_s[s_out_I == nPLev-1] = np.nan
+    T_out_a, add_area_a = _outflow(p_env, T_env, T_rho_env, T_rho_a, a_out_I)
+    # Compute CAPE, integrating up to the LNB
+    dlnp_lev = np.reshape(-dlnp, p_lev.shape)
+    CAPE = np.take_along_axis(np.cumsum(pr.Rd * (T_rho_a - T_rho_env) * dlnp_lev, axis = 0), a_out_I[None], axis = 0)[0]
+    CAPEs = np.take_along_axis(np.cumsum(pr.Rd * (T_rho_s - T_rho_env) * dlnp_lev, axis = 0), s_out_I[None], axis = 0)[0]
     CAPE += add_area_a
     CAPEs += add_area_s
     # Difference of the CAPEs
@@ -411,6 +322,28 @@ def CAPE_PI_vectorized(sst,p_surf,p_env,T_env,r_env):
     PI[np.isnan(PI)] = 0
     return PI
 
+""" Outflow temperature and additional CAPE area of a parcel with density
+temperature T_rho_p, found by linear interpolation in pressure of the level
+of neutral buoyancy between the levels out_I and out_I + 1. Both are zero
+where out_I is the highest level. """
+def _outflow(p_env, T_env, T_rho_env, T_rho_p, out_I):
+    nPLev = len(p_env)
+    idx = np.minimum(out_I, nPLev-2)[None]
+    Te1 = np.take_along_axis(T_env, idx, axis = 0)[0]
+    Te2 = np.take_along_axis(T_env, idx+1, axis = 0)[0]
+    dT1 = np.take_along_axis(T_rho_p, idx, axis = 0)[0] - np.take_along_axis(T_rho_env, idx, axis = 0)[0]
+    dT2 = np.take_along_axis(T_rho_p, idx+1, axis = 0)[0] - np.take_along_axis(T_rho_env, idx+1, axis = 0)[0]
+    p1 = p_env[idx[0]]
+    p2 = p_env[idx[0]+1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        p_out = (p1*dT2 - p2*dT1)/(dT2-dT1)
+        T_out = (Te1*(p_out-p2)+Te2*(p1-p_out))/(p1 - p2)
+        add_area = pr.Rd *dT1*(p1-p_out)/(p1+p_out)
+    is_top = out_I == nPLev-1
+    T_out[is_top] = 0
+    add_area[is_top] = 0
+    return T_out, add_area
+
 """ Emanuel GPI function """
 def gpi(PI,chi,vort,S):
     # Set GPI to zero when PI falls under the 35 m/s threshold
@@ -433,11 +366,38 @@ def s_diff_der(T,p,r_t,select_thermo,s_ref):
     diff_der = 2*(s_sat(T,p,r_t,select_thermo)-s_ref)*s_sat_der(T,p,r_t,select_thermo)
     return diff_der
 
+""" Inverts the saturation entropy for temperature, s_sat(T,p,rt) = s, on the grid
+of the 1D axes p [Pa], s [J/kg/K] and rt [kg/kg]. The inversion uses Newton
+iterations with the analytical derivative s_sat_der, vectorized over pressure and
+total water, until the entropy is within tol of s. Entropies are inverted in
+increasing order, each starting from the temperatures at the previous entropy.
+Returns the temperature table, with dimensions (p, s, rt). """
+def invert_entropy(p,s,rt,select_thermo,tol,T_init=250.0,max_iter=50):
+    p_mat, rt_mat = np.meshgrid(p, rt, indexing = 'ij')
+    T = np.full(p_mat.shape, T_init)
+    T_lookup = np.zeros((len(p),len(s),len(rt)), dtype=float)
+    for jj in np.arange(0,len(s)):
+        for it in np.arange(0,max_iter):
+            s_err = s_sat(T,p_mat,rt_mat,select_thermo) - s[jj]
+            # Only iterate where the inversion has not converged, so that the
+            # solution of a point does not depend on the other points.
+            active = np.logical_not(np.abs(s_err) < tol)
+            if not np.any(active):
+                break
+            # Keep the iterations within the range of the saturation thermodynamics
+            T_new = np.clip(T - s_err / s_sat_der(T,p_mat,rt_mat,select_thermo), 50.0, 400.0)
+            T = np.where(active, T_new, T)
+        T_lookup[:,jj,:] = T
+    return T_lookup
+
 """Function to generate a Temperature lookup table with pressure and entropy coordinates.
-The temperature table is obtained by inverting the entropy function at constant pressure.
+The temperature table is obtained by inverting the entropy function at constant pressure
+(see invert_entropy), and is saved in the thermo directory of the source directory, as
+the table of the current version (entropy_lookup.table_version), which is then used by
+CAPE_PI and CAPE_PI_vectorized.
 Inputs:
-pmin: minimum of the pressure axis [Pa]
-pmax: maximum of the pressure axis [Pa]
+pmin: minimum of the pressure axis [hPa]
+pmax: maximum of the pressure axis [hPa]
 nprs: number of pressure points
 smin: minimum of the entropy axis [J/kg/K]
 smax: maximum of the entropy axis [J/kg/K]
@@ -445,37 +405,43 @@ ns: number of entropy points
 rtmin: minimum total water content (only for reversible case)
 rtmax: maximum total water content (only for reversible case)
 nrt: number of total water points
+n_procs: number of processes, between which the pressure axis is split
 Values of about 100 for nprs and ns are recommended for a earth-like ranges of climate.
-smin and smax can be generated using s_unsat and s_sat, and selecting appropriate T, P and rv"""
+smin and smax can be generated using s_unsat and s_sat, and selecting appropriate T, P and rv
+Returns the name of the table file."""
 
-def generate_entropy_table(pmin,pmax,nprs,smin,smax,ns,rtmin,rtmax,nrt,select_thermo):
+def generate_entropy_table(pmin,pmax,nprs,smin,smax,ns,rtmin,rtmax,nrt,select_thermo,n_procs=1):
     # Create the entropy and pressure axes
     s_look = np.linspace(smin,smax,ns)
     p_look = 100*np.linspace(pmin,pmax,nprs)
-    # Initial temperature guess (250 K works pretty well)
-    T_approx = 250.0
-
     if select_thermo == 1:
-        # Create the inversion table, by iterating through pressure and entropy
-        T_lookup = np.zeros((nprs,ns), dtype=float)
-        for ii in np.arange(0,nprs):
-            for jj in np.arange(0,ns):
-                T_lookup[ii,jj] = minimize(s_diff, T_approx, args = (p_look[ii],0.0,select_thermo,s_look[jj]),
-                                           method='Nelder-Mead', jac=None).x
-        # Save entropy inversion table
-        np.savez('entropy_table.npz', p=p_look, s=s_look, T=T_lookup)
-
+        rt_look = np.zeros(1)
     elif select_thermo == 2:
         # Create an additional dimension for total water content
         rt_look = np.linspace(rtmin,rtmax,nrt)
-        # Create the inversion table, by iterating through pressure, entropy and total water
-        T_lookup = np.zeros((nprs,ns,nrt), dtype=float)
-        for ii in np.arange(0,nprs):
-            for jj in np.arange(0,ns):
-                for kk in np.arange(0,nrt):
-                    T_lookup[ii,jj,kk] = minimize(s_diff, T_approx, args = (p_look[ii],rt_look[kk],select_thermo,s_look[jj]),
-                                               method='Nelder-Mead', jac=None).x
-        # Save entropy inversion table
-        np.savez('entropy_table_reversible.npz', p=p_look, s=s_look, rt=rt_look, T=T_lookup)
 
-    return
+    # Create the inversion table, splitting the pressure axis between processes
+    tol = 1e-8
+    p_chunks = np.array_split(p_look, min(n_procs, nprs))
+    if len(p_chunks) == 1:
+        T_lookup = invert_entropy(p_look,s_look,rt_look,select_thermo,tol)
+    else:
+        n_chunks = len(p_chunks)
+        with concurrent.futures.ProcessPoolExecutor(max_workers = n_chunks) as pool:
+            T_lookup = np.concatenate(list(pool.map(invert_entropy, p_chunks, [s_look] * n_chunks,
+                                                    [rt_look] * n_chunks, [select_thermo] * n_chunks,
+                                                    [tol] * n_chunks)), axis = 0)
+    # Cells which did not converge have no solution in the temperature range
+    p_mat, s_mat, rt_mat = np.meshgrid(p_look, s_look, rt_look, indexing = 'ij')
+    residual = np.abs(s_sat(T_lookup,p_mat,rt_mat,select_thermo) - s_mat)
+    print('Entropy inversion table: %d of %d cells did not converge, largest residual of %.2e J/kg/K' %
+          (np.sum(np.logical_not(residual < tol)), residual.size, np.nanmax(residual)))
+
+    # Save entropy inversion table
+    fn_table = entropy_lookup.get_fn_table(select_thermo, entropy_lookup.table_version)
+    table = dict(p=p_look, s=s_look, T=T_lookup[:,:,0] if select_thermo == 1 else T_lookup,
+                 version=entropy_lookup.table_version, residual=np.nanmax(residual))
+    if select_thermo == 2:
+        table['rt'] = rt_look
+    np.savez(fn_table, **table)
+    return fn_table
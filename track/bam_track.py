@@ -4,42 +4,75 @@
 @author: jzlin@mit.edu
 """
 # %%
-import datetime
 import numpy as np
 import xarray as xr
-import time
-
-from scipy.interpolate import interp1d
 
 import namelist
 from track import env_wind
-from util import input, mat, sphere
+from util import input, instrument, mat, month_cache, sphere
 
 """
 Generate F from Emanuel et. al. (2006). It is a Fourier series where
 the individual wave components have a random phase. In addition, the
 kinetic energy power spectrum follows that of geostrophic turublence.
+The random phases are drawn from the generator rng.
+"""
+def gen_f(N, T, t, num, rng):
+    return(eval_f(gen_f_phases(N, num, rng), gen_f_basis(N, T, t)))
+
 """
-def gen_f(N, T, t, num):
-    fs = np.zeros((num, np.size(t)))
-    for i in range(0, num):
-        n = np.linspace(1, N, N)
-        xln = np.tile(np.random.rand(N, 1), (1, np.size(t)))   # Zero phase correlation
-        fs[i, :] = np.sqrt(2 / np.sum(np.power(n, -3))) * \
-                   np.sum(np.multiply(np.tile(np.power(n, -1.5), (np.size(t), 1)).T,
-                                      np.sin(2. * np.pi * (np.outer(n, t) / T + xln))), axis=0)
-    return(fs)
+Draws the random phases of num Fourier series of gen_f (dimensions [num, N]).
+"""
+def gen_f_phases(N, num, rng):
+    return(rng.random((num, N)))       # Zero phase correlation
 
 """
-Seed the generator. Advantage of this method is that processes that
-run close to each other will have very different seeds.
+Returns the angular frequencies (k) and amplitudes of the N wave components
+of the Fourier series of gen_f, with period T.
 """
-def random_seed():
-    t = int(time.time() * 1000.0)
-    np.random.seed(((t & 0xff000000) >> 24) +
-                   ((t & 0x00ff0000) >>  8) +
-                   ((t & 0x0000ff00) <<  8) +
-                   ((t & 0x000000ff) << 24))
+def gen_f_components(N, T):
+    n = np.linspace(1, N, N)
+    k = 2. * np.pi * n / T
+    amp = np.sqrt(2 / np.sum(np.power(n, -3))) * np.power(n, -1.5)
+    return(k, amp)
+
+"""
+Returns the basis of the Fourier series of gen_f at the times t, with the
+amplitude of each wave component included. The first N rows are the sine
+components, and the last N rows are the cosine components.
+"""
+def gen_f_basis(N, T, t):
+    k, amp = gen_f_components(N, T)
+    kt = np.outer(k, np.atleast_1d(t))
+    return(np.concatenate((amp[:, np.newaxis] * np.sin(kt), amp[:, np.newaxis] * np.cos(kt)), axis = 0))
+
+"""
+Evaluates Fourier series with the random phases xln (dimensions [..., N])
+on a basis from gen_f_basis. Since sin(a + b) = sin(a)cos(b) + cos(a)sin(b),
+each series is a weighted sum of the basis, so any number of series (e.g.
+storms x wind levels) are evaluated with one matrix product.
+Returns dimensions [..., time].
+"""
+def eval_f(xln, basis):
+    return(np.matmul(gen_f_weights(xln), basis))
+
+"""
+Returns the weights of the basis from gen_f_basis, for Fourier series with
+the random phases xln (dimensions [..., N]). Returns dimensions [..., 2N].
+If the amplitudes (amp) are given, they are included in the weights.
+"""
+def gen_f_weights(xln, amp = 1):
+    return(np.concatenate((amp * np.cos(2. * np.pi * xln), amp * np.sin(2. * np.pi * xln)), axis = -1))
+
+"""
+Evaluates Fourier series exactly at the time(s) t, without materializing
+them at other times. Fs_w are the weights of the series, with amplitudes
+(see gen_f_weights), and k are the angular frequencies (see gen_f_components).
+Returns dimensions [...] for a scalar t, and [..., time] otherwise.
+"""
+def eval_f_at(Fs_w, k, t):
+    kt = np.multiply.outer(k, t)
+    return(np.matmul(Fs_w, np.concatenate((np.sin(kt), np.cos(kt)))))
 
 class BetaAdvectionTrack:
     """
@@ -54,12 +87,15 @@ class BetaAdvectionTrack:
         self.total_steps = int(self.total_time / self.dt_track) + 1
         self.t_s = np.linspace(0, self.total_time, int(self.total_time / self.dt_track) + 1)
         self.T_Fs = namelist.T_days*24*60*60    # 15-day period of the fourier series
+        self.N_Fs = 15                          # number of sine waves
+        self.Fs_k, self.Fs_amp = gen_f_components(self.N_Fs, self.T_Fs)
         self.u_beta = namelist.u_beta           # zonal beta drift speed
         self.v_beta = namelist.v_beta           # meridional beta drift speed
         self.nLvl = len(namelist.steering_levels)
         self.nWLvl = self.nLvl * 2
         self.dt_start = dt_start
         self.basin = basin
+        self.wnd_cov_mode = namelist.wnd_cov_mode
         self.var_names = env_wind.wind_mean_vector_names()
         self.u_Mean_idxs = np.zeros(self.nLvl).astype(int)
         self.v_Mean_idxs = np.zeros(self.nLvl).astype(int)
@@ -69,64 +105,175 @@ class BetaAdvectionTrack:
             self.v_Mean_idxs[i] = int(self.var_names.index('va' + str(p_lvls[i]) + '_Mean'))          
         self._load_wnd_stat()
 
-    def _interp_basin_field(self, var):
-        lon_b, lat_b, var_b = self.basin.transform_global_field(self.wnd_lon, self.wnd_lat, var)
-        return mat.interp2_fx(lon_b, lat_b, np.nan_to_num(var_b))
+    """ Returns the list of global fields Xs on the basin grid, stacked. """
+    def _transform_basin_fields(self, Xs):
+        Xs_b = [0] * len(Xs)
+        for i in range(len(Xs)):
+            lon_b, lat_b, Xs_b[i] = self.basin.transform_global_field(self.wnd_lon, self.wnd_lat, Xs[i])
+        return (lon_b, lat_b, np.nan_to_num(np.stack(Xs_b)))
+
+    """ Returns the lower triangle of the Cholesky factor of the covariance at
+        each grid point, given the lower triangle of the covariance (wnd_tril).
+        Grid points where the covariance is not positive definite are repaired
+        with the nearest positive definite matrix, rather than having zero winds. """
+    def _factor_wnd_cov(self, wnd_tril):
+        (tril_i, tril_j) = self.wnd_tril_idxs
+        wnd_cov = np.zeros(wnd_tril.shape[1:] + (self.nWLvl, self.nWLvl))
+        wnd_cov[..., tril_i, tril_j] = np.moveaxis(wnd_tril, 0, -1)
+        wnd_cov[..., tril_j, tril_i] = np.moveaxis(wnd_tril, 0, -1)
+
+        # Grid points without statistics (missing data) keep a zero factor.
+        has_stats = np.any(wnd_cov != 0, axis = (-2, -1))
+        wnd_A = np.zeros(wnd_cov.shape)
+        wnd_A[has_stats], self.n_wnd_cov_repaired = mat.cholesky_nearestPD(wnd_cov[has_stats])
+        if self.n_wnd_cov_repaired > 0:
+            print('%s: repaired %d of %d wind covariances that were not positive definite' %
+                  (self.dt_start, self.n_wnd_cov_repaired, np.sum(has_stats)))
+        return np.moveaxis(wnd_A[..., tril_i, tril_j], -1, 0)
 
     def _load_wnd_stat(self):
-        wnd_Mean, wnd_Cov = env_wind.read_env_wnd_fn(self.fn_wnd_stat)
-        self.wnd_Mean_Fxs = [0]*len(wnd_Mean)
-        self.wnd_Cov_Fxs = [['' for i in range(len(wnd_Cov))] for j in range(len(wnd_Cov[0]))]
-        ds = xr.open_dataset(self.fn_wnd_stat)
+        ds = env_wind.open_env_wnd_fn(self.fn_wnd_stat)
         self.datetime_start = input.convert_to_datetime(ds, np.array([self.dt_start]))
-        self.wnd_lon = wnd_Mean[0]['lon']
-        self.wnd_lat = wnd_Mean[0]['lat']
 
         # Since xarray interpolation is slow, use our own 2-D interpolation.
-        # Only create interpolation functions for the lower trianglular matrix.
-        for i in range(len(wnd_Mean)):
-            self.wnd_Mean_Fxs[i] = self._interp_basin_field(wnd_Mean[i].interp(time = self.dt_start))
-            for j in range(len(wnd_Mean)):
-                if j <= i:
-                    self.wnd_Cov_Fxs[i][j] = self._interp_basin_field(wnd_Cov[i][j].interp(time = self.dt_start))
+        # All statistics are interpolated together: the means, followed by the
+        # lower trianglular matrix of the covariance (in row-major order).
+        # In the 'factor' mode, the covariance is replaced by its Cholesky factor.
+        # The statistics of the month in the basin are saved in the month cache.
+        self.wnd_tril_idxs = np.tril_indices(self.nWLvl)
+        key_parts = [month_cache.file_id(self.fn_wnd_stat), self.dt_start, self.basin.basin_id,
+                     self.basin.basin_bounds, namelist.steering_levels, self.wnd_cov_mode]
+        wnd = month_cache.get_arrays('wnd', key_parts, self._basin_wnd_stat)
+        self.n_wnd_cov_repaired = int(wnd['n_repaired'])
+        self.f_wnd = mat.Interp2Stack(wnd['lon'], wnd['lat'], wnd['stats'])
 
-    def interp_wnd_mean_cov(self, clon, clat, ct):
-        wnd_mean = np.zeros(self.nWLvl)
-        wnd_cov = np.zeros((self.nWLvl, self.nWLvl))
+    """ Returns the wind statistics of the month on the basin grid, as a dictionary. """
+    def _basin_wnd_stat(self):
+        wnd_Mean, wnd_Cov = env_wind.read_env_wnd_fn(self.fn_wnd_stat)
+        self.wnd_lon = wnd_Mean[0]['lon'].data
+        self.wnd_lat = wnd_Mean[0]['lat'].data
+        wnd_stats = [wnd_Mean[i] for i in range(self.nWLvl)]
+        wnd_stats += [wnd_Cov[i][j] for (i, j) in zip(*self.wnd_tril_idxs)]
+        ds_stats = xr.merge([x.rename('s%d' % i) for (i, x) in enumerate(wnd_stats)], compat = 'override')
+        ds_stats = ds_stats.interp(time = self.dt_start)
+        lon_b, lat_b, wnd_stats_b = self._transform_basin_fields([ds_stats['s%d' % i].data for i in range(len(wnd_stats))])
 
-        # Only interpolate the lower trianglular matrix.
-        for i in range(0, self.nWLvl):
-            wnd_mean[i] = self.wnd_Mean_Fxs[i].ev(clon, clat)
-            for j in range(0, self.nWLvl):
-                if j <= i:
-                    wnd_cov[i, j] = self.wnd_Cov_Fxs[i][j].ev(clon, clat)
+        self.n_wnd_cov_repaired = 0
+        if self.wnd_cov_mode == 'factor':
+            wnd_stats_b[self.nWLvl:] = self._factor_wnd_cov(wnd_stats_b[self.nWLvl:])
+        return dict(lon = lon_b, lat = lat_b, stats = wnd_stats_b,
+                    n_repaired = np.array(self.n_wnd_cov_repaired))
 
-        for i in range(0, self.nWLvl):
-            for j in range(i, self.nWLvl):
-                wnd_cov[i, j] = wnd_cov[j, i]
+    def interp_wnd_mean_cov(self, clon, clat, ct):
+        wnd_mean, wnd_cov = self.interp_wnd_mean_cov_vectorized(np.atleast_1d(clon), np.atleast_1d(clat))
+        return(wnd_mean[0], wnd_cov[0])
 
-        return(wnd_mean, wnd_cov)
+    """ Generate the weights of the random Fourier Series (see gen_f_weights),
+        using the generator rng. Returns (nWLvl, 2 * N_Fs). """
+    def gen_synthetic_f_weights(self, rng):
+        return(gen_f_weights(gen_f_phases(self.N_Fs, self.nWLvl, rng), self.Fs_amp))
+
+    """ Generate the weights of the random Fourier Series of many storms at once,
+        using the generator of each storm in rngs. The phases are drawn from
+        each generator, as in gen_synthetic_f_weights, and the weights of all
+        of the storms are computed together. Returns (n, nWLvl, 2 * N_Fs). """
+    def gen_synthetic_f_weights_vectorized(self, rngs):
+        xln = np.stack([gen_f_phases(self.N_Fs, self.nWLvl, rng) for rng in rngs])
+        return(gen_f_weights(xln, self.Fs_amp))
 
-    """ Generate the random Fourier Series """
-    def gen_synthetic_f(self):
-        N_series = 15                       # number of sine waves
-        return(gen_f(N_series, self.T_Fs, self.t_s, self.nWLvl))
+    """ Evaluate the Fourier Series of the current track at the time(s) t,
+        exactly from its weights (Fs_w). Returns (nWLvl) for a scalar t,
+        and (nWLvl, time) otherwise. """
+    def Fs_i(self, t):
+        return eval_f_at(self.Fs_w, self.Fs_k, t)
 
     """ Calculate environmental winds at a point and time. """
     def _env_winds(self, clon, clat, ts):
         if np.isnan(clon) or np.isnan(ts):
             return np.zeros(self.nWLvl)
 
-        ct = self.datetime_start + datetime.timedelta(seconds = ts)
-        wnd_mean, wnd_cov = self.interp_wnd_mean_cov(clon, clat, ct)
+        wnd_mean, wnd_A = self.interp_wnd_mean_factor_vectorized(np.atleast_1d(clon), np.atleast_1d(clat))
+        wnds = wnd_mean[0] + np.matmul(wnd_A[0], self.Fs_i(ts))
+        return wnds
+
+    """ Returns the interpolated means (n, nWLvl) and the lower triangles of
+        the interpolated statistics (n, nWLvl, nWLvl) at 1-D arrays of positions. """
+    def _interp_wnd_stats_vectorized(self, clon, clat):
+        wnd_stats = self.f_wnd.ev(clon, clat)
+        wnd_mean = wnd_stats[0:self.nWLvl].T
+        wnd_tril = np.zeros((np.size(clon), self.nWLvl, self.nWLvl))
+        (tril_i, tril_j) = self.wnd_tril_idxs
+        wnd_tril[:, tril_i, tril_j] = wnd_stats[self.nWLvl:].T
+        return(wnd_mean, wnd_tril)
+
+    """ Vectorized version of interp_wnd_mean_cov, for 1-D arrays of positions.
+        Returns the means (n, nWLvl) and covariances (n, nWLvl, nWLvl). """
+    def interp_wnd_mean_cov_vectorized(self, clon, clat):
+        wnd_mean, wnd_tril = self._interp_wnd_stats_vectorized(clon, clat)
+        if self.wnd_cov_mode == 'factor':
+            wnd_cov = np.matmul(wnd_tril, np.swapaxes(wnd_tril, 1, 2))
+        else:
+            wnd_cov = wnd_tril + np.swapaxes(np.tril(wnd_tril, -1), 1, 2)
+        return(wnd_mean, wnd_cov)
+
+    """ Returns the means (n, nWLvl) and the Cholesky factors of the covariances
+        (n, nWLvl, nWLvl) at 1-D arrays of positions. In the 'factor' mode, the
+        factors are interpolated directly. Otherwise, the interpolated covariance
+        is factorized, and positions where it is not positive definite have
+        zero mean and covariance. """
+    def interp_wnd_mean_factor_vectorized(self, clon, clat):
+        if self.wnd_cov_mode == 'factor':
+            return self._interp_wnd_stats_vectorized(clon, clat)
+
+        wnd_mean, wnd_cov = self.interp_wnd_mean_cov_vectorized(clon, clat)
         try:
             wnd_A = np.linalg.cholesky(wnd_cov)
-        except np.linalg.LinAlgError as err:
-            print(self.dt_start)
-            return np.zeros(self.nWLvl)
-        wnds = wnd_mean + np.matmul(wnd_A, self.Fs_i(ts))
+        except np.linalg.LinAlgError:
+            # At least one matrix is not positive definite, so factorize individually.
+            wnd_A = np.zeros(wnd_cov.shape)
+            for i in range(wnd_cov.shape[0]):
+                try:
+                    wnd_A[i] = np.linalg.cholesky(wnd_cov[i])
+                except np.linalg.LinAlgError:
+                    print(self.dt_start)
+                    instrument.count('cholesky_failures')
+                    wnd_mean[i] = 0
+        return(wnd_mean, wnd_A)
+
+    """ Evaluate a stack of Fourier series, with weights Fs_w (n, nWLvl, 2 * N_Fs),
+        at the time ts. Returns (n, nWLvl). """
+    def _eval_Fs_vectorized(self, Fs_w, ts):
+        return eval_f_at(Fs_w, self.Fs_k, ts)
+
+    """ Calculate environmental winds at many points, given the weights of the
+        Fourier series (n, nWLvl) of each point. """
+    def _env_winds_vectorized(self, clon, clat, Fs_t):
+        wnds = np.zeros((np.size(clon), self.nWLvl))
+        valid = ~np.isnan(clon)
+        if not np.any(valid):
+            return wnds
+
+        wnd_mean, wnd_A = self.interp_wnd_mean_factor_vectorized(clon[valid], clat[valid])
+        wnds[valid] = wnd_mean + np.einsum('nij,nj->ni', wnd_A, Fs_t[valid])
         return wnds
 
+    """ Vectorized version of _step_bam_track. steering_coefs is (n, nLvl). """
+    def _step_bam_track_vectorized(self, clon, clat, Fs_t, steering_coefs):
+        wnds = self._env_winds_vectorized(clon, clat, Fs_t)
+
+        v_bam = np.zeros((np.size(clon), 2))
+        w_lat = np.cos(np.deg2rad(clat))
+        v_beta_sgn = np.sign(clat) * self.v_beta
+
+        v_bam[:, 0] = np.sum(wnds[:, self.u_Mean_idxs] * steering_coefs, axis = 1) + self.u_beta * w_lat
+        v_bam[:, 1] = np.sum(wnds[:, self.v_Mean_idxs] * steering_coefs, axis = 1) + v_beta_sgn * w_lat
+
+        # Include a hard stop for latitudes above 80 degrees.
+        polar = np.abs(clat) >= 80
+        v_bam[polar] = 0
+        wnds[polar] = 0
+        return(v_bam, wnds)
+
     """ Calculate the translational speeds from the beta advection model """
     def _step_bam_track(self, clon, clat, ts, steering_coefs):
         # Include a hard stop for latitudes above 80 degrees.
@@ -149,14 +296,15 @@ class BetaAdvectionTrack:
         steering_coefs = np.array(namelist.steering_coefs)
         return steering_coefs
 
-    """ Generate a track with a starting position of (clon, clat) """
-    def gen_track(self, clon, clat):
-        # Make sure that tracks are sufficiently randomized.
-        random_seed()
+    """ Generate a track with a starting position of (clon, clat). The random
+        weights of the track are drawn from the generator rng (a new generator
+        with fresh entropy if not given). """
+    def gen_track(self, clon, clat, rng = None):
+        if rng is None:
+            rng = np.random.default_rng()
 
         # Create the weights for the beta-advection model (across time).
-        self.Fs = self.gen_synthetic_f()
-        self.Fs_i = interp1d(self.t_s, self.Fs, axis = 1)
+        self.Fs_w = self.gen_synthetic_f_weights(rng)
 
         track = np.full((self.total_steps+1, 2), np.nan)
         wind_track = np.full((self.total_steps, self.nWLvl), np.nan)
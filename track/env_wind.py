@@ -1,11 +1,14 @@
-import dask
+import concurrent.futures
+import dask.array
 import datetime
+import functools
 import numpy as np
 import os
+import warnings
 import xarray as xr
 
 import namelist
-from util import input
+from util import input, mat, output, util
 
 """
 Returns the name of the file containing environmental wind statistics.
@@ -14,7 +17,7 @@ def get_env_wnd_fn():
     fn_out = '%s/env_wnd_%s_%d%02d_%d%02d.nc' % (namelist.output_directory, namelist.exp_prefix,
                                                  namelist.start_year, namelist.start_month,
                                                  namelist.end_year, namelist.end_month)
-    return(fn_out)
+    return(output.get_fn(fn_out))
 
 """
 Generates variable names in the monthly mean wind vector.
@@ -54,6 +57,17 @@ def deep_layer_winds(env_wnds):
     v850 = env_wnds[:, var_names.index('va850_Mean')]
     return (u250, v250, u850, v850)
 
+"""
+Opens the file of environmental wind statistics. The file is opened once in
+each process, and reopened only if it has been modified.
+"""
+def open_env_wnd_fn(fn_wnd_stat):
+    return _open_env_wnd_fn(fn_wnd_stat, os.path.getmtime(fn_wnd_stat))
+
+@functools.lru_cache(maxsize = 4)
+def _open_env_wnd_fn(fn_wnd_stat, mtime):
+    return output.open_dataset(fn_wnd_stat)
+
 """
 Read the mean and covariance of the upper/lower level zonal and meridional winds.
 """
@@ -62,9 +76,9 @@ def read_env_wnd_fn(fn_wnd_stat, dt_s = None, dt_e = None):
     var_Var = wind_cov_matrix_names()
 
     if dt_s is None:
-        ds = xr.open_dataset(fn_wnd_stat)
+        ds = open_env_wnd_fn(fn_wnd_stat)
     else:
-        ds = xr.open_dataset(fn_wnd_stat).sel(time = slice(dt_s, dt_e))
+        ds = open_env_wnd_fn(fn_wnd_stat).sel(time = slice(dt_s, dt_e))
     wnd_Mean = [ds[x] for x in var_Mean]
     wnd_Cov = [['' for i in range(len(var_Mean))] for j in range(len(var_Mean))]
     for i in range(len(var_Mean)):
@@ -78,7 +92,10 @@ def read_env_wnd_fn(fn_wnd_stat, dt_s = None, dt_e = None):
 
 """
 Generate the wind mean and covariance matrices used to advect
-tropical cyclones.
+tropical cyclones. The statistics of each month are computed by a pool of
+namelist.n_procs processes, and written to the output file as soon as they
+are computed, so no intermediate files are written. The file is written
+under a temporary name, and renamed when it is complete.
 """
 def gen_wind_mean_cov():
     fn_out = get_env_wnd_fn()
@@ -89,53 +106,53 @@ def gen_wind_mean_cov():
     # control over the files being opened.
     fns_ua = input._glob_prefix(input.get_u_key())
     fns_va = input._glob_prefix(input.get_v_key())
+    fn_pairs = list(zip(fns_ua, fns_va))
+
+    # Find the months of each file, and create the output file.
+    tasks = []
+    times = []
+    for (fn_u, fn_v) in fn_pairs:
+        with input._load_var_daily(fn_u) as ds_ua:
+            t_months = get_wnd_months(ds_ua)
+            times += list(input.convert_from_datetime(ds_ua, t_months))
+            lon = ds_ua[input.get_lon_key()].data
+            lat = ds_ua[input.get_lat_key()].data
+        tasks += [(fn_u, fn_v, dt) for dt in t_months]
 
-    lazy_results = []
-    for i in range(min(len(fns_ua), len(fns_va))):
-        lazy_result = dask.delayed(wnd_stat_wrapper)((fns_ua[i], fns_va[i]))
-        lazy_results.append(lazy_result)
-    out = dask.compute(*lazy_results)
-    out_fns = [x for x in out if x is not None]
-
-    # Combine all intermediate files into one dataset, and delete
-    #ds = input._open_fns(out_fns)
-
-    with input._open_fns(out_fns) as ds:
-
-        da = ds['wnd_stats']
-
-        var_Mean = wind_mean_vector_names()
-        var_Var = sum([[x for x in y if len(x) > 0] for y in wind_cov_matrix_names()], [])
-        var_names = var_Mean + var_Var
-        var_dict = dict()
-        for i in range(len(var_names)):
-            var_dict[var_names[i]] = da[:, i, :, :].rename(var_names[i])
-
-
-    ds_e = xr.Dataset(data_vars = var_dict)
-    ds_e.to_netcdf(fn_out, mode = 'w')
+    var_Mean = wind_mean_vector_names()
+    var_Var = sum([[x for x in y if len(x) > 0] for y in wind_cov_matrix_names()], [])
+    var_names = var_Mean + var_Var
+    fields = dask.array.zeros((len(times), len(lat), len(lon)), chunks = (1, len(lat), len(lon)))
+    ds_e = xr.Dataset(data_vars = {x: (['time', 'lat', 'lon'], fields) for x in var_names},
+                      coords = dict(lon = ("lon", lon), lat = ("lat", lat), time = ("time", np.array(times))))
+    fn_tmp = '%s_tmp%s' % os.path.splitext(fn_out)
+    output.create_dataset(ds_e, fn_tmp, 'env_wnd')
+
+    # Only a few months per process are in flight, so that the parent holds
+    # the statistics of a bounded number of months. A partially written file
+    # is removed, so that it is not left behind on a failure.
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = namelist.n_procs) as pool:
+            for (i, wnd_stats) in util.pool_imap_unordered(pool, calc_wnd_stat_month, tasks, 2 * namelist.n_procs):
+                ds_stats = xr.Dataset(data_vars = {x: (['time', 'lat', 'lon'], wnd_stats[None, k])
+                                                   for (k, x) in enumerate(var_names)})
+                output.write_region(ds_stats, fn_tmp, dict(time = slice(i, i + 1)))
+    except BaseException:
+        output.remove(fn_tmp)
+        raise
+    os.rename(fn_tmp, fn_out)
     print('Saved %s' % fn_out)
 
-    import time
-    time.sleep(0.5)
-
-    '''
-    # Remove intermediate files
-    for fn in out_fns:
-        os.remove(fn)
-    '''
-    
-def wnd_stat_wrapper(args):
-    fn_u, fn_v = args
-
+"""
+Returns the months of the wind dataset ds_ua to average over, within the
+downscaling period, as datetimes. The first month is the first time of the
+period or of the file; the others are the middle of each month.
+"""
+def get_wnd_months(ds_ua):
     dt_start, dt_end = input.get_bounding_times()
-    ds_ua = input._load_var_daily(fn_u)
-    ds_va = input._load_var_daily(fn_v)
-    ua = ds_ua[input.get_u_key()]
-    va = ds_va[input.get_v_key()]
 
     # Find all of the months to average over.
-    dts = input.convert_to_datetime(ds_ua, ds_ua['time'].values)
+    dts = input.get_datetimes(ds_ua)
     dt_start = max([dt_start, dts[0]])
     t_months = [dt_start]
     while t_months[-1] <= min([dt_end, dts[-1]]):
@@ -146,35 +163,59 @@ def wnd_stat_wrapper(args):
         else:
             t_months.append(datetime.datetime(cYear, cMonth + 1, 15))
 
-    t_months = t_months[0:-1]
-    nMonths = len(t_months)
+    return t_months[0:-1]
 
-    # No computations found for this file.
-    if nMonths == 0:
-        return
+"""
+Opens the daily wind files, and converts their time axis. The files of the
+last month are kept open in each process, for the other months of the files.
+"""
+@functools.lru_cache(maxsize = 1)
+def _open_wnd_files(fn_u, fn_v):
+    ds_ua = input._load_var_daily(fn_u)
+    ds_va = input._load_var_daily(fn_v)
+    dts = input.get_datetimes(ds_ua)
+    return (ds_ua[input.get_u_key()], ds_va[input.get_v_key()], dts)
 
-    # Compute mean and covariances for upper and lower level horizontal winds.
-    out = [0]*nMonths
-    for i in range(nMonths):
-        out[i] = calc_wnd_stat(ua, va, t_months[i])
+"""
+Computes the wind statistics of the month of dt, from the daily wind files
+fn_u and fn_v. Returns an array of dimensions (stat, lat, lon).
+"""
+def calc_wnd_stat_month(fn_u, fn_v, dt):
+    ua, va, dts = _open_wnd_files(fn_u, fn_v)
+    return calc_wnd_stat(ua, va, dt, dts).data
 
-    # Save the results using an intermediate file.
-    da_wnd = xr.DataArray(data = xr.concat(out, dim = "time").data,
-                          dims = ['time', 'stat', 'lat', 'lon'],
-                          coords = dict(lon = ("lon", ds_ua[input.get_lon_key()].data),
-                                        lat = ("lat", ds_ua[input.get_lat_key()].data),
-                                        time = ("time", input.convert_from_datetime(ds_ua, t_months))))
-    ds_wnd = da_wnd.to_dataset(name='wnd_stats')
-    fn_ds_wnd = '%s/env_wnd_%s_p%d%02d_%d%02d.nc' % (namelist.output_directory, namelist.exp_prefix,
-                                                     t_months[0].year, t_months[0].month,
-                                                     t_months[-1].year, t_months[-1].month)
-    ds_wnd.to_netcdf(fn_ds_wnd)
-    return fn_ds_wnd
+"""
+Returns the indices of the steering levels in the level axis of the wind da.
+"""
+def get_steering_level_idxs(da):
+    lvl = da[input.get_lvl_key()]
+    p_lvls = list(namelist.steering_levels)
+    if lvl.units not in ['millibars', 'hPa']:
+        p_lvls = [x * 100 for x in p_lvls]
+    lvl_index = da.get_index(input.get_lvl_key())
+    return [int(lvl_index.get_loc(x)) for x in p_lvls]
+
+"""
+Reads the wind da at the time indices t_idxs (a slice if they are
+consecutive) and the level indices lvl_idxs. Only this subset of the file
+is read.
+"""
+def _read_wnd(da, t_idxs, lvl_idxs):
+    if np.all(np.diff(t_idxs) == 1):
+        t_idxs = slice(t_idxs[0], t_idxs[-1] + 1)
+    return da.isel({'time': t_idxs, input.get_lvl_key(): lvl_idxs}).values
 
 """
-Computes mean and covariance of environmental winds across a month.
+Computes mean and covariance of environmental winds across a month, at the
+steering levels. The statistics are accumulated in one pass over the days of
+the month (see mat.StreamingMeanCov), reading the winds at the steering
+levels one day at a time. If the time step is less than one day and
+namelist.wnd_stat_daily_mean is set, the winds are first averaged over each
+day; otherwise, each time step is a sample. As before, variances are
+normalized by N and covariances by N - 1. dts are the datetimes of the time
+axis of ua, if they have already been converted.
 """
-def calc_wnd_stat(ua, va, dt):
+def calc_wnd_stat(ua, va, dt, dts = None):
     cYear = dt.year
     cMonth = dt.month
 
@@ -182,49 +223,39 @@ def calc_wnd_stat(ua, va, dt):
         tEnd = datetime.datetime(cYear + 1, 1, 1)
     else:
         tEnd = datetime.datetime(cYear, cMonth + 1, 1)
-    month_mask = ((input.convert_to_datetime(ua, ua['time'].values) >= datetime.datetime(cYear, cMonth, 1)) &
-                  (input.convert_to_datetime(ua, ua['time'].values) < tEnd))
-
-    lvl = ua[input.get_lvl_key()]
-    if lvl.units in ['millibars', 'hPa']:
-        p_upper = 250; p_lower = 850;
-    else:
-        p_upper = 25000; p_lower = 85000;
+    if dts is None:
+        dts = input.get_datetimes(ua)
+    t_idxs = np.nonzero((dts >= datetime.datetime(cYear, cMonth, 1)) & (dts < tEnd))[0]
+    lvl_idxs_u = get_steering_level_idxs(ua)
+    lvl_idxs_v = get_steering_level_idxs(va)
 
     # If time step is less than one day, group by day.
     dt_step = (np.timedelta64(1, 'D') - (ua['time'][1] - ua['time'][0]).data) / np.timedelta64(1, 's')
-    if dt_step < 0:
-        ua_month = ua.sel(time = month_mask).groupby("time.day").mean(dim = 'time')
-        va_month = va.sel(time = month_mask).groupby("time.day").mean(dim = 'time')
-        t_unit = 'day'
-    else:
-        ua_month = ua.sel(time = month_mask)
-        va_month = va.sel(time = month_mask)
-        t_unit = 'time'
-
-    # Compute the daily averages
-    ua250_month = ua_month.sel({input.get_lvl_key(): p_upper})
-    va250_month = va_month.sel({input.get_lvl_key(): p_upper})
-    ua850_month = ua_month.sel({input.get_lvl_key(): p_lower})
-    va850_month = va_month.sel({input.get_lvl_key(): p_lower})
-
-    month_wnds = [ua250_month, va250_month,
-                  ua850_month, va850_month]
-    month_mean_wnds = [0] * len(month_wnds)
-    month_var_wnds = [[np.empty(0) for i in range(len(month_wnds))] for j in range(len(month_wnds))]
-    for i in range(len(month_wnds)):
-        month_mean_wnds[i] = month_wnds[i].mean(dim = t_unit)
-        for j in range(0, i+1):
-            if i == j:
-                month_var_wnds[i][j] = month_wnds[i].var(dim = t_unit)
-            else:
-                month_var_wnds[i][j] = xr.cov(month_wnds[i], month_wnds[j], dim = t_unit)
+    days = np.array([x.day for x in dts[t_idxs]])
+    t_days = [t_idxs[days == x] for x in np.unique(days)]
+    daily_mean = dt_step < 0 and namelist.wnd_stat_daily_mean
+
+    n_lon = len(ua[input.get_lon_key()])
+    n_lat = len(ua[input.get_lat_key()])
+    wnd_acc = mat.StreamingMeanCov(2 * len(lvl_idxs_u), (n_lat, n_lon))
+    for t_day in t_days:
+        # Winds ordered as [ua(p), va(p) for p in steering levels], with dimensions (time, var, lat, lon)
+        ua_day = _read_wnd(ua, t_day, lvl_idxs_u)
+        va_day = _read_wnd(va, t_day, lvl_idxs_v)
+        wnds_day = np.stack([ua_day, va_day], axis = 2).reshape((len(t_day), -1, n_lat, n_lon))
+        if daily_mean:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                wnd_acc.update(np.nanmean(wnds_day, axis = 0))
+        else:
+            for wnds in wnds_day:
+                wnd_acc.update(wnds)
 
-    wnd_vars = [[x for x in y if len(x) > 0] for y in month_var_wnds]
-    stats = sum(wnd_vars, month_mean_wnds)
-    wnd_stats = np.zeros((len(stats),) + month_mean_wnds[0].shape)
-    for i in range(len(stats)):
-        wnd_stats[i, :, :] = stats[i]
+    # Means, followed by the lower triangle of the covariance matrix.
+    month_mean_wnds = wnd_acc.get_mean()
+    month_cov_wnds = wnd_acc.get_cov(ddof = 0, ddof_cov = 1)
+    i_lower, j_lower = np.tril_indices(month_mean_wnds.shape[0])
+    wnd_stats = np.concatenate([month_mean_wnds, month_cov_wnds[i_lower, j_lower]], axis = 0)
 
     wnd_stats = xr.DataArray(
             data = wnd_stats,
@@ -234,4 +265,3 @@ def calc_wnd_stat(ua, va, dt):
                 lat=(ua[input.get_lat_key()].values)))
 
     return wnd_stats
-
@@ -28,12 +28,13 @@ class TC_Basin:
 
     """
     Returns true if the position is within dx degrees of the basin bounds.
+    clon and clat can be scalars or arrays of positions.
     """
     def in_basin(self, clon, clat, dx):
         lon_min, lat_min, lon_max, lat_max = self.get_bounds()
 
-        is_in_basin = ((lon_min + dx) < clon < (lon_max - dx) and
-                       (lat_min + dx) < clat < (lat_max - dx))
+        is_in_basin = (((lon_min + dx) < clon) & (clon < (lon_max - dx)) &
+                       ((lat_min + dx) < clat) & (clat < (lat_max - dx)))
         return(is_in_basin)
     """
     Returns the lower left, and upper right coordinates of the longitude
@@ -3,19 +3,22 @@
 """
 @author: jzlin@mit.edu
 """
-import dask
+import concurrent.futures
 import datetime
+import functools
+import json
 import numpy as np
 import os
+import shutil
 import xarray as xr
 import time
 
 #import namelist
-from intensity import coupled_fast, ocean
+from intensity import coupled_fast, geo, ocean
 from thermo import calc_thermo
 from track import env_wind
 from wind import tc_wind
-from util import basins, input, mat
+from util import basins, input, instrument, mat, month_cache, output, static_fields, util
 
 #for the namelist
 import importlib.util
@@ -50,7 +53,7 @@ def get_fn_tracks(b,namelist):
                namelist.start_year, namelist.start_month,
                namelist.end_year, namelist.end_month)
     fn_trk = '%s/%s/tracks_%s_%s_%d%02d_%d%02d.nc' % fn_args
-    return(fn_trk)
+    return(output.get_fn(fn_trk))
 
 """
 Adds a number to the end of fn_trk if the file exists.
@@ -59,78 +62,145 @@ Used when running multiple simulations under the same configuration.
 def fn_tracks_duplicates(fn_trk):
     f_int = 0
     fn_trk_out = fn_trk
+    fn_base, fn_ext = os.path.splitext(fn_trk)
     while os.path.exists(fn_trk_out):
-        fn_trk_out = fn_trk.rstrip('.nc') + '_e%d.nc' % f_int
+        fn_trk_out = fn_base + '_e%d%s' % (f_int, fn_ext)
         f_int += 1
     return fn_trk_out
 
 """
-Generates "n_tracks" number of tropical cyclone tracks, in basin
-described by "b" (can be global), in the year.
+Reads the mask of basin "basin_id" from the land mask directory,
+through the store of static fields. Returns (lon, lat, mask).
 """
-def run_tracks(year, n_tracks, b, iteration, namelist):
-    # Load thermodynamic and ocean variables.
-    fn_th = calc_thermo.get_fn_thermo()
-    ds = xr.open_dataset(fn_th)
-    dt_year_start = datetime.datetime(year-1, 12, 31)
-    dt_year_end = datetime.datetime(year, 12, 31)
-    dt_bounds = input.convert_from_datetime(ds, [dt_year_start, dt_year_end])
-    ds = ds.sel(time=slice(dt_bounds[0], dt_bounds[1])).load()
-    lon = ds['lon'].data
-    lat = ds['lat'].data
-    mld = ocean.mld_climatology(year, basins.TC_Basin('GL'))
-    strat = ocean.strat_climatology(year, basins.TC_Basin('GL'))
-
-    # Make sure latitude is increasing.
-    vpot = ds['vmax'] * namelist.PI_reduc * np.sqrt(namelist.Ck / namelist.Cd)
-    rh_mid = ds['rh_mid']
-    chi = ds['chi']
-    if (lat[0] - lat[1]) > 0:
-        vpot = vpot.reindex({'lat': lat[::-1]})
-        rh_mid = rh_mid.reindex({'lat': lat[::-1]})
-        chi = chi.reindex({'lat': lat[::-1]})
-        lat = lat[::-1]
+def read_basin_mask(land_dir, basin_id):
+    fields = static_fields.get_fields('%s_%s' % (os.path.basename(land_dir), basin_id),
+                                      f'{land_dir}/{basin_id}.nc', ['lon', 'lat', 'basin'])
+    return (fields['lon'], fields['lat'], fields['basin'])
+
+"""
+Returns the indices of the (increasing) grid x that are needed to
+interpolate between x_min and x_max, including the grid points on
+either side of the interval.
+"""
+def _seed_grid_idxs(x, x_min, x_max):
+    idx_min = max(np.searchsorted(x, x_min, side = 'right') - 1, 0)
+    idx_max = min(np.searchsorted(x, x_max, side = 'left') + 1, x.size)
+    idx_max = max(idx_max, idx_min + 2)
+    return np.arange(idx_min, idx_max)
+
+"""
+Loads the fields needed to generate tracks in basin "basin_id" in the year:
+the basin masks on the part of the grid where seeds are drawn, and the
+thermodynamic fields of each month, in the Coupled_FAST objects and the
+interpolants of the initial m. The fields are set up once per year in each
+process, and are shared by all of the batches of storms of the year that
+the process runs. Returns (basin_ids, b_bounds, lat_min, lat_max, f_masks,
+cpl_fast, m_init_fx).
+"""
+@functools.lru_cache(maxsize = 1)
+def _setup_year(year, basin_id, iteration, namelist):
+    b = basins.TC_Basin(basin_id)
 
     # === Load land mask directory for the current iteration ===
+    t_start = instrument.tic()
     land_dir = f'land_{iteration}'
 
-    # Load the basin bounds and genesis points.
+    # Load the basin bounds and genesis points. The mask of the basin and the
+    # masks of all of the basins are interpolated together, on the part of
+    # the grid where seeds are drawn.
     basin_ids = np.array(sorted([k for k in namelist.basin_bounds if k != 'GL']))
-    f_basins = {}
-    for basin_id in basin_ids:
-        ds_b = xr.open_dataset(f'{land_dir}/{basin_id}.nc')
-        basin_mask = ds_b['basin']
-        f_basins[basin_id] = mat.interp2_fx(basin_mask['lon'], basin_mask['lat'], basin_mask)
-
-    # In case basin is "GL", we load again.
-    ds_b = xr.open_dataset(f'{land_dir}/{b.basin_id}.nc')
-    basin_mask = ds_b['basin']
-    f_b = mat.interp2_fx(basin_mask['lon'], basin_mask['lat'], basin_mask)
     b_bounds = b.get_bounds()
-    
-    
+    lat_min = 3 if np.sign(b_bounds[1]) >= 0 else -45
+    lat_max = 45 if np.sign(b_bounds[3]) >= 0 else -3
+    lon_m, lat_m, basin_mask = read_basin_mask(land_dir, b.basin_id)
+    basin_masks = [basin_mask] + [read_basin_mask(land_dir, basin_id)[2] for basin_id in basin_ids]
+    lon_idxs = _seed_grid_idxs(lon_m, b_bounds[0], b_bounds[2])
+    lat_idxs = _seed_grid_idxs(lat_m, min(b_bounds[1], lat_min), max(b_bounds[3], lat_max))
+    f_masks = mat.Interp2Stack(lon_m[lon_idxs], lat_m[lat_idxs],
+                               np.stack(basin_masks)[:, lat_idxs, :][:, :, lon_idxs])
+    instrument.toc('read_inputs', t_start)
+
     # To randomly seed in both space and time, load data for each month in the year.
     cpl_fast = [0] * 12
     m_init_fx = [0] * 12
-    n_seeds = np.zeros((len(basin_ids), 12))
     T_s = namelist.total_track_time_days * 24 * 60 * 60     # total time to run tracks
     fn_wnd_stat = env_wind.get_env_wnd_fn()
-    ds_wnd = xr.open_dataset(fn_wnd_stat)
-    for i in range(12):
-        dt_month = datetime.datetime(year, i + 1, 15)
-        ds_dt_month = input.convert_from_datetime(ds_wnd, [dt_month])[0]
-        vpot_month = np.nan_to_num(vpot.interp(time = ds_dt_month).data, 0)
-        rh_mid_month = rh_mid.interp(time = ds_dt_month).data
-        chi_month = chi.interp(time = ds_dt_month).data
-        chi_month[np.isnan(chi_month)] = 5
-        m_init_fx[i] = mat.interp2_fx(lon, lat, rh_mid_month)
+    ds_wnd = env_wind.open_env_wnd_fn(fn_wnd_stat)
+    fn_th = calc_thermo.get_fn_thermo()
+
+    """
+    Returns the thermodynamic and ocean fields of month i, on the basin grid
+    of cpl_fast[i], and the relative humidity on the global grid. The ocean
+    climatologies are read once, the first time a month is not in the cache.
+    """
+    ocean_clim = []
+    def thermo_month(i, dt_month):
+        if len(ocean_clim) == 0:
+            ocean_clim.append(ocean.mld_climatology(year, basins.TC_Basin('GL')))
+            ocean_clim.append(ocean.strat_climatology(year, basins.TC_Basin('GL')))
+        mld, strat = ocean_clim
+        lon, lat, vmax_month, chi_month, rh_mid_month = calc_thermo.read_thermo_month(dt_month)
+        vpot_month = np.nan_to_num(vmax_month * namelist.PI_reduc * np.sqrt(namelist.Ck / namelist.Cd), 0)
+        chi_month = np.where(np.isnan(chi_month), 5, chi_month)
         chi_month = np.maximum(np.minimum(np.exp(np.log(chi_month + 1e-3) + namelist.log_chi_fac) + namelist.chi_fac, 5), 1e-5)
 
         mld_month = mat.interp_2d_grid(mld['lon'], mld['lat'], np.nan_to_num(mld[:, :, i]), lon, lat)
         strat_month = mat.interp_2d_grid(strat['lon'], strat['lat'], np.nan_to_num(strat[:, :, i]), lon, lat)
+        lon_b, lat_b, fields_b = cpl_fast[i].basin_fields(lon, lat, chi_month, vpot_month, mld_month, strat_month)
+        return dict(lon = lon, lat = lat, rh_mid = rh_mid_month,
+                    lon_b = lon_b, lat_b = lat_b, fields_b = fields_b)
+
+    t_start = instrument.tic()
+    for i in range(12):
+        dt_month = datetime.datetime(year, i + 1, 15)
+        ds_dt_month = input.convert_from_datetime(ds_wnd, [dt_month])[0]
         cpl_fast[i] = coupled_fast.Coupled_FAST(fn_wnd_stat, b, ds_dt_month,
                                                 namelist.output_interval_s, T_s)
-        cpl_fast[i].init_fields(lon, lat, chi_month, vpot_month, mld_month, strat_month)
+        instrument.count('wnd_cov_repaired', cpl_fast[i].n_wnd_cov_repaired)
+
+        key_parts = [month_cache.file_id(fn_th), month_cache.file_id(ocean.get_fn_mld()),
+                     month_cache.file_id(ocean.get_fn_strat()), dt_month, b.basin_id, b.basin_bounds,
+                     namelist.PI_reduc, namelist.Ck, namelist.Cd, namelist.log_chi_fac, namelist.chi_fac]
+        x = month_cache.get_arrays('thermo', key_parts, lambda: thermo_month(i, dt_month))
+        cpl_fast[i].init_basin_fields(x['lon_b'], x['lat_b'], x['fields_b'])
+        m_init_fx[i] = mat.interp2_fx(x['lon'], x['lat'], x['rh_mid'])
+    instrument.toc('setup_months', t_start)
+    return (basin_ids, b_bounds, lat_min, lat_max, f_masks, cpl_fast, m_init_fx)
+
+"""
+Returns the random stream of simulation "iteration" under namelist.rng_seed.
+If namelist.rng_seed is None, new entropy is drawn for the stream.
+"""
+def get_sim_seed_seq(iteration, namelist):
+    return util.child_seed_seq(np.random.SeedSequence(namelist.rng_seed), iteration)
+
+"""
+Returns the random stream of batch k of the storms of the year, below the
+stream of the simulation, seed_seq. This is the stream run_downscaling
+passes to run_tracks, so a batch of a saved year is reproduced with
+run_tracks(year, n_k, b, iteration, namelist, get_batch_seed_seq(seed_seq, year, k)),
+where seed_seq is rebuilt from the rng_entropy and rng_spawn_key saved in
+the tracks file, and n_k is the number of storms of the batch.
+"""
+def get_batch_seed_seq(seed_seq, year, k):
+    return util.child_seed_seq(seed_seq, year, k)
+
+"""
+Generates "n_tracks" number of tropical cyclone tracks, in basin
+described by "b" (can be global), in the year. Random numbers are drawn
+from the stream seed_seq (a SeedSequence), which run_downscaling sets to
+the stream of each batch of storms in the year (see get_batch_seed_seq).
+"""
+def run_tracks(year, n_tracks, b, iteration, namelist, seed_seq):
+    # Seeds are drawn from the stream of the batch, and each storm has
+    # its own stream, keyed by the order in which the seeds are drawn.
+    rng = np.random.default_rng(seed_seq)
+    instrument.enable(namelist.instrument)
+    t_run = instrument.tic()
+
+    (basin_ids, b_bounds, lat_min, lat_max,
+     f_masks, cpl_fast, m_init_fx) = _setup_year(year, b.basin_id, iteration, namelist)
+    n_seeds = np.zeros((len(basin_ids), 12))
 
     # Output vectors.
     nt = 0
@@ -143,105 +213,370 @@ def run_tracks(year, n_tracks, b, iteration, namelist):
     tc_env_wnds = np.full((n_tracks, n_steps, cpl_fast[0].nWLvl), np.nan)
     tc_month = np.full(n_tracks, np.nan)
     tc_basin = np.full(n_tracks, "", dtype = 'U2')
-    while nt < n_tracks:
-        seed_passed = False
-        while not seed_passed:
-            # Random genesis location for the seed (weighted by area).
-            # Ensure that it is located within the basin and over ocean.
-            # Genesis is [3, 45] latitude for each basin.
-            lat_min = 3 if np.sign(b_bounds[1]) >= 0 else -45
-            lat_max = 45 if np.sign(b_bounds[3]) >= 0 else -3
-            y_min = np.sin(np.pi / 180 * lat_min)
-            y_max = np.sin(np.pi / 180 * lat_max)
-            gen_lon = np.random.uniform(b_bounds[0], b_bounds[2], 1)[0]
-            gen_lat = np.arcsin(np.random.uniform(y_min, y_max, 1)[0]) * 180 / np.pi
-            while f_b.ev(gen_lon, gen_lat) < 1e-2:
-                gen_lon = np.random.uniform(b_bounds[0], b_bounds[2], 1)[0]
-                gen_lat = np.random.uniform(b_bounds[1], b_bounds[3], 1)[0]
-
-            # Randomly seed the month.
-            month_seed = np.random.randint(1, 13)
-            fast = cpl_fast[month_seed - 1]
-
-            # Find basin of genesis location and switch H_bl.
-            basin_val = np.zeros(len(basin_ids))
-            for (b_idx, basin_id) in enumerate(basin_ids):
-                basin_val[b_idx] = f_basins[basin_id].ev(gen_lon, gen_lat)
-            basin_idx = np.argmax(basin_val)
+    """
+    Draws random genesis locations. A location is first drawn uniformly
+    in area between lat_min and lat_max. If it is not in the basin, it is
+    redrawn uniformly in longitude and latitude within the basin bounds,
+    until it is in the basin.
+    """
+    def draw_locations(n):
+        gen_lon = rng.uniform(b_bounds[0], b_bounds[2], n)
+        gen_lat = np.arcsin(rng.uniform(np.sin(np.pi / 180 * lat_min),
+                                              np.sin(np.pi / 180 * lat_max), n)) * 180 / np.pi
+        redraw_idxs = np.nonzero(f_masks.ev(gen_lon, gen_lat)[0] < 1e-2)[0]
+        while redraw_idxs.size > 0:
+            n_draw = max(4 * redraw_idxs.size, 256)
+            r_lon = rng.uniform(b_bounds[0], b_bounds[2], n_draw)
+            r_lat = rng.uniform(b_bounds[1], b_bounds[3], n_draw)
+            in_b = np.nonzero(f_masks.ev(r_lon, r_lat)[0] >= 1e-2)[0][0:redraw_idxs.size]
+            gen_lon[redraw_idxs[0:in_b.size]] = r_lon[in_b]
+            gen_lat[redraw_idxs[0:in_b.size]] = r_lat[in_b]
+            redraw_idxs = redraw_idxs[in_b.size:]
+        return (gen_lon, gen_lat)
+
+    """
+    Draws n random seeds that pass the genesis criteria. Candidates are drawn
+    and tested in batches, but are processed in the order that they are drawn,
+    so each seed is returned with the number of seeds in each basin and month
+    drawn to obtain it (including itself).
+    """
+    lat_vort_power = np.array([namelist.lat_vort_power[x] for x in basin_ids])
+    n_cand_total = [0, 0]           # candidates drawn, and seeds that passed
+    def draw_seeds(n):
+        gen_lon = np.zeros(n); gen_lat = np.zeros(n)
+        month_seed = np.zeros(n, dtype = int); basin_idx = np.zeros(n, dtype = int)
+        seed_counts = np.zeros((n,) + n_seeds.shape)
+        counts_pending = np.zeros(n_seeds.size)
+        n_pass = 0
+        while n_pass < n:
+            frac_pass = (n_cand_total[1] + 1) / (n_cand_total[0] + 1)
+            n_cand = int(min(max(2 * (n - n_pass) / frac_pass, 1024), 2**18))
+            c_lon, c_lat = draw_locations(n_cand)
+            c_month = rng.integers(1, 13, n_cand)
+
+            # Find basin of genesis location.
+            basin_val = f_masks.ev(c_lon, c_lat)[1:]
+            c_basin = np.argmax(basin_val, axis = 0)
 
             # Discard seeds with increasing probability equatorwards.
             # If PI is less than 35 m/s, do not integrate, but treat as a seed.
-            pi_gen = float(fast.f_vpot.ev(gen_lon, gen_lat))
-            lat_vort_power = namelist.lat_vort_power[basin_ids[basin_idx]]
-            prob_lowlat = np.power(np.minimum(np.maximum((np.abs(gen_lat) - namelist.lat_vort_fac) / 12.0, 0), 1), lat_vort_power)
-            rand_lowlat = np.random.uniform(0, 1, 1)[0]
-            if (np.nanmax(basin_val) > 1e-3) and (rand_lowlat < prob_lowlat):
-                n_seeds[basin_idx, month_seed-1] += 1
-                if (pi_gen > 35):
-                    seed_passed = True
+            prob_lowlat = np.power(np.minimum(np.maximum((np.abs(c_lat) - namelist.lat_vort_fac) / 12.0, 0), 1),
+                                   lat_vort_power[c_basin])
+            rand_lowlat = rng.uniform(0, 1, n_cand)
+            is_seed = (np.nanmax(basin_val, axis = 0) > 1e-3) & (rand_lowlat < prob_lowlat)
+            pi_gen = np.zeros(n_cand)
+            for month in np.unique(c_month[is_seed]):
+                idxs = np.nonzero(is_seed & (c_month == month))[0]
+                pi_gen[idxs] = cpl_fast[month - 1].interp_vpot(c_lon[idxs], c_lat[idxs])
+            is_pass = is_seed & (pi_gen > 35)
+
+            # Candidates after the n-th passing seed are not used.
+            pass_idxs = np.nonzero(is_pass)[0][0:(n - n_pass)]
+            n_used = pass_idxs[-1] + 1 if pass_idxs.size == n - n_pass else n_cand
+            n_cand_total[0] += n_used
+            n_cand_total[1] += pass_idxs.size
+
+            # Accumulate the seeds, in order, onto the passing seed that ends each run.
+            seed_idxs = np.nonzero(is_seed[0:n_used])[0]
+            seed_run = np.searchsorted(pass_idxs, seed_idxs)
+            counts = np.zeros((pass_idxs.size + 1, n_seeds.size))
+            np.add.at(counts, (seed_run, c_basin[seed_idxs] * 12 + c_month[seed_idxs] - 1), 1)
+            counts[0] += counts_pending
+            counts_pending = counts[-1]
+
+            if instrument.is_enabled():
+                for (name, is_x) in [('seed_candidates', np.ones(n_used, dtype = bool)),
+                                     ('seeds', is_seed[0:n_used]),
+                                     ('seeds_rejected_pi', is_seed[0:n_used] & ~is_pass[0:n_used])]:
+                    n_x = np.bincount(c_basin[0:n_used][is_x], minlength = basin_ids.size)
+                    for b_idx in np.flatnonzero(n_x):
+                        instrument.count(name, n_x[b_idx], basin_ids[b_idx])
+
+            idxs = slice(n_pass, n_pass + pass_idxs.size)
+            gen_lon[idxs] = c_lon[pass_idxs]
+            gen_lat[idxs] = c_lat[pass_idxs]
+            month_seed[idxs] = c_month[pass_idxs]
+            basin_idx[idxs] = c_basin[pass_idxs]
+            seed_counts[idxs] = counts[0:pass_idxs.size].reshape((pass_idxs.size,) + n_seeds.shape)
+            n_pass += pass_idxs.size
 
         # Set the initial value of m to a function of relative humidity.
-        v_init = namelist.seed_v_init_ms + np.random.randn(1)[0]
-        rh_init = float(m_init_fx[month_seed-1].ev(gen_lon, gen_lat))
+        v_init = namelist.seed_v_init_ms + rng.standard_normal(n)
+        rh_init = np.zeros(n)
+        for month in np.unique(month_seed):
+            idxs = month_seed == month
+            rh_init[idxs] = m_init_fx[month - 1].ev(gen_lon[idxs], gen_lat[idxs])
         m_init = np.maximum(0, namelist.f_mInit(rh_init))
-        fast.h_bl = namelist.atm_bl_depth[basin_ids[basin_idx]]
-        res = fast.gen_track(gen_lon, gen_lat, v_init, m_init)
-
-        is_tc = False
-        if res != None:
-            track_lon = res.y[0]
-            track_lat = res.y[1]
-            v_track = res.y[2]
-            m_track = res.y[3]
-
-            # If the TC has not reached the threshold m/s after 2 days, throw it away.
-            # The TC must also reach the genesis threshold during it's entire lifetime.
-            v_thresh = namelist.seed_v_threshold_ms
-            v_thresh_2d = np.interp(2*24*60*60, res.t, v_track.flatten())
-            is_tc = np.logical_and(np.any(v_track >= v_thresh), v_thresh_2d >= namelist.seed_v_2d_threshold_ms)
-
-        if is_tc:
-            n_time = len(track_lon)
-            tc_lon[nt, 0:n_time] = track_lon
-            tc_lat[nt, 0:n_time] = track_lat
-            tc_v[nt, 0:n_time] = v_track
-            tc_m[nt, 0:n_time] = m_track
-
-            # Redudant calculation, but since environmental winds are not part
-            # of the time-integrated state (a parameter), we recompute it.
-            # TODO: Remove this redudancy by pre-caclulating the env. wind.
-            for i in range(len(track_lon)):
-                tc_env_wnds[nt, i, :] = fast._env_winds(track_lon[i], track_lat[i], fast.t_s[i])     
-            vmax = tc_wind.axi_to_max_wind(track_lon, track_lat, fast.dt_track,
-                                           v_track, tc_env_wnds[nt, 0:n_time, :])
-            if np.nanmax(vmax) >= namelist.seed_vmax_threshold_ms:
-                tc_vmax[nt, 0:n_time] = vmax
-                tc_month[nt] = month_seed
-                tc_basin[nt] = basin_ids[basin_idx]
-                nt += 1
-    return((tc_lon, tc_lat, tc_v, tc_m, tc_vmax, tc_env_wnds, tc_month, tc_basin, n_seeds))
+        return (gen_lon, gen_lat, v_init, m_init, month_seed, basin_idx, seed_counts)
+
+    n_used = 0
+    n_drawn = 0
+    while nt < n_tracks:
+        # The batched integrator advances a batch of seeds together. Size the
+        # batch by the fraction of seeds that have become tracks so far.
+        n_batch = 1
+        if namelist.track_integrator == 'batched':
+            frac_tc = (nt + 1) / (n_used + 1)
+            n_batch = int(min(namelist.n_storms_batch, np.ceil(1.5 * (n_tracks - nt) / frac_tc)))
+        t_start = instrument.tic()
+        gen_lon, gen_lat, v_init, m_init, month_seed, basin_idx, seed_counts = draw_seeds(n_batch)
+        instrument.toc('seeding', t_start)
+        rngs = [np.random.default_rng(util.child_seed_seq(seed_seq, n_drawn + i)) for i in range(n_batch)]
+        n_drawn += n_batch
+        h_bl = np.array([namelist.atm_bl_depth[basin_ids[x]] for x in basin_idx])
+
+        # Switch H_bl to that of the basin of genesis.
+        t_start = instrument.tic()
+        res = [None] * n_batch
+        if namelist.track_integrator == 'batched':
+            for month in np.unique(month_seed):
+                idxs = np.nonzero(month_seed == month)[0]
+                res_month = cpl_fast[month - 1].gen_tracks(gen_lon[idxs], gen_lat[idxs], v_init[idxs],
+                                                           m_init[idxs], h_bl[idxs], [rngs[i] for i in idxs])
+                for (i, res_i) in zip(idxs, res_month):
+                    res[i] = res_i
+        else:
+            for i in range(n_batch):
+                fast = cpl_fast[month_seed[i] - 1]
+                fast.h_bl = h_bl[i]
+                res[i] = fast.gen_track(gen_lon[i], gen_lat[i], v_init[i], m_init[i], rngs[i])
+        instrument.toc('integration', t_start)
+
+        # Process the seeds in the order they were drawn. Seeds drawn after
+        # the last track is found are not counted.
+        for i in range(n_batch):
+            if nt >= n_tracks:
+                break
+            n_seeds += seed_counts[i]
+            n_used += 1
+            fast = cpl_fast[month_seed[i] - 1]
+            basin_id = basin_ids[basin_idx[i]]
+
+            is_tc = False
+            if res[i] is not None:
+                track_lon = res[i].y[0]
+                track_lat = res[i].y[1]
+                v_track = res[i].y[2]
+                m_track = res[i].y[3]
+
+                # If the TC has not reached the threshold m/s after 2 days, throw it away.
+                # The TC must also reach the genesis threshold during it's entire lifetime.
+                v_thresh = namelist.seed_v_threshold_ms
+                v_thresh_2d = np.interp(2*24*60*60, res[i].t, v_track.flatten())
+                is_tc = np.logical_and(np.any(v_track >= v_thresh), v_thresh_2d >= namelist.seed_v_2d_threshold_ms)
+                if not is_tc:
+                    instrument.count('tracks_rejected_v_threshold', 1, basin_id)
+            else:
+                instrument.count('tracks_rejected_vent', 1, basin_id)
+
+            if is_tc:
+                n_time = len(track_lon)
+                tc_lon[nt, 0:n_time] = track_lon
+                tc_lat[nt, 0:n_time] = track_lat
+                tc_v[nt, 0:n_time] = v_track
+                tc_m[nt, 0:n_time] = m_track
+
+                tc_env_wnds[nt, 0:n_time, :] = res[i].env_wnds
+                t_start = instrument.tic()
+                vmax = tc_wind.axi_to_max_wind(track_lon, track_lat, fast.dt_track,
+                                               v_track, tc_env_wnds[nt, 0:n_time, :])
+                instrument.toc('max_wind', t_start)
+                if np.nanmax(vmax) >= namelist.seed_vmax_threshold_ms:
+                    tc_vmax[nt, 0:n_time] = vmax
+                    tc_month[nt] = month_seed[i]
+                    tc_basin[nt] = basin_id
+                    nt += 1
+                    instrument.count('tracks_accepted', 1, basin_id)
+                else:
+                    instrument.count('tracks_rejected_vmax', 1, basin_id)
+    instrument.toc('run_tracks', t_run)
+    return((tc_lon, tc_lat, tc_v, tc_m, tc_vmax, tc_env_wnds, tc_month, tc_basin, n_seeds,
+            instrument.collect()))
+
+"""
+Returns the directory where the years of simulation "iteration" in basin
+"b" are saved as they finish, until the tracks file is written.
+"""
+def get_dir_shards(b, iteration, namelist):
+    return('%s_shards_%02d' % (os.path.splitext(get_fn_tracks(b, namelist))[0], iteration))
+
+"""
+Reads the manifest of the shard directory, or returns None if there is none.
+"""
+def read_manifest(dir_shards):
+    fn_manifest = '%s/manifest.json' % dir_shards
+    if not os.path.exists(fn_manifest):
+        return None
+    with open(fn_manifest, 'r') as f:
+        return json.load(f)
+
+"""
+Writes the manifest of the shard directory to a temporary file and renames
+it, so that the manifest is never partially written.
+"""
+def _write_manifest(dir_shards, manifest):
+    fn_tmp = '%s/manifest.json.tmp' % dir_shards
+    with open(fn_tmp, 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(fn_tmp, '%s/manifest.json' % dir_shards)
+
+"""
+Returns the settings of the namelist that identify the random streams of a
+run (the seed, and the name of the namelist), as saved in the manifest.
+"""
+def _get_manifest_seed(namelist):
+    return dict(rng_seed = json.loads(json.dumps(namelist.rng_seed)), namelist = namelist.__name__)
+
+"""
+Returns the random stream saved in the manifest of simulation "iteration"
+in basin "basin_id", or None if the simulation has no shards. A restarted
+simulation resumes from its saved stream, so that it draws the same numbers
+of tracks, and the years that are computed again match the saved years.
+Raises a ValueError if the shards were made with another rng_seed or
+namelist, rather than mixing their stream with the current settings.
+"""
+def resume_seed_seq(basin_id, iteration, namelist):
+    dir_shards = get_dir_shards(basins.TC_Basin(basin_id), iteration, namelist)
+    manifest = read_manifest(dir_shards)
+    if manifest is None:
+        return None
+    manifest_seed = _get_manifest_seed(namelist)
+    if {k: manifest.get(k) for k in manifest_seed} != manifest_seed:
+        raise ValueError('The shards in %s were made with rng_seed = %s (namelist %s), but the namelist has '
+                         'rng_seed = %s (namelist %s). Restore the settings to resume the run, or remove the '
+                         'directory to start a new run.' % (dir_shards, manifest.get('rng_seed'), manifest.get('namelist'),
+                                                             manifest_seed['rng_seed'], manifest_seed['namelist']))
+    return np.random.SeedSequence(manifest['rng_entropy'], spawn_key = tuple(manifest['rng_spawn_key']))
+
+# Variables of a shard, in the order of the output of run_tracks.
+_shard_vars = [('lon_trks', ['n_trk', 'time']), ('lat_trks', ['n_trk', 'time']),
+               ('v_trks', ['n_trk', 'time']), ('m_trks', ['n_trk', 'time']),
+               ('vmax_trks', ['n_trk', 'time']), ('env_wnds_trks', ['n_trk', 'time', 'level']),
+               ('tc_month', ['n_trk']), ('tc_basins', ['n_trk']),
+               ('seeds_per_month', ['basin', 'month'])]
+
+"""
+Saves the output of a year (the output of run_tracks, summed over the
+batches of the year) as a shard. The shard is written to a temporary
+file and renamed, so that a shard that exists is complete.
+"""
+def _write_shard(fn_shard, out_yr):
+    ds = xr.Dataset(data_vars = {var: (dims, x) for ((var, dims), x) in zip(_shard_vars, out_yr)},
+                    attrs = dict(instrument = json.dumps(out_yr[9])))
+    fn_tmp = '%s.tmp%s' % os.path.splitext(fn_shard)
+    ds.to_netcdf(fn_tmp, mode = 'w')
+    os.replace(fn_tmp, fn_shard)
+
+"""
+Reads a shard, and returns it in the same form as the output of run_tracks.
+"""
+def _read_shard(fn_shard):
+    with xr.open_dataset(fn_shard) as ds:
+        out_yr = tuple([ds[var].data.astype('U2') if var == 'tc_basins' else ds[var].data
+                        for (var, _) in _shard_vars])
+        return out_yr + (json.loads(ds.attrs['instrument']),)
+
+"""
+Runs run_tracks in a worker of the process pool. The namelist is passed
+by name, and imported in the worker.
+"""
+def _run_tracks_task(year, n_tracks, basin_id, iteration, namelist_name, seed_seq):
+    namelist = importlib.import_module(namelist_name)
+    return run_tracks(year, n_tracks, basins.TC_Basin(basin_id), iteration, namelist, seed_seq)
 
 """
 Runs the downscaling model in basin "basin_id" according to the
-settings in the namelist.txt file.
+settings in the namelist.txt file. Random numbers are drawn from the
+stream of the simulation, seed_seq (by default, the stream of simulation
+"iteration" under namelist.rng_seed). Each batch of storms in each year
+has its own stream.
 """
-def run_downscaling(basin_id, n_TC_per_year, iteration, namelist):
+def run_downscaling(basin_id, n_TC_per_year, iteration, namelist, seed_seq = None):
     n_tracks = n_TC_per_year
     n_procs = namelist.n_procs
     b = basins.TC_Basin(basin_id)
     yearS = namelist.start_year
     yearE = namelist.end_year
 
-    lazy_results = []; f_args = [];
+    # If namelist.rng_seed is None, the entropy of the run is drawn here. It is
+    # saved in the output, so the run (or any year of it) can be reproduced.
+    if seed_seq is None:
+        seed_seq = get_sim_seed_seq(iteration, namelist)
+
+    # Load the static fields once in this process, before the years are
+    # distributed, so that the workers map the stored fields instead of
+    # reading the source files.
+    land_dir = f'land_{iteration}'
+    geo.read_land_bathy(b)
+    ocean.mld_climatology(yearS, basins.TC_Basin('GL'))
+    ocean.strat_climatology(yearS, basins.TC_Basin('GL'))
+    for basin_id in set([b.basin_id] + [k for k in namelist.basin_bounds if k != 'GL']):
+        read_basin_mask(land_dir, basin_id)
+
+    # Years are saved as shards as soon as all of their batches finish. The
+    # manifest records the run and the finished years. A restarted run with
+    # the same stream and numbers of tracks only computes the missing years.
+    dir_shards = get_dir_shards(b, iteration, namelist)
+    os.makedirs(dir_shards, exist_ok = True)
+    manifest_run = dict(basin = b.basin_id, iteration = iteration,
+                        start_year = yearS, end_year = yearE,
+                        n_tracks = [int(x) for x in n_tracks[0:(yearE-yearS+1)]],
+                        n_tracks_per_task = namelist.n_tracks_per_task,
+                        rng_entropy = seed_seq.entropy,
+                        rng_spawn_key = [int(x) for x in seed_seq.spawn_key],
+                        **_get_manifest_seed(namelist))
+    manifest = read_manifest(dir_shards)
+    if manifest is not None and {k: manifest.get(k) for k in manifest_run} != manifest_run:
+        print('Discarding the shards of a different run in %s' % dir_shards)
+        manifest = None
+    if manifest is None:
+        for fn in os.listdir(dir_shards):
+            os.remove('%s/%s' % (dir_shards, fn))
+        manifest = dict(manifest_run, years_done = [])
+        _write_manifest(dir_shards, manifest)
+    fn_shard = lambda yr: '%s/tracks_%d.nc' % (dir_shards, yr)
+    if len(manifest['years_done']) > 0:
+        print('Resuming from %s, finished years: %s' % (dir_shards, manifest['years_done']))
+
+    # Split the tracks of each year into batches of storms, which are
+    # balanced over the process pool. The batches are submitted in order
+    # of year, so that each worker sets up few years. Each batch has its
+    # own stream, so the tracks do not depend on the scheduling.
+    tasks = []; f_args = [];
     for yr in range(yearS, yearE+1):
-        lazy_result = dask.delayed(run_tracks)(yr, n_tracks[yr-yearS], b, iteration, namelist)
+        n_yr = n_tracks[yr-yearS]
+        n_batches = max(int(np.ceil(n_yr / namelist.n_tracks_per_task)), 1)
+        if yr not in manifest['years_done']:
+            for k in range(n_batches):
+                tasks.append((yr, n_yr // n_batches + int(k < n_yr % n_batches), k))
         print('yr - yearS = ' , yr - yearS)
-        print('n_tracks = ', n_tracks[yr-yearS])
+        print('n_tracks = ', n_yr)
         f_args.append((yr, n_tracks, b))
-        lazy_results.append(lazy_result)
 
     s = time.time()
-    out = dask.compute(*lazy_results, scheduler = 'processes', num_workers = n_procs)
+    out_batches = {yr: [None] * len([t for t in tasks if t[0] == yr]) for (yr, _, _) in tasks}
+    task_args = [(yr, n_k, b.basin_id, iteration, namelist.__name__, get_batch_seed_seq(seed_seq, yr, k))
+                 for (yr, n_k, k) in tasks]
+    # Only a few batches per process are in flight, and the batches of a
+    # year are dropped once the year is saved.
+    with concurrent.futures.ProcessPoolExecutor(max_workers = n_procs) as pool:
+        for (i, out_k) in util.pool_imap_unordered(pool, _run_tracks_task, task_args, 2 * n_procs):
+            yr, _, k = tasks[i]
+            out_batches[yr][k] = out_k
+            del out_k
+            if any([x is None for x in out_batches[yr]]):
+                continue
+
+            # Reassemble the batches of the year, in order, and save the year.
+            out_yr = out_batches.pop(yr)
+            _write_shard(fn_shard(yr), tuple([np.concatenate([x[j] for x in out_yr], axis = 0) for j in range(8)]) +
+                                       (np.sum([x[8] for x in out_yr], axis = 0),
+                                        instrument.aggregate([x[9] for x in out_yr])))
+            manifest['years_done'] = sorted(manifest['years_done'] + [yr])
+            _write_manifest(dir_shards, manifest)
+            del out_yr
+            print('Saved year %d' % yr)
+    out = [_read_shard(fn_shard(yr)) for (yr, _, _) in f_args]
 
     # Process the output and save as a netCDF file.
     tc_lon = np.concatenate([x[0] for x in out], axis = 0)
@@ -261,24 +596,49 @@ def run_downscaling(basin_id, n_TC_per_year, iteration, namelist):
     yr_trks = np.stack([[x[0]] for x in f_args]).flatten()
     basin_ids = sorted([k for k in namelist.basin_bounds if k != 'GL'])
 
-    ds = xr.Dataset(data_vars = dict(lon_trks = (["n_trk", "time"], tc_lon),
-                                     lat_trks = (["n_trk", "time"], tc_lat),
-                                     u250_trks = (["n_trk", "time"], tc_env_wnds[:, :, 0]),
-                                     v250_trks = (["n_trk", "time"], tc_env_wnds[:, :, 1]),
-                                     u850_trks = (["n_trk", "time"], tc_env_wnds[:, :, 2]),
-                                     v850_trks = (["n_trk", "time"], tc_env_wnds[:, :, 3]),
-                                     v_trks = (["n_trk", "time"], tc_v),
-                                     m_trks = (["n_trk", "time"], tc_m),
-                                     vmax_trks = (["n_trk", "time"], tc_vmax),
+    trks = dict(lon_trks = tc_lon, lat_trks = tc_lat,
+                u250_trks = tc_env_wnds[:, :, 0], v250_trks = tc_env_wnds[:, :, 1],
+                u850_trks = tc_env_wnds[:, :, 2], v850_trks = tc_env_wnds[:, :, 3],
+                v_trks = tc_v, m_trks = tc_m, vmax_trks = tc_vmax)
+    trks = {var: x.astype(namelist.tracks_dtype) for (var, x) in trks.items()}
+    attrs = dict(rng_entropy = str(seed_seq.entropy),
+                 rng_spawn_key = str(tuple(seed_seq.spawn_key)),
+                 n_tracks_per_task = namelist.n_tracks_per_task,
+                 output_profile = namelist.output_profile)
+    if namelist.tracks_layout == 'ragged':
+        # CF contiguous ragged array: the points of the tracks are stored one
+        # after another along "obs", and row_size is the number of points of
+        # each track, up to its last valid point.
+        row_size = tc_lon.shape[1] - np.argmax(~np.isnan(tc_lon[:, ::-1]), axis = 1)
+        row_size[np.all(np.isnan(tc_lon), axis = 1)] = 0
+        is_obs = np.arange(tc_lon.shape[1]) < row_size[:, None]
+        data_trks = {var: (["obs"], x[is_obs]) for (var, x) in trks.items()}
+        data_trks['row_size'] = (["n_trk"], row_size.astype(np.int32),
+                                 dict(long_name = 'number of points of each track', sample_dimension = 'obs'))
+        coords_trks = dict(time = (["obs"], np.broadcast_to(ts_output, tc_lon.shape)[is_obs]))
+        attrs['featureType'] = 'trajectory'
+    else:
+        data_trks = {var: (["n_trk", "time"], x) for (var, x) in trks.items()}
+        coords_trks = dict(time = ts_output)
+
+    ds = xr.Dataset(data_vars = dict(**data_trks,
                                      tc_month = (["n_trk"], tc_months),
-                                     tc_basins = (["n_trk"], tc_basins),                                     
+                                     tc_basins = (["n_trk"], tc_basins),
                                      tc_years = (["n_trk"], tc_years),
                                      seeds_per_month = (["year", "basin", "month"], n_seeds)),
-                    coords = dict(n_trk = range(tc_lon.shape[0]), time = ts_output,
-                                  year = yr_trks, basin = basin_ids, month = list(range(1, 13))))
+                    coords = dict(n_trk = range(tc_lon.shape[0]), **coords_trks,
+                                  year = yr_trks, basin = basin_ids, month = list(range(1, 13))),
+                    attrs = attrs)
 
     os.makedirs('%s/%s' % (namelist.base_directory, namelist.exp_name), exist_ok = True)
     fn_trk_out = fn_tracks_duplicates(get_fn_tracks(b,namelist))
-    ds.to_netcdf(fn_trk_out, mode = 'w')
+    output.write_dataset(ds, fn_trk_out, 'tracks')
     print('Saved %s' % fn_trk_out)
+
+    if namelist.instrument:
+        fn_profile = '%s_profile.json' % os.path.splitext(fn_trk_out)[0]
+        instrument.write_sidecar(fn_profile, {yr_trks[i]: out[i][9] for i in range(len(out))},
+                                 dict(basin = b.basin_id, exp_name = namelist.exp_name, fn_tracks = fn_trk_out))
+        print('Saved %s' % fn_profile)
+    shutil.rmtree(dir_shards)
     print(time.time() - s)
\ No newline at end of file
@@ -8,8 +8,14 @@ Utility library for dealing with CMIP6 and reanalysis data files.
 import calendar
 import cftime
 import datetime
+import functools
 import glob
+import json
 import numpy as np
+import operator
+import os
+import pandas as pd
+import weakref
 import xarray as xr
 import namelist
 
@@ -20,27 +26,181 @@ def _open_fns(fns):
         ds = xr.open_mfdataset(fns, concat_dim = "time", combine = "nested", data_vars="minimal")
     return ds
 
+# Input files of the experiments, by (base_directory, exp_prefix).
+_glob_cache = {}
+
+"""
+Returns the input files of the experiment. The files are found once in
+each process, and found again after _clear_file_index (e.g. when a file
+that was found is modified or removed) or when the catalog is modified.
+"""
+def _glob_files(base_directory, exp_prefix):
+    key = (base_directory, exp_prefix)
+    if key not in _glob_cache:
+        _glob_cache[key] = glob.glob('%s/**/*%s*.nc' % (base_directory, exp_prefix), recursive = True)
+    return _glob_cache[key]
+
 def _glob_prefix(var_prefix):
-    fns = glob.glob('%s/**/*%s*.nc' % (namelist.base_directory, namelist.exp_prefix), recursive = True)
+    fns = _glob_files(namelist.base_directory, namelist.exp_prefix)
     fns_var = sorted([x for x in fns if '_%s_' % var_prefix in x])
     if len(fns_var) == 0:
         fns_var = sorted([x for x in fns if '%s_' % var_prefix in x])
     return(fns_var)
 
-def _find_in_timerange(fns, ct_start, ct_end = None):
-    fns_multi = []
-    for fn in fns:
-        ds = xr.open_dataset(fn)
-        time = ds['time']                      # time
-        if ct_start is not None and ct_end is None:
-            if ((ct_start >= time[0]) & (ct_start <= time[-1])):
-                fns_multi.append(fn)
-        else:
-            if ((time >= ct_start) & (time <= ct_end)).any():
-                fns_multi.append(fn)
-        ds.close()
+"""
+Catalog of the input files: the variables, calendar and time range of each
+file, saved as a JSON file in the output directory, so that the files of a
+time range are found without opening every file. Times are in seconds since
+1970-01-01, in the calendar of the file. An entry is read again from its
+file when the size or modification time of the file changes.
+"""
+def get_catalog_fn():
+    return('%s/input_catalog.json' % namelist.output_directory)
+
+"""
+Returns the time t (a datetime, np.datetime64 or cftime datetime, in any
+calendar) in seconds since 1970-01-01 in the calendar t_calendar, from its
+year, month, day and time of day, so that times of any type compare with
+the times of the files. Days that do not exist in the calendar are clipped
+to the last day of the month, as in convert_from_datetime.
+"""
+def _time_to_num(t, t_calendar = 'standard'):
+    if isinstance(t, np.datetime64):
+        t = pd.Timestamp(t)
+    if t_calendar in _days_in_month:
+        n_days = _days_in_month[t_calendar][t.month - 1]
+    else:
+        n_days = calendar.monthrange(t.year, t.month)[1]
+    fields = (t.year, t.month, min(t.day, n_days), t.hour, t.minute, t.second)
+    if t_calendar in ['standard', 'gregorian', 'proleptic_gregorian']:
+        return (datetime.datetime(*fields) - datetime.datetime(1970, 1, 1)).total_seconds()
+    ct = cftime.datetime(*fields, calendar = t_calendar)
+    return float(cftime.date2num(ct, 'seconds since 1970-01-01', calendar = t_calendar))
+
+def _read_catalog(fn_catalog):
+    try:
+        with open(fn_catalog) as f:
+            return json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+"""
+Adds the entries to the catalog file. Entries written by other processes
+in the meantime are kept.
+"""
+def _write_catalog(fn_catalog, entries):
+    catalog = _read_catalog(fn_catalog)
+    catalog.update(entries)
+    os.makedirs(os.path.dirname(os.path.abspath(fn_catalog)), exist_ok = True)
+    fn_tmp = '%s.%d' % (fn_catalog, os.getpid())
+    with open(fn_tmp, 'w') as f:
+        json.dump(dict(version = 1, files = catalog), f, indent = 1)
+    os.replace(fn_tmp, fn_catalog)
+
+def _read_time_range(fn, st):
+    with xr.open_dataset(fn) as ds:
+        time = ds['time'].values
+        calendar = time[0].calendar if isinstance(time[0], cftime.datetime) else 'standard'
+        return dict(mtime = st.st_mtime, size = st.st_size, variables = list(ds.data_vars),
+                    calendar = calendar, time_start = _time_to_num(time[0], calendar),
+                    time_end = _time_to_num(time[-1], calendar))
 
-    return(fns_multi)
+# Index of the files of each variable, with the modification time of the
+# catalog it was built from, by (var_prefix, base_directory, exp_prefix,
+# fn_catalog).
+_var_index_cache = {}
+
+def _get_mtime(fn):
+    try:
+        return os.stat(fn).st_mtime
+    except OSError:
+        return None
+
+"""
+Returns the modification time and size of the file fn, or None if it does
+not exist.
+"""
+def _get_file_id(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+"""
+Forgets the input files and the indices of the variables found in this
+process, so that they are found and built again.
+"""
+def _clear_file_index():
+    _glob_cache.clear()
+    _var_index_cache.clear()
+
+"""
+Returns the files of the variable var_prefix sorted by their first time,
+with their first and last times (from the catalog), the calendar of the
+times, and the modification time and size of each file. The index is built
+once in each process, and again (with the files found again) when the
+catalog is modified, e.g. by another process that found new files. The
+files returned by a query are checked in _find_in_timerange.
+"""
+def _get_var_index(var_prefix, base_directory, exp_prefix, fn_catalog):
+    key_index = (var_prefix, base_directory, exp_prefix, fn_catalog)
+    mtime_catalog = _get_mtime(fn_catalog)
+    if key_index in _var_index_cache:
+        if _var_index_cache[key_index][0] == mtime_catalog:
+            return _var_index_cache[key_index][1]
+        _glob_cache.pop((base_directory, exp_prefix), None)
+
+    fns = _glob_prefix(var_prefix)
+    stats = [os.stat(fn) for fn in fns]
+    catalog = _read_catalog(fn_catalog)
+    entries = []
+    new_entries = {}
+    for (fn, st) in zip(fns, stats):
+        key = os.path.abspath(fn)
+        entry = catalog.get(key)
+        if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            entry = _read_time_range(fn, st)
+            new_entries[key] = entry
+        entries.append(entry)
+    if len(new_entries) > 0:
+        _write_catalog(fn_catalog, new_entries)
+
+    t_start = np.array([x['time_start'] for x in entries])
+    t_end = np.array([x['time_end'] for x in entries])
+    order = np.argsort(t_start, kind = 'stable')
+    file_ids = [(stats[i].st_mtime, stats[i].st_size) for i in order]
+    calendar = entries[0]['calendar'] if len(entries) > 0 else 'standard'
+    index = (np.array(fns)[order], t_start[order], t_end[order], calendar, file_ids)
+    _var_index_cache[key_index] = (_get_mtime(fn_catalog), index)
+    return index
+
+"""
+Returns the files of the variable var_prefix that overlap the times ct_start
+to ct_end (or contain ct_start). The times are compared in the calendar of
+the files. Only the files that are returned are checked against the file
+system: if one of them was modified or removed since the index was built,
+or if no file is found (e.g. the files of the times were added since), the
+files are found and the index is built again.
+"""
+def _find_in_timerange(var_prefix, ct_start, ct_end = None):
+    for i in range(2):
+        fns, t_start, t_end, calendar, file_ids = _get_var_index(var_prefix, namelist.base_directory,
+                                                                 namelist.exp_prefix, get_catalog_fn())
+        t_s = _time_to_num(ct_start, calendar)
+        t_e = t_s if ct_end is None else _time_to_num(ct_end, calendar)
+        # Files overlapping [t_s, t_e]. If the files do not overlap each other,
+        # they are found by bisection; otherwise, all files are checked.
+        if np.all(np.diff(t_end) >= 0):
+            idxs = np.arange(np.searchsorted(t_end, t_s, side = 'left'),
+                             np.searchsorted(t_start, t_e, side = 'right'))
+        else:
+            idxs = np.nonzero((t_start <= t_e) & (t_end >= t_s))[0]
+        if len(idxs) > 0 and all([_get_file_id(fns[j]) == file_ids[j] for j in idxs]):
+            break
+        _clear_file_index()
+    # Keep the order of the file names, as before.
+    return(sorted([str(x) for x in fns[idxs]]))
 
 """
 Opens files described by "var", bounded by times ct_start and ct_end.
@@ -51,9 +211,9 @@ def _load_var(var, ct_start, ct_end):
     if ct_start == None and ct_end == None:
         ds = _open_fns(_glob_prefix(var))
     elif ct_start is not None and ct_end == None:
-        ds = _open_fns(_find_in_timerange(_glob_prefix(var), ct_start)).sel(time = ct_start)
+        ds = _open_fns(_find_in_timerange(var, ct_start)).sel(time = ct_start)
     else:
-        fns = _find_in_timerange(_glob_prefix(var), ct_start, ct_end)
+        fns = _find_in_timerange(var, ct_start, ct_end)
         ds = _open_fns(fns).sel(time=slice(ct_start, ct_end))
     return ds
 
@@ -108,30 +268,136 @@ def _load_var_daily(fn):
     ds = xr.open_dataset(fn)
     return ds
 
+"""
+Calendar conversion between datetimes and the times of the datasets, which
+are np.datetime64 or cftime datetimes of any calendar (e.g. noleap,
+all_leap, 360_day). Dates are converted through their fields (year, month,
+day, hour, minute, second) with numpy; only reading and making cftime dates
+loops over the dates. Days that do not exist in the target calendar (e.g.
+February 29 in noleap, or February 30 in a standard calendar) are clipped to
+the last day of the month.
+"""
+_days_in_month = {'noleap': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                  'all_leap': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                  '360_day': [30] * 12}
+_days_in_month['365_day'] = _days_in_month['noleap']
+_days_in_month['366_day'] = _days_in_month['all_leap']
+
+# Datetimes of the time axes of the open datasets, by id of the time index.
+_datetimes_cache = {}
+
+"""
+Returns the first time of ds if it is a cftime datetime (from which the
+type and calendar of the times are taken), and None if the times are
+np.datetime64. Only the first time is read.
+"""
+def _get_cftime_sample(ds):
+    idx = ds.indexes['time']
+    if np.issubdtype(idx.dtype, np.datetime64):
+        return None
+    elif isinstance(idx[0], cftime.datetime):
+        return idx[0]
+    else:
+        raise Exception("Did not understand type of time.")
+
+"""
+Returns the fields (year, month, day, hour, minute, second) of an array of
+datetimes or np.datetime64, as an integer array of dimensions (date, field).
+"""
+def _datetime64_fields(dts):
+    if not np.issubdtype(dts.dtype, np.datetime64):
+        dts = pd.to_datetime(dts).values
+    t = dts.astype('datetime64[s]')
+    t_month = t.astype('datetime64[M]')
+    s_day = (t - t.astype('datetime64[D]')).astype(np.int64)
+    return np.stack([t.astype('datetime64[Y]').astype(np.int64) + 1970,
+                     t_month.astype(np.int64) % 12 + 1,
+                     (t.astype('datetime64[D]') - t_month.astype('datetime64[D]')).astype(np.int64) + 1,
+                     s_day // 3600, s_day // 60 % 60, s_day % 60], axis = -1)
+
+"""
+Returns the first days (np.datetime64[D]) and the numbers of days of the
+months of year and month, in the standard calendar.
+"""
+def _standard_months(year, month):
+    t_month = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1).astype('timedelta64[M]')
+    t_next = (t_month + np.timedelta64(1, 'M')).astype('datetime64[D]')
+    return (t_month.astype('datetime64[D]'), (t_next - t_month.astype('datetime64[D]')).astype(np.int64))
+
+"""
+Returns the np.datetime64[s] of the fields of dimensions (date, field).
+"""
+def _fields_to_datetime64(fields):
+    (t_month, n_days) = _standard_months(fields[:, 0], fields[:, 1])
+    t = t_month + (np.minimum(fields[:, 2], n_days) - 1).astype('timedelta64[D]')
+    return t.astype('datetime64[s]') + (fields[:, 3] * 3600 + fields[:, 4] * 60 + fields[:, 5]).astype('timedelta64[s]')
+
+def _cftime_fields(dts):
+    return np.stack([np.fromiter(map(operator.attrgetter(x), dts), np.int64, len(dts))
+                     for x in ['year', 'month', 'day', 'hour', 'minute', 'second']], axis = -1)
+
+"""
+Returns the cftime datetimes of the fields of dimensions (date, field), in
+the calendar of the cftime datetime sample. The datetimes are built with
+cftime.datetime and the calendar, which is faster than with the subclass of
+the calendar (e.g. cftime.DatetimeNoLeap); they compare and hash equal to
+the datetimes of the subclass.
+"""
+def _fields_to_cftime(fields, sample):
+    if sample.calendar in _days_in_month:
+        n_days = np.array(_days_in_month[sample.calendar])[fields[:, 1] - 1]
+    else:
+        n_days = _standard_months(fields[:, 0], fields[:, 1])[1]
+    fields = fields.copy()
+    fields[:, 2] = np.minimum(fields[:, 2], n_days)
+    fx = functools.partial(cftime.datetime, calendar = sample.calendar, has_year_zero = sample.has_year_zero)
+    adt = np.empty(len(fields), dtype = object)
+    adt[:] = list(map(fx, *fields.T.tolist()))
+    return adt
+
 def convert_from_datetime(ds, dts):
     # Convert the datetime array dts to the timestamps used by ds.
-    # Only supports np.datetime64 or cftime.DatetimeNoLeap to datetimes.
     # Necessary to convert between non-standard calendars (like no leap).
-    if isinstance(np.array(ds['time'])[0], np.datetime64):
-        adt = np.array([np.datetime64(str(x)) for x in np.array(dts)])
-    elif isinstance(np.array(ds['time'])[0], cftime.DatetimeNoLeap):
-        adt = np.array([cftime.DatetimeNoLeap(x.year, x.month, x.day, x.hour) for x in np.array(dts)])
+    sample = _get_cftime_sample(ds)
+    dts = np.asarray(dts)
+    shape = dts.shape
+    if isinstance(dts.ravel()[0] if dts.size > 0 else None, cftime.datetime):
+        fields = _cftime_fields(dts.ravel())
     else:
-        raise Exception("Did not understand type of time.")
-    return adt
+        fields = _datetime64_fields(dts.ravel())
+    if sample is None:
+        adt = _fields_to_datetime64(fields)
+    else:
+        adt = _fields_to_cftime(fields, sample)
+    return adt.reshape(shape)
 
 def convert_to_datetime(ds, dts):
     # Convert the timestamps types of ds to datetime timestamps.
-    # Only supports np.datetime64 or cftime.DatetimeNoLeap to datetimes.
     # Necessary to convert between non-standard calendars (like no leap).
-    if isinstance(np.array(ds['time'])[0], np.datetime64):
-        adt = np.array(dts.astype('datetime64[s]').tolist())
-    elif isinstance(np.array(ds['time'])[0], cftime.DatetimeNoLeap):
-        adt = np.array([datetime.datetime(x.year, x.month, x.day, x.hour) for x in np.array(dts)])
+    sample = _get_cftime_sample(ds)
+    dts = np.asarray(dts)
+    if sample is None:
+        adt = dts.astype('datetime64[s]').astype(object)
     else:
-        raise Exception("Did not understand type of time.")
+        adt = _fields_to_datetime64(_cftime_fields(dts.ravel())).astype(object).reshape(dts.shape)
     return adt
 
+"""
+Returns the times of ds as datetimes. The times are converted once, and
+kept while the time axis of ds exists; the returned array is read-only.
+"""
+def get_datetimes(ds):
+    idx = ds.indexes['time']
+    key = id(idx)
+    entry = _datetimes_cache.get(key)
+    if entry is None or entry[0]() is not idx:
+        dts = convert_to_datetime(ds, idx.values)
+        dts.setflags(write = False)
+        entry = (weakref.ref(idx), dts)
+        _datetimes_cache[key] = entry
+        weakref.finalize(idx, _datetimes_cache.pop, key, None)
+    return entry[1]
+
 def get_bounding_times():
     s_dt = datetime.datetime(namelist.start_year, namelist.start_month, 1)
     N_day = calendar.monthrange(namelist.end_year, namelist.end_month)[1]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Opt-in instrumentation of the downscaling model, enabled with
+namelist.instrument. Timers measure the wall time of the stages of
+run_tracks (reading inputs, setting up the months, seeding, integration,
+maximum winds), and counters count events (RHS evaluations, rejected seeds
+and tracks, Cholesky failures). Counters can be attributed to a basin.
+
+The state is per process, and is reset at the start of each task. When
+instrumentation is disabled, tic, toc and count return immediately, so the
+instrumented code runs as before.
+"""
+
+import json
+import time
+
+_enabled = False
+_timers = {}
+_counters = {}
+_basin_counters = {}
+
+"""
+Enables (or disables) instrumentation, and resets the timers and counters.
+"""
+def enable(enabled):
+    global _enabled
+    _enabled = bool(enabled)
+    _timers.clear()
+    _counters.clear()
+    _basin_counters.clear()
+
+def is_enabled():
+    return _enabled
+
+"""
+Returns the start time of a timer (see toc), or 0 if instrumentation is disabled.
+"""
+def tic():
+    if not _enabled:
+        return 0.
+    return time.perf_counter()
+
+"""
+Adds the wall time since t_start (from tic) to the timer name.
+"""
+def toc(name, t_start):
+    if not _enabled:
+        return
+    timer_name = _timers.setdefault(name, [0.0, 0])
+    timer_name[0] += time.perf_counter() - t_start
+    timer_name[1] += 1
+
+"""
+Adds n to the counter name. If basin_id is given, the count is also
+attributed to that basin.
+"""
+def count(name, n = 1, basin_id = None):
+    if not _enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + int(n)
+    if basin_id is not None:
+        counters_b = _basin_counters.setdefault(str(basin_id), {})
+        counters_b[name] = counters_b.get(name, 0) + int(n)
+
+"""
+Returns the timers and counters as a dictionary, or an empty dictionary
+if instrumentation is disabled.
+"""
+def collect():
+    if not _enabled:
+        return {}
+    return dict(timers = {k: dict(total_s = v[0], calls = v[1]) for (k, v) in _timers.items()},
+                counters = dict(_counters),
+                basins = {k: dict(v) for (k, v) in _basin_counters.items()})
+
+"""
+Sums a list of dictionaries from collect().
+"""
+def aggregate(stats):
+    total = dict(timers = {}, counters = {}, basins = {})
+    for x in stats:
+        for (k, v) in x.get('timers', {}).items():
+            t = total['timers'].setdefault(k, dict(total_s = 0.0, calls = 0))
+            t['total_s'] += v['total_s']
+            t['calls'] += v['calls']
+        for (k, v) in x.get('counters', {}).items():
+            total['counters'][k] = total['counters'].get(k, 0) + v
+        for (b, counters_b) in x.get('basins', {}).items():
+            total_b = total['basins'].setdefault(b, {})
+            for (k, v) in counters_b.items():
+                total_b[k] = total_b.get(k, 0) + v
+    return total
+
+"""
+Writes the statistics of each year (a dictionary of year to the output of
+collect), and their total, to the JSON file fn_out.
+"""
+def write_sidecar(fn_out, stats_per_year, attrs = {}):
+    out = dict(attrs)
+    out['years'] = {str(yr): x for (yr, x) in stats_per_year.items()}
+    out['total'] = aggregate(stats_per_year.values())
+    with open(fn_out, 'w') as f:
+        json.dump(out, f, indent = 1)
@@ -152,6 +152,103 @@ def interp2_fx(lon, lat, X):
     f_X = RectBivariateSpline(lon, r_lat, r_X, kx=1, ky=1)
     return(f_X)
 
+"""
+Bilinear interpolation of a stack of 2-D fields that share the same grid.
+X has dimensions [field, lat, lon]. All of the fields are returned in one
+lookup, with dimensions [field] + shape of clon, so a scalar query returns
+a 1-D array with one value per field. As with interp2_fx, points outside of
+the grid take the value at the nearest edge of the grid.
+"""
+class Interp2Stack:
+    def __init__(self, lon, lat, X):
+        lon = np.asarray(lon, dtype = float)
+        lat = np.asarray(lat, dtype = float)
+        X = np.asarray(X, dtype = float)
+        if lat[1] - lat[0] < 0:
+            # Reverse grid since x and y must be strictly increasing.
+            lat = np.flip(lat, 0)
+            X = np.flip(X, 1)
+        self.lon = lon
+        self.lat = lat
+        self.lon_dx = (lon[-1] - lon[0]) / (lon.size - 1) if np.allclose(np.diff(lon), lon[1] - lon[0]) else None
+        self.lat_dx = (lat[-1] - lat[0]) / (lat.size - 1) if np.allclose(np.diff(lat), lat[1] - lat[0]) else None
+        self.n_fields = X.shape[0]
+        # Store as [lat * lon, field], so the fields at a grid point are contiguous.
+        self.X = np.ascontiguousarray(np.moveaxis(X, 0, -1)).reshape((lat.size * lon.size, self.n_fields))
+        self.corner_offsets = np.array([0, 1, lon.size, lon.size + 1])
+        # For single points: a [lat, lon, field] view of X, and the grids
+        # as Python floats, to avoid the overhead of numpy scalars.
+        self.X_grid = self.X.reshape((lat.size, lon.size, self.n_fields))
+        self.lon_point = (float(lon[0]), None if self.lon_dx is None else float(self.lon_dx), lon.size)
+        self.lat_point = (float(lat[0]), None if self.lat_dx is None else float(self.lat_dx), lat.size)
+
+    """ Returns the lower index and weight of x in the (increasing) grid x_grid.
+        Uniform grids (spacing dx) use index arithmetic instead of a search. """
+    def _grid_weights(self, x, x_grid, dx):
+        if dx is not None:
+            x_idx = np.minimum(np.maximum((x - x_grid[0]) / dx, 0), x_grid.size - 1)
+        else:
+            x_idx = np.interp(x, x_grid, np.arange(x_grid.size))
+        x_idx0 = np.minimum(x_idx.astype(int), x_grid.size - 2)
+        return (x_idx0, x_idx - x_idx0)
+
+    """ Scalar version of _grid_weights, for a Python float x. """
+    def _grid_weight_point(self, x, x_grid, x_point):
+        (x0, dx, n) = x_point
+        if dx is not None:
+            x_idx = min(max((x - x0) / dx, 0.0), n - 1)
+        else:
+            x_idx = float(np.interp(x, x_grid, np.arange(n)))
+        x_idx0 = min(int(x_idx), n - 2)
+        return (x_idx0, x_idx - x_idx0)
+
+    """ Scalar version of ev, which avoids the overhead of array operations:
+        the weights are computed with Python floats, and the four corners
+        are a view of the grid. """
+    def _ev_point(self, clon, clat):
+        if clon != clon or clat != clat:
+            return np.full(self.n_fields, np.nan)
+        lon_idx, w_lon = self._grid_weight_point(clon, self.lon, self.lon_point)
+        lat_idx, w_lat = self._grid_weight_point(clat, self.lat, self.lat_point)
+        w_c = np.array([(1 - w_lat) * (1 - w_lon), (1 - w_lat) * w_lon,
+                        w_lat * (1 - w_lon), w_lat * w_lon])
+        X_c = self.X_grid[lat_idx:lat_idx+2, lon_idx:lon_idx+2].reshape((4, self.n_fields))
+        return np.dot(w_c, X_c)
+
+    def ev(self, clon, clat):
+        # Single points (e.g. one storm integrated by solve_ivp) skip the
+        # setup of the arrays of points.
+        if isinstance(clon, np.ndarray) and isinstance(clat, np.ndarray):
+            (shape, size) = (clon.shape, clon.size)
+            if size == 1:
+                return self._ev_point(clon.item(), clat.item()).reshape((self.n_fields,) + shape)
+        else:
+            (shape, size) = (np.shape(clon), np.size(clon))
+            if size == 1:
+                X_v = self._ev_point(float(np.ravel(clon)[0]), float(np.ravel(clat)[0]))
+                return X_v.reshape((self.n_fields,) + shape)
+
+        clon = np.ravel(clon)
+        clat = np.ravel(clat)
+        is_nan = np.isnan(clon + clat)
+        has_nan = is_nan.any()
+        if has_nan:
+            clon = np.where(is_nan, self.lon[0], clon)
+            clat = np.where(is_nan, self.lat[0], clat)
+
+        lon_idx, w_lon = self._grid_weights(clon, self.lon, self.lon_dx)
+        lat_idx, w_lat = self._grid_weights(clat, self.lat, self.lat_dx)
+
+        # Gather the four corners of each cell, [point, corner, field].
+        idx = lat_idx * self.lon.size + lon_idx
+        X_c = self.X[idx[:, np.newaxis] + self.corner_offsets]
+        w_c = np.stack([(1 - w_lat) * (1 - w_lon), (1 - w_lat) * w_lon,
+                        w_lat * (1 - w_lon), w_lat * w_lon], axis = 0)
+        X_v = np.einsum('cn,ncf->fn', w_c, X_c)
+        if has_nan:
+            X_v[:, is_nan] = np.nan
+        return X_v.reshape((self.n_fields,) + shape)
+
 """
 2-D interpolation. Interpolates a field X (dimensions [lat, lon]),
 to a grid defined by [lat_grid, lon_grid].
@@ -172,6 +269,48 @@ def interp_2d_points(lon, lat, X, interp_lons, interp_lats):
     X_grid = f_X.ev(interp_lons, interp_lats)
     return(X_grid)
 
+"""
+Streaming mean and covariance matrix of a stack of fields, updated one
+sample at a time (Welford's algorithm), so that only the running moments are
+kept in memory. Samples have dimensions [field] + shape. As in xarray, NaN
+values are skipped: the statistics of each pair of fields are computed over
+the samples where both are valid.
+"""
+class StreamingMeanCov:
+    def __init__(self, n_fields, shape):
+        self.n_fields = n_fields
+        # Moments of each pair of fields [i, j, ...]: the number of valid
+        # samples, the mean of field i, and the co-moment of fields i and j.
+        self.n = np.zeros((n_fields, n_fields) + tuple(shape))
+        self.mean = np.zeros((n_fields, n_fields) + tuple(shape))
+        self.C = np.zeros((n_fields, n_fields) + tuple(shape))
+
+    """ Adds the sample X, with dimensions [field] + shape. """
+    def update(self, X):
+        X = np.asarray(X, dtype = float)
+        valid = np.isfinite(X)
+        X = np.where(valid, X, 0)
+        is_pair = valid[:, None] & valid[None, :]
+        self.n += is_pair
+        dX = np.where(is_pair, X[:, None] - self.mean, 0)
+        self.mean += np.divide(dX, self.n, out = np.zeros(dX.shape), where = is_pair)
+        self.C += dX * np.where(is_pair, X[None, :] - np.swapaxes(self.mean, 0, 1), 0)
+
+    """ Returns the means of the fields, [field] + shape. """
+    def get_mean(self):
+        idx = np.arange(self.n_fields)
+        return np.where(self.n[idx, idx] > 0, self.mean[idx, idx], np.nan)
+
+    """ Returns the covariance matrix, [field, field] + shape, normalized by
+        N - ddof for the variances and by N - ddof_cov for the covariances. """
+    def get_cov(self, ddof = 0, ddof_cov = 1):
+        idx = np.arange(self.n_fields)
+        ddofs = np.full((self.n_fields, self.n_fields), ddof_cov)
+        ddofs[idx, idx] = ddof
+        ddofs = ddofs.reshape(ddofs.shape + (1,) * (self.n.ndim - 2))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(self.n - ddofs > 0, self.C / (self.n - ddofs), np.nan)
+
 """Find the nearest positive-definite matrix to input
 
 A Python/Numpy port of John D'Errico's `nearestSPD` MATLAB code [1], which
@@ -222,6 +361,30 @@ def isPD(B):
     except la.LinAlgError:
         return False
 
+"""
+Cholesky factors of a stack of symmetric matrices A (dimensions [..., n, n]).
+Matrices that are not positive-definite are replaced by the nearest
+positive-definite matrix (see nearestPD) before they are factorized.
+Returns the lower triangular factors and the number of repaired matrices.
+"""
+def cholesky_nearestPD(A):
+    A_flat = np.reshape(A, (-1,) + np.shape(A)[-2:])
+    try:
+        L = la.cholesky(A_flat)
+        return (L.reshape(np.shape(A)), 0)
+    except la.LinAlgError:
+        pass
+
+    L = np.zeros(A_flat.shape)
+    n_repaired = 0
+    for i in range(A_flat.shape[0]):
+        try:
+            L[i] = la.cholesky(A_flat[i])
+        except la.LinAlgError:
+            L[i] = la.cholesky(nearestPD(A_flat[i]))
+            n_repaired += 1
+    return (L.reshape(np.shape(A)), n_repaired)
+
 def smooth_anomaly(lon_idx, lat_idx, X, dx):
     X_smooth = np.copy(X)
     X_temp = np.copy(X)
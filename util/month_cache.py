@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+On-disk cache of the monthly fields of the downscaling model, cropped to
+the basin: the thermodynamic and ocean fields interpolated to the middle of
+each month, and the environmental wind statistics (and their Cholesky
+factors). The fields only depend on the input files, the month, the basin
+and a few namelist parameters, so they are shared by all of the simulations
+of an experiment (and by all of the processes of a simulation).
+
+Each entry is keyed by a hash of its inputs: the name, size and modification
+time of the input files, and the namelist parameters that the fields depend
+on. Entries are saved as directories of .npy files, which are memory-mapped
+when read. When the cache is larger than namelist.month_cache_max_gb, the
+least recently used entries are removed. A maximum size of 0 disables it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+import namelist
+
+"""
+Returns the directory of the cache.
+"""
+def get_cache_dir():
+    if namelist.month_cache_dir is not None:
+        return(namelist.month_cache_dir)
+    return('%s/month_cache' % namelist.output_directory)
+
+"""
+Returns the identity of the file fn in a key: its path, size and
+modification time (a directory, like a Zarr store, is identified by
+its path and modification time).
+"""
+def file_id(fn):
+    st = os.stat(fn)
+    return [os.path.abspath(fn), st.st_size if os.path.isfile(fn) else 0, st.st_mtime]
+
+def _get_key(name, key_parts):
+    key_str = json.dumps([name] + list(key_parts), default = str)
+    return('%s_%s' % (name, hashlib.sha1(key_str.encode()).hexdigest()))
+
+def _dir_size(fn_dir):
+    return sum([os.path.getsize('%s/%s' % (fn_dir, fn)) for fn in os.listdir(fn_dir)])
+
+"""
+Removes the least recently used entries until the cache is smaller than
+namelist.month_cache_max_gb.
+"""
+def _evict(cache_dir):
+    entries = []
+    for key in os.listdir(cache_dir):
+        fn_dir = '%s/%s' % (cache_dir, key)
+        if os.path.isdir(fn_dir) and not key.startswith('.'):
+            entries.append((os.path.getmtime(fn_dir), _dir_size(fn_dir), fn_dir))
+    size_max = namelist.month_cache_max_gb * 1e9
+    size = sum([x[1] for x in entries])
+    for (_, size_entry, fn_dir) in sorted(entries):
+        if size <= size_max:
+            break
+        shutil.rmtree(fn_dir, ignore_errors = True)
+        size -= size_entry
+
+"""
+Returns the arrays (a dictionary) of the entry "name" with the inputs
+key_parts (a list of values that can be written to JSON, or converted to
+strings). If the entry is not in the cache, the arrays are computed by
+f_compute and saved. Arrays read from the cache are read-only.
+"""
+def get_arrays(name, key_parts, f_compute):
+    if namelist.month_cache_max_gb <= 0:
+        return f_compute()
+
+    cache_dir = get_cache_dir()
+    fn_dir = '%s/%s' % (cache_dir, _get_key(name, key_parts))
+    if os.path.isdir(fn_dir):
+        try:
+            arrays = {fn[:-4]: np.load('%s/%s' % (fn_dir, fn), mmap_mode = 'r')
+                      for fn in os.listdir(fn_dir) if fn.endswith('.npy')}
+            os.utime(fn_dir)
+            return arrays
+        except (OSError, ValueError):
+            # The entry was evicted while being read.
+            pass
+
+    # Save to a temporary directory which is then renamed, so that other
+    # processes never read a partially written entry.
+    arrays = f_compute()
+    os.makedirs(cache_dir, exist_ok = True)
+    fn_tmp = '%s/.%s.%d' % (cache_dir, os.path.basename(fn_dir), os.getpid())
+    os.makedirs(fn_tmp, exist_ok = True)
+    for (var, X) in arrays.items():
+        np.save('%s/%s.npy' % (fn_tmp, var), np.asarray(X))
+    try:
+        os.rename(fn_tmp, fn_dir)
+    except OSError:
+        # Another process saved the entry first.
+        shutil.rmtree(fn_tmp, ignore_errors = True)
+    _evict(cache_dir)
+    return arrays
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Writing and reading of the output files of the model: the thermodynamic
+fields, the environmental wind statistics and the tracks.
+
+The encoding of the files is chosen with namelist.output_profile, and the
+file format (netCDF or Zarr) with namelist.output_format. The chunks of each
+product are aligned with how the model reads it: the gridded fields are read
+one month at a time, and the tracks are read whole. Files that are too large
+to be computed in memory are created with create_dataset, and then written
+region by region with write_region.
+"""
+
+import netCDF4
+import os
+import shutil
+import numpy as np
+import xarray as xr
+
+import namelist
+
+# Zarr is optional, and only needed with namelist.output_format = 'zarr'.
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# Encoding profiles. 'compression' and 'complevel' are only used by netCDF;
+# Zarr uses its default compressor. 'dtype' packs floating point variables.
+# The 'default' profile writes netCDF files as xarray does without an
+# encoding (contiguous, uncompressed); Zarr files are always chunked.
+profiles = dict(default = dict(),
+                zlib = dict(compression = 'zlib', complevel = 4, shuffle = True),
+                zlib_float32 = dict(compression = 'zlib', complevel = 4, shuffle = True, dtype = 'float32'),
+                zstd = dict(compression = 'zstd', complevel = 4, shuffle = True),
+                zstd_float32 = dict(compression = 'zstd', complevel = 4, shuffle = True, dtype = 'float32'))
+
+# Chunk sizes of each product, along each dimension. Dimensions that are
+# not listed are not split.
+product_chunks = dict(thermo = dict(time = 1),
+                      env_wnd = dict(time = 1),
+                      tracks = dict(n_trk = 1024, obs = 2**18))
+
+"""
+Raises an error if the output format fmt is not valid, or needs a package
+that is not installed.
+"""
+def check_format(fmt):
+    if fmt not in ['netcdf', 'zarr']:
+        raise ValueError("Output format %s is not valid. Use 'netcdf' or 'zarr'." % fmt)
+    if fmt == 'zarr' and zarr is None:
+        raise ImportError("Output format 'zarr' needs the zarr package (pip install zarr).")
+
+"""
+Returns the name of the file fn (with a .nc extension) in the output format.
+"""
+def get_fn(fn):
+    if namelist.output_format == 'zarr':
+        return('%s.zarr' % os.path.splitext(fn)[0])
+    return(fn)
+
+"""
+Returns the name of the file fn (with a .nc extension) in the format it was
+written in, whatever the current output format: the .zarr store if only it
+exists, and fn otherwise.
+"""
+def find_fn(fn):
+    fn_zarr = '%s.zarr' % os.path.splitext(fn)[0]
+    if not os.path.exists(fn) and os.path.exists(fn_zarr):
+        return(fn_zarr)
+    return(fn)
+
+"""
+Opens a dataset written by write_dataset, in either format. Keyword
+arguments (e.g. use_cftime) are passed to xarray.
+"""
+def open_dataset(fn, **kwargs):
+    if fn.endswith('.zarr'):
+        check_format('zarr')
+        return xr.open_zarr(fn, **kwargs)
+    return xr.open_dataset(fn, **kwargs)
+
+"""
+Returns the encoding of the data variables of ds, for the product
+(a key of product_chunks), under the encoding profile.
+"""
+def get_encoding(ds, product, profile):
+    check_format(namelist.output_format)
+    if profile not in profiles:
+        raise ValueError('Output profile %s is not valid. See output.profiles.' % profile)
+    enc_profile = dict(profiles[profile])
+    if enc_profile.get('compression') == 'zstd' and not netCDF4.__has_zstandard_support__:
+        raise ValueError('Output profile %s needs netCDF4 with zstd support.' % profile)
+    if namelist.output_format == 'zarr':
+        enc_profile = {k: v for (k, v) in enc_profile.items() if k == 'dtype'}
+
+    chunks = product_chunks[product]
+    encoding = dict()
+    for (var, da) in ds.data_vars.items():
+        if not np.issubdtype(da.dtype, np.number) or 0 in da.shape:
+            continue
+        enc = {k: v for (k, v) in enc_profile.items() if k != 'dtype'}
+        if 'dtype' in enc_profile and np.issubdtype(da.dtype, np.floating):
+            enc['dtype'] = enc_profile['dtype']
+        # Compressed netCDF variables, and Zarr arrays, are chunked.
+        is_chunked = 'compression' in enc or namelist.output_format == 'zarr'
+        if is_chunked and len(set(chunks) & set(da.dims)) > 0:
+            chunk_shape = tuple([min(chunks.get(dim, n), n) for (dim, n) in zip(da.dims, da.shape)])
+            enc['chunks' if namelist.output_format == 'zarr' else 'chunksizes'] = chunk_shape
+        encoding[var] = enc
+    return encoding
+
+"""
+Writes ds to fn (from get_fn) in the output format, with the encoding of
+the product under namelist.output_profile.
+"""
+def write_dataset(ds, fn, product):
+    encoding = get_encoding(ds, product, namelist.output_profile)
+    if namelist.output_format == 'zarr':
+        ds.to_zarr(fn, mode = 'w', encoding = encoding)
+    else:
+        ds.to_netcdf(fn, mode = 'w', encoding = encoding)
+
+"""
+Creates the file fn (from get_fn) for ds in the output format, with the
+encoding of the product under namelist.output_profile, but only writes its
+coordinates and metadata. The data variables of ds can be lazy (e.g. dask
+arrays), and are written later with write_region.
+"""
+def create_dataset(ds, fn, product):
+    encoding = get_encoding(ds, product, namelist.output_profile)
+    if namelist.output_format == 'zarr':
+        ds.to_zarr(fn, mode = 'w', encoding = encoding, compute = False)
+    else:
+        ds.to_netcdf(fn, mode = 'w', encoding = encoding, compute = False)
+
+"""
+Removes the file fn, in either format, if it exists.
+"""
+def remove(fn):
+    if os.path.isdir(fn):
+        shutil.rmtree(fn)
+    elif os.path.exists(fn):
+        os.remove(fn)
+
+"""
+Writes the data variables of ds (without coordinates) to the region of the
+file fn from create_dataset. region is a dictionary of dimensions to slices.
+"""
+def write_region(ds, fn, region):
+    if fn.endswith('.zarr'):
+        check_format('zarr')
+        ds.to_zarr(fn, region = {dim: region.get(dim, slice(None)) for dim in ds.dims})
+    else:
+        with netCDF4.Dataset(fn, 'r+') as nc:
+            for (var, da) in ds.data_vars.items():
+                nc[var][tuple([region.get(dim, slice(None)) for dim in da.dims])] = da.data
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Process-wide store of the static fields of the downscaling model, i.e. the
+fields that do not change over a run: the land mask and bathymetry, the
+basin masks, and the mixed layer depth and stratification climatologies.
+
+The variables of a source file are read once, and saved as .npy files in
+the static field directory. Every process (including the dask workers)
+memory-maps the same .npy files, so the fields are read once per run and
+are shared between processes through the page cache, instead of being
+reread from the netCDF files for every month and year. The fields are
+stored under their name and a hash of the path of the source file and of
+the shapes of its variables, so that experiments that share an output
+directory, but read different files or grids, do not share their fields.
+The .npy files are refreshed when the source file is modified.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import xarray as xr
+
+import namelist
+
+_fields = {}
+
+"""
+Returns the directory where the static fields are stored.
+"""
+def get_static_dir():
+    return('%s/static_fields' % namelist.output_directory)
+
+"""
+Saves the variables (a dictionary of arrays) in the directory fn_dir.
+Each file is written to a temporary file and then renamed, so that other
+processes never map a partially written file.
+"""
+def _save_fields(fn_dir, fields):
+    os.makedirs(fn_dir, exist_ok = True)
+    for (var, X) in fields.items():
+        fn_tmp = '%s/%s.%d.tmp.npy' % (fn_dir, var, os.getpid())
+        np.save(fn_tmp, np.asarray(X))
+        os.replace(fn_tmp, '%s/%s.npy' % (fn_dir, var))
+
+"""
+Returns the directory of the fields "key" read from the source file fn_src,
+whose variables have the shapes var_shapes (a dictionary of tuples).
+"""
+def _get_fields_dir(key, fn_src, var_shapes):
+    key_str = json.dumps([os.path.abspath(fn_src), sorted([[var, list(x)] for (var, x) in var_shapes.items()])])
+    return('%s/%s_%s' % (get_static_dir(), key, hashlib.sha1(key_str.encode()).hexdigest()))
+
+"""
+Returns the variables var_names of the netCDF file fn_src, as a dictionary
+of read-only, memory-mapped arrays. key is the name of the fields in the store.
+"""
+def get_fields(key, fn_src, var_names):
+    mtime_src = os.path.getmtime(fn_src)
+    key_src = (key, os.path.abspath(fn_src), tuple(var_names))
+    if key_src in _fields and _fields[key_src][0] >= mtime_src:
+        return _fields[key_src][1]
+
+    # Only the header of the source is read, unless the fields are not stored.
+    with xr.open_dataset(fn_src) as ds:
+        fn_dir = _get_fields_dir(key, fn_src, {var: ds[var].shape for var in var_names})
+        fn_vars = ['%s/%s.npy' % (fn_dir, var) for var in var_names]
+        if not all([os.path.exists(fn) and os.path.getmtime(fn) >= mtime_src for fn in fn_vars]):
+            _save_fields(fn_dir, {var: ds[var].data for var in var_names})
+
+    fields = {var: np.load(fn, mmap_mode = 'r') for (var, fn) in zip(var_names, fn_vars)}
+    _fields[key_src] = (mtime_src, fields)
+    return fields
@@ -1,3 +1,5 @@
+import concurrent.futures
+import itertools
 import os
 import subprocess
 import namelist
@@ -18,15 +20,39 @@ def inv_trans_sampling(data, n_bins=40, n_samples=1000):
 
 
 """
-Seed the generator. Advantage of this method is that processes that
-run close to each other will have very different seeds.
+Returns the SeedSequence of the random stream below seed_seq that is
+identified by keys. Random streams form a hierarchy: the run, followed by
+the simulation index, the year, and the storm (e.g. seed_seq of a year and
+keys = (storm index,)). Since a stream only depends on its keys, and not
+on the order in which streams are created, any stream can be recreated
+on its own.
 """
-def random_seed():
-    t = int(time.time() * 1000.0)
-    np.random.seed(((t & 0xff000000) >> 24) +
-                   ((t & 0x00ff0000) >>  8) +
-                   ((t & 0x0000ff00) <<  8) +
-                   ((t & 0x000000ff) << 24))
+def child_seed_seq(seed_seq, *keys):
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key = tuple(seed_seq.spawn_key) + tuple(keys))
+
+"""
+Runs fx on each of the argument tuples in tasks in the process pool, and
+yields (index of the task, result) as the tasks finish. At most
+max_pending tasks are submitted at a time, and no reference to a result
+is kept once it has been yielded, so the memory held by the results does
+not grow with the number of tasks.
+"""
+def pool_imap_unordered(pool, fx, tasks, max_pending):
+    tasks = enumerate(tasks)
+    futures = {}
+    while True:
+        for (i, args) in itertools.islice(tasks, max_pending - len(futures)):
+            futures[pool.submit(fx, *args)] = i
+        if len(futures) == 0:
+            return
+        done, _ = concurrent.futures.wait(futures, return_when = concurrent.futures.FIRST_COMPLETED)
+        while len(done) > 0:
+            future = done.pop()
+            i = futures.pop(future)
+            result = future.result()
+            del future
+            yield (i, result)
+            del result
 
 def map_to_fx(source_idx, fxs):
     if source_idx > len(fxs):